@@ -0,0 +1,323 @@
+#!/opt/homebrew/bin/python3.11
+# Copyright 2024 by moshix
+# Benchmarks for the search servers
+#
+#   corpus  write a synthetic FILES/ tree of text files and PDFs plus a videos catalog
+#   micro   time search_text_file, search_pdf and search_videos on a corpus
+#   load    open N telnet connections to a running TelnetServer, replay a query
+#           mix and report throughput and p50/p95/p99 latency
+#
+# Every run prints a summary and, with --output, writes its results as JSON
+# so runs before and after a change can be compared.
+#
+# invoke with:
+#   python3 benchmark.py corpus --dir bench/FILES/ --videos_file bench/videos.txt --text_files 200 --text_kb 64 --pdf_files 20
+#   python3 benchmark.py micro --dir bench/FILES/ --videos_file bench/videos.txt --output micro.json
+#   python3 telnet.py --port 8023 --files_dir bench/FILES/ --videos_file bench/videos.txt
+#   python3 benchmark.py load --port 8023 --connections 50 --duration 30 --output load.json
+
+import os
+import json
+import math
+import time
+import random
+import socket
+import argparse
+import platform
+import tempfile
+import threading
+from datetime import datetime
+import search_engine
+from pdf_cache import PdfTextCache
+from video_index import VideoCatalog
+
+WORDS = ("cics mvs cobol jcl vsam ief233i dfhsip tso ispf zos racf db2 ims sysout rexx assembler "
+         "vm370 hercules dataset catalog volume spool job step abend dump the and of a to in").split()
+SEPARATORS = [" ", " ", " ", "  ", "\t", " - ", ", ", ". "]
+
+# Query mix replayed by the load generator unless --queries is given
+DEFAULT_QUERIES = [
+    '/search "cics"',
+    '/search "mvs" "cobol"',
+    '/search "ief233i abend"',
+    '/search "no such keyword"',
+    '/videosearch mvs',
+    '/videosearch hercules',
+]
+
+# Every response of the telnet server ends with this line
+RESPONSE_END = b"Response time: "
+
+
+def percentile(values, fraction):
+    """Return the nearest-rank percentile of sorted values."""
+    if not values:
+        return 0.0
+    return values[min(len(values) - 1, max(0, math.ceil(fraction * len(values)) - 1))]
+
+
+def summarize(seconds):
+    """Return count, mean and percentiles in milliseconds of a list of durations."""
+    seconds = sorted(seconds)
+    return {
+        'count': len(seconds),
+        'mean_ms': sum(seconds) / len(seconds) * 1000 if seconds else 0.0,
+        'p50_ms': percentile(seconds, 0.50) * 1000,
+        'p95_ms': percentile(seconds, 0.95) * 1000,
+        'p99_ms': percentile(seconds, 0.99) * 1000,
+        'max_ms': seconds[-1] * 1000 if seconds else 0.0,
+    }
+
+
+def write_results(results, output):
+    results['timestamp'] = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+    results['python'] = platform.python_version()
+    results['cpus'] = os.cpu_count()
+    if output:
+        with open(output, 'w') as f:
+            json.dump(results, f, indent=2)
+        print(f"Results written to {output}")
+
+
+def random_line(rng):
+    words = [rng.choice(WORDS) for _ in range(rng.randint(3, 14))]
+    words = [word.upper() if rng.random() < 0.2 else word for word in words]
+    return "".join(word + rng.choice(SEPARATORS) for word in words).rstrip()
+
+
+def write_pdf(path, pages):
+    """Write a minimal PDF with one text line per line of every page."""
+    objects = [b"<< /Type /Catalog /Pages 2 0 R >>"]
+    kids = " ".join(f"{3 + i * 2} 0 R" for i in range(len(pages)))
+    objects.append(f"<< /Type /Pages /Kids [{kids}] /Count {len(pages)} >>".encode())
+    font = 3 + len(pages) * 2
+    for i, lines in enumerate(pages):
+        objects.append(f"<< /Type /Page /Parent 2 0 R /MediaBox [0 0 612 792] /Contents {4 + i * 2} 0 R "
+                       f"/Resources << /Font << /F1 {font} 0 R >> >> >>".encode())
+        operators = ["BT /F1 10 Tf 12 TL 50 750 Td"]
+        for line in lines:
+            line = line.replace("\\", "\\\\").replace("(", "\\(").replace(")", "\\)")
+            operators.append(f"({line}) Tj T*")
+        operators.append("ET")
+        stream = "\n".join(operators).encode('latin-1')
+        objects.append(b"<< /Length %d >>\nstream\n" % len(stream) + stream + b"\nendstream")
+    objects.append(b"<< /Type /Font /Subtype /Type1 /BaseFont /Helvetica >>")
+
+    data = bytearray(b"%PDF-1.4\n")
+    offsets = []
+    for number, body in enumerate(objects, 1):
+        offsets.append(len(data))
+        data += b"%d 0 obj\n" % number + body + b"\nendobj\n"
+    xref = len(data)
+    data += b"xref\n0 %d\n0000000000 65535 f \n" % (len(objects) + 1)
+    for offset in offsets:
+        data += b"%010d 00000 n \n" % offset
+    data += b"trailer\n<< /Size %d /Root 1 0 R >>\nstartxref\n%d\n%%%%EOF\n" % (len(objects) + 1, xref)
+    with open(path, 'wb') as f:
+        f.write(data)
+
+
+def generate_corpus(args):
+    """Write text files, PDFs and a videos catalog under args.dir."""
+    rng = random.Random(args.seed)
+    os.makedirs(os.path.join(args.dir, 'sub'), exist_ok=True)
+    text_bytes = 0
+    for i in range(args.text_files):
+        # Half of the files go into a subdirectory to exercise the recursive search
+        directory = args.dir if i % 2 else os.path.join(args.dir, 'sub')
+        lines = []
+        size = 0
+        while size < args.text_kb * 1024:
+            line = random_line(rng)
+            lines.append(line)
+            size += len(line) + 1
+        with open(os.path.join(directory, f"text{i:05d}.txt"), 'w') as f:
+            f.write("\n".join(lines) + "\n")
+        text_bytes += size
+    for i in range(args.pdf_files):
+        pages = [[random_line(rng) for _ in range(args.pdf_lines)] for _ in range(args.pdf_pages)]
+        write_pdf(os.path.join(args.dir, f"doc{i:05d}.pdf"), pages)
+    if args.videos_file:
+        with open(args.videos_file, 'w') as f:
+            for i in range(args.videos):
+                f.write(f"URL:moshix.com/v{i:07d} {random_line(rng)}\n")
+    print(f"Wrote {args.text_files} text files ({text_bytes // 1024} KB), {args.pdf_files} PDFs "
+          f"and {args.videos if args.videos_file else 0} videos to {args.dir}")
+
+
+def time_calls(function, items, repeat):
+    """Call function on every item repeat times, return the duration of each call."""
+    durations = []
+    for _ in range(repeat):
+        for item in items:
+            start = time.perf_counter()
+            function(item)
+            durations.append(time.perf_counter() - start)
+    return durations
+
+
+def run_micro(args):
+    """Time the search functions on the files of a corpus."""
+    keywords = [keyword.lower().strip() for keyword in args.keywords]
+    file_paths = search_engine.list_files(args.dir)
+    text_paths = [path for path in file_paths if not path.lower().endswith('.pdf')]
+    pdf_paths = [path for path in file_paths if path.lower().endswith('.pdf')]
+    results = {'benchmark': 'micro', 'dir': args.dir, 'keywords': keywords, 'repeat': args.repeat}
+
+    if text_paths:
+        text_bytes = sum(os.path.getsize(os.path.join(args.dir, path)) for path in text_paths)
+        durations = time_calls(lambda path: search_engine.search_text_file(args.dir, path, keywords), text_paths, args.repeat)
+        results['search_text_file'] = summarize(durations)
+        results['search_text_file']['mb_per_second'] = text_bytes * args.repeat / sum(durations) / 1e6
+
+    if pdf_paths:
+        results['search_pdf'] = summarize(
+            time_calls(lambda path: search_engine.search_pdf(args.dir, path, keywords), pdf_paths, args.repeat))
+        with tempfile.TemporaryDirectory() as cache_dir:
+            # Fill the PDF text cache first, then time the searches that hit it
+            pdf_cache = PdfTextCache(cache_dir)
+            search_cached = lambda path: search_engine.search_pdf(args.dir, path, keywords, pdf_cache)
+            time_calls(search_cached, pdf_paths, 1)
+            results['search_pdf_cached'] = summarize(time_calls(search_cached, pdf_paths, args.repeat))
+
+    if args.videos_file and os.path.exists(args.videos_file):
+        start = time.perf_counter()
+        catalog = VideoCatalog(args.videos_file)
+        results['videos_load_ms'] = (time.perf_counter() - start) * 1000
+        results['search_videos'] = summarize(time_calls(catalog.search, args.video_keywords, args.repeat * 10))
+
+    for name, value in results.items():
+        if isinstance(value, dict):
+            print(f"{name:<20} " + "  ".join(f"{key} {number:.3f}" if isinstance(number, float) else f"{key} {number}"
+                                            for key, number in value.items()))
+    write_results(results, args.output)
+
+
+def read_response(sock, buffer=b""):
+    """Read from sock until the end of one response, return whatever came after it."""
+    while True:
+        end = buffer.find(RESPONSE_END)
+        if end != -1:
+            line_end = buffer.find(b"\n", end)
+            if line_end != -1:
+                return buffer[line_end + 1:]
+        data = sock.recv(65536)
+        if not data:
+            raise ConnectionError("connection closed by server")
+        buffer += data
+
+
+def load_client(args, queries, deadline, latencies, errors, lock, seed):
+    """Replay queries on one connection until deadline, one command at a time."""
+    rng = random.Random(seed)
+    own_latencies = []
+    own_errors = 0
+    try:
+        sock = socket.create_connection((args.host, args.port), timeout=args.timeout)
+        # The welcome and help text come first, switch pacing off so only searching is measured
+        sock.sendall(b"/pace off\n")
+        buffer = read_response(sock)
+        requests = 0
+        while time.time() < deadline and (not args.requests or requests < args.requests):
+            query = rng.choice(queries)
+            start = time.perf_counter()
+            try:
+                sock.sendall(query.encode('utf-8') + b"\n")
+                buffer = read_response(sock, buffer)
+            except OSError:
+                own_errors += 1
+                break
+            own_latencies.append(time.perf_counter() - start)
+            requests += 1
+        sock.close()
+    except OSError:
+        own_errors += 1
+    with lock:
+        latencies.extend(own_latencies)
+        errors.append(own_errors)
+
+
+def run_load(args):
+    """Open concurrent telnet connections, replay the query mix and report throughput and latency."""
+    if args.queries:
+        with open(args.queries) as f:
+            queries = [line.strip() for line in f if line.strip()]
+    else:
+        queries = DEFAULT_QUERIES
+
+    latencies = []
+    errors = []
+    lock = threading.Lock()
+    start = time.time()
+    deadline = start + args.duration
+    threads = [
+        threading.Thread(target=load_client, args=(args, queries, deadline, latencies, errors, lock, args.seed + i))
+        for i in range(args.connections)
+    ]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    elapsed = time.time() - start
+
+    results = {
+        'benchmark': 'load',
+        'host': args.host,
+        'port': args.port,
+        'connections': args.connections,
+        'duration_s': elapsed,
+        'queries': queries,
+        'requests': len(latencies),
+        'errors': sum(errors),
+        'throughput_rps': len(latencies) / elapsed if elapsed else 0.0,
+        'latency': summarize(latencies),
+    }
+    latency = results['latency']
+    print(f"{results['requests']} requests on {args.connections} connections in {elapsed:.1f}s, "
+          f"{results['throughput_rps']:.1f} requests/s, {results['errors']} errors")
+    print(f"latency ms: mean {latency['mean_ms']:.2f}  p50 {latency['p50_ms']:.2f}  p95 {latency['p95_ms']:.2f}  "
+          f"p99 {latency['p99_ms']:.2f}  max {latency['max_ms']:.2f}")
+    write_results(results, args.output)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Benchmark the search servers.')
+    subparsers = parser.add_subparsers(dest='command', required=True)
+
+    corpus = subparsers.add_parser('corpus', help='Generate a synthetic corpus')
+    corpus.add_argument('--dir', type=str, default='bench/FILES/', help='Directory to write the corpus to')
+    corpus.add_argument('--text_files', type=int, default=200, help='Number of text files')
+    corpus.add_argument('--text_kb', type=int, default=64, help='Size of every text file in KB')
+    corpus.add_argument('--pdf_files', type=int, default=20, help='Number of PDFs')
+    corpus.add_argument('--pdf_pages', type=int, default=10, help='Pages per PDF')
+    corpus.add_argument('--pdf_lines', type=int, default=40, help='Lines per PDF page')
+    corpus.add_argument('--videos_file', type=str, default='bench/videos.txt', help='Videos catalog to write, empty for none')
+    corpus.add_argument('--videos', type=int, default=100000, help='Number of videos in the catalog')
+    corpus.add_argument('--seed', type=int, default=1, help='Random seed, the same seed writes the same corpus')
+
+    micro = subparsers.add_parser('micro', help='Time the search functions')
+    micro.add_argument('--dir', type=str, default='bench/FILES/', help='Corpus directory')
+    micro.add_argument('--videos_file', type=str, default='bench/videos.txt', help='Videos catalog to search')
+    micro.add_argument('--keywords', nargs='+', default=['mvs', 'cobol'], help='Keywords for the file searches')
+    micro.add_argument('--video_keywords', nargs='+', default=['mvs', 'hercules', 'v00123', 'no such video'], help='Keywords for the videos search')
+    micro.add_argument('--repeat', type=int, default=3, help='Number of passes over the corpus')
+    micro.add_argument('--output', type=str, help='File to write the results to as JSON')
+
+    load = subparsers.add_parser('load', help='Load test a running telnet server')
+    load.add_argument('--host', type=str, default='127.0.0.1', help='Server host')
+    load.add_argument('--port', type=int, default=8023, help='Server port')
+    load.add_argument('--connections', type=int, default=20, help='Number of concurrent connections')
+    load.add_argument('--duration', type=float, default=30.0, help='Seconds to run')
+    load.add_argument('--requests', type=int, default=0, help='Stop every connection after this many requests, 0 for no limit')
+    load.add_argument('--queries', type=str, help='File with one command per line to replay instead of the default mix')
+    load.add_argument('--timeout', type=float, default=60.0, help='Seconds to wait for a response')
+    load.add_argument('--seed', type=int, default=1, help='Random seed for the order of the queries')
+    load.add_argument('--output', type=str, help='File to write the results to as JSON')
+
+    args = parser.parse_args()
+    if args.command == 'corpus':
+        generate_corpus(args)
+    elif args.command == 'micro':
+        run_micro(args)
+    else:
+        run_load(args)
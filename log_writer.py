@@ -0,0 +1,133 @@
+# Copyright 2024 by moshix
+# Background writer for the server log
+#
+# Client threads hand their log lines to a LogWriter and carry on, a single
+# writer thread prints them and appends them to the log file in batches. It
+# writes a batch when batch_lines lines are waiting or flush_interval seconds
+# after the first of them arrived, so a busy server does one write and flush
+# per batch instead of one per line. The queue is bounded, when it is full a
+# line is either dropped (and the number of dropped lines noted in the log
+# later) or the caller waits for room. The log file can be rotated like
+# logging's RotatingFileHandler does: server.log -> server.log.1 -> ... once
+# it grows past max_bytes.
+
+import os
+import sys
+import time
+import queue
+import threading
+
+# Put on the queue by close() to stop the writer thread
+STOP = object()
+
+
+class LogWriter:
+    def __init__(self, path='server.log', max_queue=10000, policy='drop', batch_lines=256, flush_interval=0.2,
+                 max_bytes=0, backups=5, echo=True):
+        self.path = path
+        self.policy = policy
+        self.batch_lines = max(1, batch_lines)
+        self.flush_interval = flush_interval
+        self.max_bytes = max_bytes
+        self.backups = backups
+        self.echo = echo
+        self.queue = queue.Queue(max(1, max_queue))
+        self.dropped = 0
+        self.total_dropped = 0
+        self.written = 0
+        self.closed = False
+        self.lock = threading.Lock()
+        self.file = open(self.path, 'a')
+        self.thread = threading.Thread(target=self.run, daemon=True)
+        self.thread.start()
+
+    def write(self, line):
+        """Queue a line for the log, dropping it or waiting for room when the queue is full."""
+        if self.closed:
+            return
+        if self.policy == 'block':
+            self.queue.put(line)
+            return
+        try:
+            self.queue.put_nowait(line)
+        except queue.Full:
+            with self.lock:
+                self.dropped += 1
+                self.total_dropped += 1
+
+    def close(self):
+        """Write everything still queued and close the log file."""
+        if self.closed:
+            return
+        self.closed = True
+        self.queue.put(STOP)
+        self.thread.join()
+
+    def run(self):
+        while True:
+            line = self.queue.get()
+            if line is STOP:
+                break
+            batch = [line]
+            deadline = time.monotonic() + self.flush_interval
+            stop = False
+            while len(batch) < self.batch_lines:
+                timeout = deadline - time.monotonic()
+                try:
+                    line = self.queue.get(timeout=timeout) if timeout > 0 else self.queue.get_nowait()
+                except queue.Empty:
+                    break
+                if line is STOP:
+                    stop = True
+                    break
+                batch.append(line)
+            self.write_batch(batch)
+            if stop:
+                break
+        self.write_batch([])
+        self.file.close()
+
+    def write_batch(self, batch):
+        with self.lock:
+            dropped, self.dropped = self.dropped, 0
+        if dropped:
+            timestamp = time.strftime('%Y-%m-%d %H:%M:%S')
+            batch.append(f"{timestamp} - Log queue full, dropped {dropped} log lines")
+        if not batch:
+            return
+        text = "\n".join(batch) + "\n"
+        # Whatever goes wrong with one batch, the writer thread must live on to
+        # write the next, a dead writer would leave write() filling the queue
+        if self.echo:
+            try:
+                sys.stdout.write(text)
+                sys.stdout.flush()
+            except Exception:
+                pass
+        try:
+            if self.file.closed:
+                self.file = open(self.path, 'a')
+            self.file.write(text)
+            self.file.flush()
+            self.written += len(batch)
+            if self.max_bytes > 0 and self.file.tell() >= self.max_bytes:
+                self.rotate()
+        except Exception as e:
+            sys.stderr.write(f"Error writing {self.path}: {e}\n")
+
+    def rotate(self):
+        """Move server.log to server.log.1, server.log.1 to server.log.2 and so on, and start a new file."""
+        self.file.close()
+        try:
+            if self.backups > 0:
+                for i in range(self.backups - 1, 0, -1):
+                    source = f"{self.path}.{i}"
+                    if os.path.exists(source):
+                        os.replace(source, f"{self.path}.{i + 1}")
+                os.replace(self.path, f"{self.path}.1")
+            else:
+                os.remove(self.path)
+        finally:
+            # Reopened even when a rename failed, the log then keeps growing
+            # in the old file until the next rotation works
+            self.file = open(self.path, 'a')
@@ -0,0 +1,130 @@
+# Copyright 2024 by moshix
+# Latency histograms for the search servers
+#
+# Every command and every stage of a search (walking FILES/, the index
+# lookup, reading and matching text files, reading and matching PDFs,
+# formatting and sending the results) is timed with time.perf_counter and
+# counted into a histogram with fixed buckets, so recording a duration is a
+# bisect and two additions. Search workers fill their own histograms for a
+# partition of files and hand them back with the matches, where they are
+# merged, so this works the same for worker threads and worker processes.
+# /metrics shows everything in the Prometheus text format.
+
+import time
+import bisect
+import threading
+import contextlib
+
+# Upper bounds of the histogram buckets in seconds, the last bucket is +Inf
+BUCKETS = (0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05,
+           0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0)
+
+
+class Histogram:
+    def __init__(self):
+        self.counts = [0] * (len(BUCKETS) + 1)
+        self.count = 0
+        self.sum = 0.0
+
+    def observe(self, seconds):
+        self.counts[bisect.bisect_left(BUCKETS, seconds)] += 1
+        self.count += 1
+        self.sum += seconds
+
+    def merge(self, other):
+        for i, count in enumerate(other.counts):
+            self.counts[i] += count
+        self.count += other.count
+        self.sum += other.sum
+
+    def quantile(self, fraction):
+        """Estimate a quantile by interpolating inside its bucket, like Prometheus does."""
+        if not self.count:
+            return 0.0
+        rank = fraction * self.count
+        seen = 0
+        for i, count in enumerate(self.counts):
+            if count and seen + count >= rank:
+                lower = BUCKETS[i - 1] if i > 0 else 0.0
+                upper = BUCKETS[i] if i < len(BUCKETS) else BUCKETS[-1]
+                return lower + (upper - lower) * (rank - seen) / count
+            seen += count
+        return BUCKETS[-1]
+
+
+def observe(stages, stage, seconds):
+    """Count seconds into the histogram of stage in a {stage: Histogram} dict."""
+    histogram = stages.get(stage)
+    if histogram is None:
+        histogram = stages[stage] = Histogram()
+    histogram.observe(seconds)
+
+
+class Metrics:
+    """Histograms of command and search stage durations, shared by all client threads."""
+
+    def __init__(self):
+        self.commands = {}
+        self.stages = {}
+        self.lock = threading.Lock()
+
+    def observe_command(self, command, seconds):
+        with self.lock:
+            observe(self.commands, command, seconds)
+
+    def observe_stage(self, stage, seconds):
+        with self.lock:
+            observe(self.stages, stage, seconds)
+
+    def merge_stages(self, stages):
+        """Add the {stage: Histogram} durations recorded by a search worker."""
+        with self.lock:
+            for stage, histogram in stages.items():
+                own = self.stages.get(stage)
+                if own is None:
+                    own = self.stages[stage] = Histogram()
+                own.merge(histogram)
+
+    @contextlib.contextmanager
+    def timer(self, stage):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe_stage(stage, time.perf_counter() - start)
+
+    def summary(self):
+        """Return (label, 'p50 / p95 ms') rows for every command and stage seen so far."""
+        rows = []
+        with self.lock:
+            for prefix, histograms in (("", self.commands), ("Stage ", self.stages)):
+                for name in sorted(histograms):
+                    histogram = histograms[name]
+                    rows.append((f"{prefix}{name} p50/p95",
+                                 f"{histogram.quantile(0.5) * 1000:.1f} / {histogram.quantile(0.95) * 1000:.1f} ms"))
+        return rows
+
+    def render(self, counters=(), gauges=()):
+        """Return all histograms plus the given (name, help, value) counters and gauges in Prometheus text format."""
+        lines = []
+        for kind, metrics in (('counter', counters), ('gauge', gauges)):
+            for name, help_text, value in metrics:
+                lines.append(f"# HELP searchserver_{name} {help_text}")
+                lines.append(f"# TYPE searchserver_{name} {kind}")
+                lines.append(f"searchserver_{name} {value}")
+        with self.lock:
+            for name, label, help_text, histograms in (
+                ('command_seconds', 'command', 'Time to run a command', self.commands),
+                ('stage_seconds', 'stage', 'Time spent in a stage of a search', self.stages),
+            ):
+                lines.append(f"# HELP searchserver_{name} {help_text}")
+                lines.append(f"# TYPE searchserver_{name} histogram")
+                for key in sorted(histograms):
+                    histogram = histograms[key]
+                    cumulative = 0
+                    for bound, count in zip(BUCKETS + ('+Inf',), histogram.counts):
+                        cumulative += count
+                        lines.append(f'searchserver_{name}_bucket{{{label}="{key}",le="{bound}"}} {cumulative}')
+                    lines.append(f'searchserver_{name}_sum{{{label}="{key}"}} {histogram.sum:.6f}')
+                    lines.append(f'searchserver_{name}_count{{{label}="{key}"}} {histogram.count}')
+        return "\r\n".join(lines)
@@ -0,0 +1,97 @@
+# Copyright 2024 by moshix
+# Machine readable output for /format plain and /format json
+#
+# A session normally gets responses laid out for a terminal, with ANSI
+# colors, headers and the first lines typed out one by one. Scripts can ask
+# for newline-delimited records instead: /format json sends every result as
+# one JSON object per line, /format plain as one line of tab separated
+# fields. The records are made straight from the matches of a search, the
+# colored rows are never built, and a page of them is encoded in one go and
+# written as one chunk without pacing. Every page of results, an empty one
+# too, ends with a page record. Other responses become a record with their
+# text, stripped of color codes:
+#
+#   {"no":1,"file":"jcl.txt","location":"Line 12","line":"//STEP1 EXEC PGM=IEFBR14"}
+#   {"page":1,"pages":2,"results":30,"more":true,"truncated":false,"error":null}
+#   {"error":"Usage: /regex <pattern>"}
+#   {"response_time":0.0123}
+#
+# In plain the page record starts with a # where a result starts with its
+# number, and holds name=value fields:
+#
+#   1	jcl.txt	Line 12	//STEP1 EXEC PGM=IEFBR14
+#   #page=1	pages=2	results=30	more=true	truncated=false	error=
+
+import re
+import json
+from json.encoder import encode_basestring
+
+FORMATS = ('ansi', 'plain', 'json')
+
+ANSI_RE = re.compile(r'\x1b\[[0-9;]*m')
+
+# Strings go out as they are, a record is one line either way
+_encoder = json.JSONEncoder(ensure_ascii=False, check_circular=False, separators=(',', ':'))
+
+
+def strip_ansi(text):
+    return ANSI_RE.sub('', text)
+
+
+def plain_field(value):
+    """Return value as a field of a plain record, a tab or line break in it would split the record."""
+    if isinstance(value, float):
+        return f"{value:.2f}"
+    return str(value).replace('\t', ' ').replace('\r', ' ').replace('\n', ' ')
+
+
+def encode_record(record):
+    """Return a dict as one JSON line."""
+    return (_encoder.encode(record) + '\n').encode('utf-8')
+
+
+def encode_records(output, fields, first_number, matches):
+    """Return matches, numbered from first_number, as one chunk of records.
+
+    fields names the values of a match tuple, in order.
+    """
+    if output == 'json':
+        # One JSONEncoder call per record costs more than the record itself, the
+        # values are encoded one by one into a template of the record instead
+        template = '{"no":%d' + ''.join(f',"{field}":%s' for field in fields) + '}'
+        lines = [template % (number, *[encode_basestring(value) if type(value) is str else _encoder.encode(value)
+                                       for value in match])
+                 for number, match in enumerate(matches, first_number)]
+    else:
+        # Strings get the cleaning of plain_field inline, lines extracted from PDFs may hold a \r
+        lines = ['\t'.join([str(number)] + [value.replace('\t', ' ').replace('\r', ' ').replace('\n', ' ')
+                                             if type(value) is str else plain_field(value)
+                                             for value in match])
+                 for number, match in enumerate(matches, first_number)]
+    lines.append('')
+    return '\n'.join(lines).encode('utf-8')
+
+
+def encode_page(output, page):
+    """Return the page record closing a page of results, page is a dict of its fields."""
+    if output == 'json':
+        return encode_record(page)
+    fields = [f"{name}={'' if value is None else str(value).lower() if isinstance(value, bool) else plain_field(value)}"
+              for name, value in page.items()]
+    return ('#' + '\t'.join(fields) + '\n').encode('utf-8')
+
+
+def encode_text(output, text):
+    """Return a terminal response as a record: its text in plain, an error or text object in json."""
+    text = strip_ansi(text).replace('\r\n', '\n').strip('\n')
+    if output == 'json':
+        if text.startswith('Error: '):
+            return encode_record({'error': text[len('Error: '):]})
+        return encode_record({'text': text})
+    return (text + '\n').encode('utf-8')
+
+
+def encode_response_time(output, seconds):
+    if output == 'json':
+        return encode_record({'response_time': round(seconds, 4)})
+    return f"Response time: {seconds:.4f} seconds\n".encode('utf-8')
@@ -0,0 +1,174 @@
+# Copyright 2024 by moshix
+# On-disk cache of text extracted from PDFs
+#
+# PyPDF2 text extraction is by far the slowest part of a search, so the text
+# of every page is stored zlib-compressed in cache_dir under a key made from
+# the PDF's path, size, mtime and inode. A changed PDF simply gets a new key
+# and its old entry ages out: when the cache grows past max_bytes the least
+# recently used entries are deleted (a cache hit touches the entry's mtime).
+# A search of a range of pages of a big PDF extracts them one at a time as
+# it goes and caches the range under the same key plus the page numbers once
+# all of its pages are extracted.
+
+import os
+import json
+import zlib
+import hashlib
+import tempfile
+import threading
+import PyPDF2
+
+
+def extract_pdf_pages(full_path):
+    """Return the extracted text of every page of a PDF."""
+    with open(full_path, 'rb') as file:
+        reader = PyPDF2.PdfReader(file)
+        return [page.extract_text() for page in reader.pages]
+
+
+def pdf_page_count(full_path):
+    """Return the number of pages of a PDF."""
+    with open(full_path, 'rb') as file:
+        return len(PyPDF2.PdfReader(file).pages)
+
+
+def iter_pdf_pages(full_path, first=0, last=None):
+    """Yield the extracted text of the pages first to last (exclusive) of a PDF, one page at a time."""
+    with open(full_path, 'rb') as file:
+        reader = PyPDF2.PdfReader(file)
+        for page_number in range(first, len(reader.pages) if last is None else min(last, len(reader.pages))):
+            yield reader.pages[page_number].extract_text()
+
+
+def read_pdf_pages(full_path, cache=None):
+    """Return the page texts of a PDF, from the cache when one is given."""
+    if cache is None:
+        return extract_pdf_pages(full_path)
+    return cache.get_pages(full_path)
+
+
+def read_pdf_range(full_path, first=0, last=None, cache=None):
+    """Yield the page texts of the pages first to last (exclusive) of a PDF, from the cache when one is given."""
+    if cache is None:
+        return iter_pdf_pages(full_path, first, last)
+    return cache.iter_pages(full_path, first, last)
+
+
+class PdfTextCache:
+    def __init__(self, cache_dir='.pdf_cache', max_bytes=256 * 1024 * 1024):
+        self.cache_dir = cache_dir
+        self.max_bytes = max_bytes
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        os.makedirs(self.cache_dir, exist_ok=True)
+        self.total_bytes = sum(size for _, _, size in self.entries())
+
+    def key(self, full_path, st):
+        identity = f"{os.path.abspath(full_path)}\0{st.st_size}\0{st.st_mtime_ns}\0{st.st_ino}"
+        return hashlib.sha1(identity.encode('utf-8', 'surrogateescape')).hexdigest()
+
+    def entries(self):
+        """Return (mtime, path, size) for every cache entry."""
+        entries = []
+        for name in os.listdir(self.cache_dir):
+            if not name.endswith('.z'):
+                continue
+            path = os.path.join(self.cache_dir, name)
+            try:
+                st = os.stat(path)
+            except OSError:
+                continue
+            entries.append((st.st_mtime, path, st.st_size))
+        return entries
+
+    def get_pages(self, full_path):
+        """Return the page texts of a PDF, extracting and caching them on a miss."""
+        path = os.path.join(self.cache_dir, self.key(full_path, os.stat(full_path)) + '.z')
+        try:
+            with open(path, 'rb') as f:
+                pages = json.loads(zlib.decompress(f.read()))
+            os.utime(path)
+            with self.lock:
+                self.hits += 1
+            return pages
+        except FileNotFoundError:
+            pass
+        except (OSError, ValueError, zlib.error):
+            # Truncated or corrupt entry, extract again and overwrite it
+            pass
+
+        pages = extract_pdf_pages(full_path)
+        with self.lock:
+            self.misses += 1
+        self.store(path, pages)
+        return pages
+
+    def load(self, path):
+        """Return the pages of a cache entry, None if it is missing or unreadable."""
+        try:
+            with open(path, 'rb') as f:
+                pages = json.loads(zlib.decompress(f.read()))
+            os.utime(path)
+            return pages
+        except (OSError, ValueError, zlib.error):
+            return None
+
+    def iter_pages(self, full_path, first=0, last=None):
+        """Yield the page texts of a range of pages of a PDF, extracting them lazily and caching the range on a miss.
+
+        A range that is not read to its end, because the search stopped
+        early, is not cached.
+        """
+        key = self.key(full_path, os.stat(full_path))
+        whole_path = os.path.join(self.cache_dir, key + '.z')
+        range_path = whole_path if first == 0 and last is None else os.path.join(self.cache_dir, f"{key}-{first}-{last}.z")
+        whole = self.load(whole_path)
+        cached = whole[first:last] if whole is not None else self.load(range_path)
+        if cached is not None:
+            with self.lock:
+                self.hits += 1
+            yield from cached
+            return
+
+        with self.lock:
+            self.misses += 1
+        pages = []
+        for text in iter_pdf_pages(full_path, first, last):
+            pages.append(text)
+            yield text
+        self.store(range_path, pages)
+
+    def store(self, path, pages):
+        data = zlib.compress(json.dumps(pages).encode('utf-8'))
+        if len(data) > self.max_bytes:
+            return
+        # Write to a temporary file first so readers never see a partial entry
+        fd, tmp_path = tempfile.mkstemp(dir=self.cache_dir, suffix='.tmp')
+        try:
+            with os.fdopen(fd, 'wb') as f:
+                f.write(data)
+            os.replace(tmp_path, path)
+        except OSError:
+            try:
+                os.unlink(tmp_path)
+            except OSError:
+                pass
+            return
+        with self.lock:
+            self.total_bytes += len(data)
+            if self.total_bytes > self.max_bytes:
+                self.evict()
+
+    def evict(self):
+        """Delete least recently used entries until the cache is below 90% of max_bytes."""
+        entries = sorted(self.entries())
+        self.total_bytes = sum(size for _, _, size in entries)
+        for _, path, size in entries:
+            if self.total_bytes <= self.max_bytes * 0.9:
+                break
+            try:
+                os.unlink(path)
+            except OSError:
+                continue
+            self.total_bytes -= size
@@ -0,0 +1,132 @@
+# Copyright 2024 by moshix
+# BM25 ranking of search matches for /rank
+#
+# A ranked search looks at every matching line instead of stopping after
+# max_results, and keeps only the best k of them in a bounded heap, so the
+# memory it needs doesn't grow with the number of matches. A line is scored
+# with BM25 on its own (keyword occurrences in the line against its length),
+# plus a share of the BM25 score of its file (keyword occurrences in all
+# matching lines of the file against the file's length) and a boost for
+# keywords that stand close together. Inverse document frequencies and
+# average lengths come from the search index, without it every keyword
+# weighs the same and lengths are not normalized.
+
+import math
+import heapq
+from search_engine import WHITESPACE_RE
+from search_index import TOKEN_RE
+
+# BM25 term frequency saturation and length normalization
+K1 = 1.2
+B = 0.75
+
+# Weight of the file's score and of keyword proximity in a line's score
+DOCUMENT_WEIGHT = 0.3
+PROXIMITY_WEIGHT = 1.0
+
+# Occurrences of a keyword in a line looked at for proximity
+MAX_OCCURRENCES = 32
+
+
+class TopK:
+    """The k items with the highest scores, earlier items win ties."""
+
+    def __init__(self, k):
+        self.k = max(1, k)
+        self.heap = []
+        self.seen = 0
+
+    def push(self, score, order, item):
+        self.seen += 1
+        entry = (score, -order, item)
+        if len(self.heap) < self.k:
+            heapq.heappush(self.heap, entry)
+        elif entry[:2] > self.heap[0][:2]:
+            heapq.heapreplace(self.heap, entry)
+
+    def entries(self):
+        """Return (score, order, item) for the kept items, best first."""
+        return [(score, -order, item) for score, order, item in sorted(self.heap, key=lambda entry: entry[:2], reverse=True)]
+
+
+class RankingStatistics:
+    """Corpus statistics for BM25, taken from the search index."""
+
+    def __init__(self, documents, average_document_length, average_line_length, document_frequencies):
+        self.documents = documents
+        self.average_document_length = average_document_length
+        self.average_line_length = average_line_length
+        self.document_frequencies = document_frequencies
+
+    @classmethod
+    def from_index(cls, index, keywords):
+        documents = len(index.documents)
+        return cls(documents, index.token_count / max(1, documents), index.token_count / max(1, index.line_count),
+                   {keyword: index.document_frequency(keyword) for keyword in keywords})
+
+
+class Ranker:
+    def __init__(self, keywords, k=30, statistics=None):
+        self.keywords = list(keywords)
+        self.k = k
+        self.statistics = statistics
+        if statistics is not None:
+            n = statistics.documents
+            self.idf = [math.log(1 + (n - df + 0.5) / (df + 0.5))
+                        for df in (statistics.document_frequencies.get(keyword, n) for keyword in self.keywords)]
+        else:
+            self.idf = [1.0] * len(self.keywords)
+
+    def top(self):
+        return TopK(self.k)
+
+    def bm25(self, frequencies, length, average_length):
+        """Return the BM25 score for the keyword frequencies in a text of length tokens."""
+        norm = 1 - B + B * length / average_length if average_length else 1.0
+        return sum(idf * tf * (K1 + 1) / (tf + K1 * norm)
+                   for idf, tf in zip(self.idf, frequencies) if tf)
+
+    def proximity(self, line):
+        """Return the length of the keywords over the shortest stretch of line containing all of them, 1.0 for a phrase."""
+        if len(self.keywords) < 2:
+            return 0.0
+        occurrences = []
+        for keyword_no, keyword in enumerate(self.keywords):
+            position = line.find(keyword)
+            count = 0
+            while position != -1 and count < MAX_OCCURRENCES:
+                occurrences.append((position, position + len(keyword), keyword_no))
+                position = line.find(keyword, position + 1)
+                count += 1
+        occurrences.sort()
+
+        # Sliding window over the occurrences in line order
+        best = None
+        ends = {}
+        for start_position, end, keyword_no in occurrences:
+            ends[keyword_no] = (start_position, end)
+            if len(ends) == len(self.keywords):
+                window = max(e for s, e in ends.values()) - min(s for s, e in ends.values())
+                best = window if best is None else min(best, window)
+        if not best:
+            return 0.0
+        return min(1.0, sum(len(keyword) for keyword in self.keywords) / best)
+
+    def rank_file(self, matches, top, order=0, document_length=None):
+        """Score the (file, location, content) matches of one file into top, in order from order on."""
+        lines = [WHITESPACE_RE.sub(' ', content.lower()) for _, _, content in matches]
+        frequencies = [[line.count(keyword) for keyword in self.keywords] for line in lines]
+
+        document_score = 0.0
+        if self.statistics is not None:
+            document_frequencies = [sum(column) for column in zip(*frequencies)]
+            document_score = self.bm25(document_frequencies, document_length or self.statistics.average_document_length,
+                                       self.statistics.average_document_length)
+        average_line_length = self.statistics.average_line_length if self.statistics is not None else None
+
+        for i, (match, line, line_frequencies) in enumerate(zip(matches, lines, frequencies)):
+            line_length = len(TOKEN_RE.findall(line)) or 1
+            score = (self.bm25(line_frequencies, line_length, average_line_length)
+                     + DOCUMENT_WEIGHT * document_score
+                     + PROXIMITY_WEIGHT * self.proximity(line))
+            top.push(score, order + i, match)
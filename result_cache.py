@@ -0,0 +1,66 @@
+# Copyright 2024 by moshix
+# In-memory cache of search results
+#
+# Entries are kept in least recently used order and the cache is bounded
+# both by number of entries and by an estimate of the memory they take.
+# Every entry is stored with the version of the data it was computed from
+# (the corpus generation for /search, the videos.txt signature for
+# /videosearch); an entry whose version no longer matches is a miss.
+
+import sys
+import threading
+from collections import OrderedDict
+
+
+def estimate_size(value):
+    """Roughly estimate the memory taken by a list of result tuples or strings, or a tuple of such lists and numbers."""
+    size = sys.getsizeof(value)
+    for item in value:
+        if isinstance(item, tuple):
+            size += sys.getsizeof(item) + sum(sys.getsizeof(field) for field in item)
+        elif isinstance(item, list):
+            size += estimate_size(item)
+        else:
+            size += sys.getsizeof(item)
+    return size
+
+
+class ResultCache:
+    def __init__(self, max_entries=1000, max_bytes=64 * 1024 * 1024):
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.entries = OrderedDict()   # key -> (version, value, size)
+        self.bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.lock = threading.Lock()
+
+    def get(self, key, version):
+        """Return the cached value for key if it was computed from version, else None."""
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is None or entry[0] != version:
+                if entry is not None:
+                    self.remove(key)
+                self.misses += 1
+                return None
+            self.entries.move_to_end(key)
+            self.hits += 1
+            return entry[1]
+
+    def put(self, key, version, value):
+        """Cache value for key, evicting least recently used entries to stay within bounds."""
+        size = estimate_size(value)
+        if self.max_entries <= 0 or size > self.max_bytes:
+            return
+        with self.lock:
+            if key in self.entries:
+                self.remove(key)
+            self.entries[key] = (version, value, size)
+            self.bytes += size
+            while len(self.entries) > self.max_entries or self.bytes > self.max_bytes:
+                self.remove(next(iter(self.entries)))
+
+    def remove(self, key):
+        version, value, size = self.entries.pop(key)
+        self.bytes -= size
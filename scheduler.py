@@ -0,0 +1,171 @@
+# Copyright 2024 by moshix
+# Admission control for searches
+#
+# A QueryScheduler lets at most max_running searches run at a time. Further
+# searches wait in a bounded queue and are turned away at once with
+# ServerBusy when max_queued of them are already waiting. The queue holds a
+# line per client and a free slot goes to the clients in turn, so a client
+# firing off many searches doesn't keep everyone else waiting. Every search
+# must be done timeout seconds after it arrived: one still waiting then gives
+# up with DeadlineExceeded, one still running has the cancel event of its
+# ticket set, which stops the file tasks it has left, and its slot is handed
+# on to the next search.
+
+import time
+import threading
+from collections import OrderedDict, deque
+from contextlib import contextmanager
+
+
+class SchedulerError(Exception):
+    """A search was turned away or stopped by the scheduler."""
+
+
+class ServerBusy(SchedulerError):
+    pass
+
+
+class DeadlineExceeded(SchedulerError):
+    pass
+
+
+class Ticket:
+    """One search admitted to or waiting for a QueryScheduler."""
+
+    def __init__(self, client, deadline):
+        self.client = client
+        self.deadline = deadline
+        self.state = 'queued'      # then 'running' and 'done' or 'expired'
+        self.cancel = threading.Event()
+
+    def remaining(self):
+        """Return the seconds left until the deadline, None if there is none."""
+        if self.deadline is None:
+            return None
+        return max(0.0, self.deadline - time.monotonic())
+
+    def check(self):
+        """Raise DeadlineExceeded once the search is past its deadline."""
+        if self.cancel.is_set() or (self.deadline is not None and time.monotonic() >= self.deadline):
+            raise DeadlineExceeded("The search took too long and was stopped.")
+
+
+class QueryScheduler:
+    def __init__(self, max_running=4, max_queued=32, timeout=30.0):
+        self.max_running = max(1, max_running)
+        self.max_queued = max(0, max_queued)
+        self.timeout = timeout
+        self.condition = threading.Condition()
+        self.running = set()
+        self.waiting = OrderedDict()   # client -> deque of its waiting tickets, in turn order
+        self.queued = 0
+        self.admitted = 0
+        self.rejected = 0
+        self.timeouts = 0
+
+    def admit(self, client=None):
+        """Return the Ticket of a new search once it may run, raising ServerBusy or DeadlineExceeded."""
+        deadline = time.monotonic() + self.timeout if self.timeout > 0 else None
+        ticket = Ticket(client, deadline)
+        with self.condition:
+            self.expire()
+            if len(self.running) < self.max_running and not self.queued:
+                self.start(ticket)
+                return ticket
+            if self.queued >= self.max_queued:
+                self.rejected += 1
+                raise ServerBusy("The server is busy, try your search again in a moment.")
+            self.waiting.setdefault(client, deque()).append(ticket)
+            self.queued += 1
+            while ticket.state == 'queued':
+                now = time.monotonic()
+                if deadline is not None and now >= deadline:
+                    self.dequeue(ticket)
+                    self.timeouts += 1
+                    raise DeadlineExceeded("The server is busy, the search waited too long to start.")
+                self.condition.wait(self.wait_seconds(now, deadline))
+                self.expire()
+            return ticket
+
+    def release(self, ticket, timed_out=False):
+        """Give back the slot of a finished search."""
+        with self.condition:
+            if ticket.state != 'running':
+                return
+            self.running.discard(ticket)
+            ticket.state = 'expired' if timed_out else 'done'
+            if timed_out:
+                self.timeouts += 1
+            self.dispatch()
+
+    @contextmanager
+    def slot(self, client=None):
+        """Run the body as an admitted search, giving its slot back afterwards."""
+        ticket = self.admit(client)
+        timed_out = False
+        try:
+            yield ticket
+        except DeadlineExceeded:
+            timed_out = True
+            raise
+        finally:
+            self.release(ticket, timed_out)
+
+    def start(self, ticket):
+        ticket.state = 'running'
+        self.running.add(ticket)
+        self.admitted += 1
+
+    def dequeue(self, ticket):
+        tickets = self.waiting[ticket.client]
+        tickets.remove(ticket)
+        if not tickets:
+            del self.waiting[ticket.client]
+        self.queued -= 1
+
+    def dispatch(self):
+        """Start waiting searches while there are free slots, taking the clients in turn."""
+        started = False
+        while self.queued and len(self.running) < self.max_running:
+            client, tickets = next(iter(self.waiting.items()))
+            ticket = tickets.popleft()
+            if tickets:
+                # The client's next search waits for its next turn
+                self.waiting.move_to_end(client)
+            else:
+                del self.waiting[client]
+            self.queued -= 1
+            self.start(ticket)
+            started = True
+        if started:
+            self.condition.notify_all()
+
+    def expire(self):
+        """Stop the running searches that are past their deadline and hand on their slots."""
+        now = time.monotonic()
+        expired = [ticket for ticket in self.running if ticket.deadline is not None and ticket.deadline <= now]
+        for ticket in expired:
+            self.running.discard(ticket)
+            ticket.state = 'expired'
+            ticket.cancel.set()
+            self.timeouts += 1
+        if expired:
+            self.dispatch()
+
+    def wait_seconds(self, now, deadline):
+        """Return how long a waiting search may sleep before its own or a running search's deadline."""
+        deadlines = [ticket.deadline for ticket in self.running if ticket.deadline is not None]
+        if deadline is not None:
+            deadlines.append(deadline)
+        if not deadlines:
+            return None
+        return max(0.0, min(deadlines) - now)
+
+    def stats(self):
+        """Return (label, value) rows describing the running and waiting searches."""
+        with self.condition:
+            return [
+                ('Searches Running / Queued', f"{len(self.running)} / {self.queued}"),
+                ('Searches Rejected (Busy)', self.rejected),
+                ('Searches Timed Out', self.timeouts),
+            ]
@@ -0,0 +1,461 @@
+# Copyright 2024 by moshix
+# File search functions run by the search worker pool
+#
+# These are plain module level functions so that they can run either on the
+# server's thread pool or, with --search_backend processes, on a pool of
+# long-lived worker processes that are not held back by the GIL. A worker
+# searches a whole partition of the file list and sends back compact
+# (file, location, line) tuples. A big PDF is split into ranges of pages
+# that are searched as partitions of their own, so several workers extract
+# its text at the same time.
+
+import os
+import re
+import time
+import codecs
+import itertools
+import locale
+from pdf_cache import PdfTextCache, read_pdf_range
+from metrics import observe
+
+# PDF text cache of a worker process, set up by init_worker
+worker_pdf_cache = None
+
+WHITESPACE_RE = re.compile(r'\s+')
+SPACE_RUN_RE = re.compile(rb' {2,}')
+
+# Encoding open() reads text files with
+TEXT_ENCODING = locale.getpreferredencoding(False)
+
+# Bytes that end a line for str.splitlines() and never occur inside a
+# multi-byte character, so chunks can be cut right after them
+LINE_BREAK_BYTES = (b'\n', b'\r', b'\x0b', b'\x0c', b'\x1c', b'\x1d', b'\x1e')
+
+# Text files are read this many bytes at a time
+DEFAULT_SCAN_CHUNK_BYTES = 1024 * 1024
+
+# One translate pass over ASCII text lowercases it, turns every line break
+# str.splitlines() knows into \n and every other whitespace character \s
+# knows into a space, without moving any byte.
+ASCII_UPPERCASE = bytes(range(ord('A'), ord('Z') + 1))
+NORMALIZE_TABLE = bytes.maketrans(ASCII_UPPERCASE + b'\r\x0b\x0c\x1c\x1d\x1e\t\x1f',
+                                  ASCII_UPPERCASE.lower() + b'\n' * 6 + b' ' * 2)
+
+
+def init_worker(pdf_cache_dir=None, pdf_cache_bytes=0):
+    """Set up a search worker process."""
+    global worker_pdf_cache
+    if pdf_cache_dir and pdf_cache_bytes > 0:
+        worker_pdf_cache = PdfTextCache(pdf_cache_dir, pdf_cache_bytes)
+
+
+def list_files(files_dir):
+    """Return the paths relative to files_dir of all files in it, in walk order."""
+    file_paths = []
+    for root, dirs, files in os.walk(files_dir):
+        for file in files:
+            file_paths.append(os.path.join(root, file).replace(files_dir, ""))
+    return file_paths
+
+
+def split_pdfs(file_paths, page_count, min_pages, max_parts):
+    """Replace the PDFs among file_paths with more than min_pages pages by (file, first page, last page) ranges.
+
+    A PDF is cut into at most max_parts ranges of at least min_pages pages,
+    page_count returns the number of pages of a PDF or None if it is not
+    known, such PDFs are left whole.
+    """
+    if min_pages <= 0 or max_parts < 2:
+        return list(file_paths)
+    items = []
+    for file_path in file_paths:
+        pages = page_count(file_path) if file_path.lower().endswith('.pdf') else None
+        if pages is None or pages <= min_pages:
+            items.append(file_path)
+            continue
+        parts = min(max_parts, pages // min_pages)
+        size, extra = divmod(pages, parts)
+        first = 0
+        for i in range(parts):
+            last = first + size + (1 if i < extra else 0)
+            items.append((file_path, first, last))
+            first = last
+    return items
+
+
+def partition(items, count):
+    """Split items into at most count contiguous, evenly sized parts."""
+    count = max(1, min(count, len(items)))
+    size, extra = divmod(len(items), count)
+    parts = []
+    start = 0
+    for i in range(count):
+        end = start + size + (1 if i < extra else 0)
+        parts.append(items[start:end])
+        start = end
+    return parts
+
+
+def partition_work(items, count):
+    """Split the files and PDF page ranges of split_pdfs into partitions, each page range in a partition of its own."""
+    parts = []
+    for part in partition(items, count):
+        run = []
+        for item in part:
+            if isinstance(item, tuple):
+                if run:
+                    parts.append(run)
+                    run = []
+                parts.append([item])
+            else:
+                run.append(item)
+        if run:
+            parts.append(run)
+    return parts
+
+
+class KeywordMatcher:
+    """The keywords of one search, prepared once for testing many lines.
+
+    Empty and duplicate keywords and keywords contained in another keyword are
+    dropped, as a line containing the others contains them too. The rest are
+    tested longest first, so a line missing one of them is usually rejected
+    by the first test. Candidate lines are found with a single pass for the
+    anchor, the longest word of all keywords, however many keywords there are.
+    """
+
+    def __init__(self, keywords):
+        self.keywords = list(keywords)
+        self.needles = []
+        for keyword in sorted(set(self.keywords), key=len, reverse=True):
+            if keyword and not any(keyword in needle for needle in self.needles):
+                self.needles.append(keyword)
+        self.anchor = max((word for needle in self.needles for word in needle.split(' ')), key=len, default='')
+
+        # Normalized ASCII text can't contain other characters or whitespace runs
+        self.ascii = all(needle.isascii() and WHITESPACE_RE.sub(' ', needle) == needle for needle in self.needles)
+        if self.ascii:
+            self.byte_needles = [needle.encode('ascii') for needle in self.needles]
+            self.byte_anchor = self.anchor.encode('ascii')
+
+    def matches(self, normalized_line):
+        """Return True if the normalized line contains all keywords."""
+        return all(needle in normalized_line for needle in self.needles)
+
+    def matches_bytes(self, normalized_line):
+        """Return True if the normalized ASCII line contains all keywords."""
+        return all(needle in normalized_line for needle in self.byte_needles)
+
+
+def keyword_matcher(keywords):
+    """Return keywords as a KeywordMatcher, building one if needed."""
+    return keywords if isinstance(keywords, KeywordMatcher) else KeywordMatcher(keywords)
+
+
+def search_text_file(files_dir, file_path, keywords, chunk_bytes=DEFAULT_SCAN_CHUNK_BYTES, stages=None):
+    """Search text files for the given keywords, reading them chunk_bytes at a time.
+
+    Every chunk is cut after its last line break and the partial line is
+    carried over to the next one, so only complete lines are scanned and the
+    line numbers simply add up. A line longer than a whole chunk is matched
+    piecewise by LongLineScanner instead of being read in one go. The time
+    spent reading and matching is added to the stages histograms if given.
+    """
+    start = time.perf_counter()
+    read_seconds = 0.0
+    matcher = keyword_matcher(keywords)
+    full_path = os.path.join(files_dir, file_path)
+    matches = []
+    line_number = 1
+    long_line = None
+    carry = b''
+    with open(full_path, 'rb') as f:
+        while True:
+            read_start = time.perf_counter()
+            block = f.read(chunk_bytes)
+            read_seconds += time.perf_counter() - read_start
+            data = carry + block if carry else block
+            carry = b''
+            if not block:
+                if long_line is not None:
+                    matches.extend(long_line.feed(data, final=True))
+                elif data:
+                    matches.extend(scan_lines(data, file_path, matcher, line_number)[0])
+                if stages is not None:
+                    observe(stages, 'text_read', read_seconds)
+                    observe(stages, 'text_match', time.perf_counter() - start - read_seconds)
+                return matches
+
+            if long_line is not None:
+                end = first_break_end(data)
+                if end == -1:
+                    matches.extend(long_line.feed(data))
+                    continue
+                matches.extend(long_line.feed(data[:end], final=True))
+                line_number = long_line.line_number
+                long_line = None
+                data = data[end:]
+
+            end = last_break_end(data)
+            if end == -1:
+                if len(data) >= chunk_bytes:
+                    long_line = LongLineScanner(file_path, matcher, line_number, chunk_bytes)
+                    matches.extend(long_line.feed(data))
+                else:
+                    carry = data
+                continue
+            found, line_count = scan_lines(data[:end], file_path, matcher, line_number)
+            matches.extend(found)
+            line_number += line_count
+            carry = data[end:]
+
+
+def carriage_return_end(data, position):
+    """Return the offset just past the line break starting with the \r at position, or -1 if data can't tell yet.
+
+    Decoding drops bytes that aren't part of a character, so a \n after such
+    bytes still makes a \r\n with the \r, just like right after it.
+    """
+    newline = data.find(b'\n', position + 1)
+    between = data[position + 1:newline if newline != -1 else len(data)]
+    if between and between.decode(TEXT_ENCODING, errors='ignore'):
+        return position + 1
+    return newline + 1 if newline != -1 else -1
+
+
+def last_break_end(data):
+    """Return the offset just past the last line break in data, or -1 if there is none."""
+    end = len(data)
+    while True:
+        position = max(data.rfind(byte, 0, end) for byte in LINE_BREAK_BYTES)
+        if position == -1:
+            return -1
+        # A \r followed by nothing that decodes may be the first half of a \r\n in the next chunk
+        if data[position] == 0x0d and carriage_return_end(data, position) == -1:
+            end = position
+            continue
+        return position + 1
+
+
+def first_break_end(data):
+    """Return the offset just past the first line break in data, or -1 if there is none yet."""
+    positions = [position for position in (data.find(byte) for byte in LINE_BREAK_BYTES) if position != -1]
+    if not positions:
+        return -1
+    position = min(positions)
+    if data[position] == 0x0d:
+        return carriage_return_end(data, position)
+    return position + 1
+
+
+def scan_lines(data, file_path, matcher, first_line=1):
+    """Search complete lines of a text file, return (matches, number of lines)."""
+    if data.isascii():
+        return scan_ascii(data, file_path, matcher, first_line)
+    return scan_text(data.decode(TEXT_ENCODING, errors='ignore'), file_path, matcher, first_line)
+
+
+def scan_ascii(data, file_path, matcher, first_line=1):
+    """Search ASCII file contents for the keywords working on bytes.
+
+    The contents are normalized in a single translate pass, candidate lines
+    are found with bytes.find for the anchor of the keywords and only those
+    lines are checked, counted and decoded.
+    """
+    if not matcher.ascii:
+        return [], count_ascii_lines(data)
+    if not matcher.needles:
+        return scan_text(data.decode('ascii'), file_path, matcher, first_line)
+
+    # open() would read \r\n as a single line break
+    if b'\r' in data:
+        data = data.replace(b'\r\n', b'\n')
+    text = data.translate(NORMALIZE_TABLE)
+    word = matcher.byte_anchor
+
+    matches = []
+    line_number = first_line
+    counted = 0
+    position = text.find(word)
+    while position != -1:
+        start = text.rfind(b'\n', 0, position) + 1
+        end = text.find(b'\n', position)
+        if end == -1:
+            end = len(text)
+        line = text[start:end]
+        if b'  ' in line:
+            line = SPACE_RUN_RE.sub(b' ', line)
+        if matcher.matches_bytes(line):
+            line_number += text.count(b'\n', counted, start)
+            counted = start
+            matches.append((file_path, f"Line {line_number}", data[start:end].decode('ascii').lower().strip()))
+        position = text.find(word, end + 1)
+    return matches, count_ascii_lines(text, normalized=True)
+
+
+def count_ascii_lines(data, normalized=False):
+    """Return the number of lines str.splitlines() would find in ASCII data."""
+    if not normalized:
+        data = data.replace(b'\r\n', b'\n').translate(NORMALIZE_TABLE)
+    line_count = data.count(b'\n')
+    if data and not data.endswith(b'\n'):
+        line_count += 1
+    return line_count
+
+
+def scan_text(content, file_path, matcher, first_line=1):
+    """Search decoded file contents for the keywords, normalizing every line once."""
+    matches = []
+    content = content.lower()
+    lines = content.splitlines()
+    normalized_content = WHITESPACE_RE.sub(' ', content)
+    if matcher.matches(normalized_content):
+        for line_number, line in enumerate(lines, first_line):
+            normalized_line = WHITESPACE_RE.sub(' ', line)
+            if matcher.matches(normalized_line):
+                matches.append((file_path, f"Line {line_number}", line.strip()))
+    return matches, len(lines)
+
+
+class LongLineScanner:
+    """Match keywords against a line too long for a single chunk, piece by piece.
+
+    Each piece is normalized together with the tail of the previous one, long
+    enough to hold all but the last character of the longest keyword, so
+    keywords spanning pieces and whitespace runs spanning pieces still match.
+    The line shown in the results is cut off after max_display characters.
+    """
+
+    def __init__(self, file_path, matcher, line_number, max_display):
+        self.file_path = file_path
+        self.needles = matcher.needles
+        self.line_number = line_number
+        self.max_display = max_display
+        self.overlap = max((len(needle) for needle in self.needles), default=1) - 1
+        self.decoder = codecs.getincrementaldecoder(TEXT_ENCODING)(errors='ignore')
+        self.pending = ''
+        self.start_line()
+
+    def start_line(self):
+        self.head = ''
+        self.tail = ''
+        self.found = [False] * len(self.needles)
+        self.open = False
+
+    def feed(self, data, final=False):
+        """Scan the next bytes of the file, return the matches of the lines they complete."""
+        text = self.pending + self.decoder.decode(data, final)
+        self.pending = ''
+        if text.endswith('\r') and not final:
+            text, self.pending = text[:-1], '\r'
+        matches = []
+        for piece in text.splitlines(keepends=True):
+            line = piece.splitlines()[0]
+            self.add(line)
+            if len(line) < len(piece):
+                self.end_line(matches)
+        if final and self.open:
+            self.end_line(matches)
+        return matches
+
+    def add(self, text):
+        text = text.lower()
+        if len(self.head) < self.max_display:
+            self.head += text[:self.max_display - len(self.head)]
+        window = WHITESPACE_RE.sub(' ', self.tail + text)
+        for i, needle in enumerate(self.needles):
+            if not self.found[i] and needle in window:
+                self.found[i] = True
+        self.tail = window[-self.overlap:] if self.overlap > 0 else ''
+        self.open = True
+
+    def end_line(self, matches):
+        if all(self.found):
+            matches.append((self.file_path, f"Line {self.line_number}", self.head.strip()))
+        self.line_number += 1
+        self.start_line()
+
+
+def search_pdf(files_dir, file_path, keywords, pdf_cache=None, stages=None, pages=None, limit=None, cancel=None):
+    """Search PDF files for the given keywords and return the results.
+
+    pages is a (first, last) range of zero-based page numbers, last
+    excluded, to search only part of the PDF. Pages are extracted one at a
+    time, so once limit matches are found or cancel is set the rest of them
+    are never read.
+    """
+    matcher = keyword_matcher(keywords)
+    matches = []
+    full_path = os.path.join(files_dir, file_path)
+    first, last = pages if pages is not None else (0, None)
+    read_seconds = 0.0
+    start = time.perf_counter()
+    page_texts = read_pdf_range(full_path, first, last, pdf_cache)
+    try:
+        for page_number in itertools.count(first + 1):
+            if cancel is not None and cancel.is_set():
+                break
+            read_start = time.perf_counter()
+            text = next(page_texts, None)
+            read_seconds += time.perf_counter() - read_start
+            if text is None:
+                break
+            if text:
+                normalized_text = WHITESPACE_RE.sub(' ', text.lower())
+                if matcher.matches(normalized_text):
+                    for line_number, line in enumerate(text.split('\n'), 1):
+                        normalized_line = WHITESPACE_RE.sub(' ', line.lower()).strip()
+                        if matcher.matches(normalized_line):
+                            cleaned_line = line.replace("/bulletmed", "").strip()
+                            matches.append((file_path, f"Page {page_number}", cleaned_line))
+            if limit is not None and len(matches) >= limit:
+                break
+    finally:
+        page_texts.close()
+    if stages is not None:
+        observe(stages, 'pdf_read', read_seconds)
+        observe(stages, 'pdf_match', time.perf_counter() - start - read_seconds)
+    return matches
+
+
+def search_partition(files_dir, file_paths, keywords, limit=None, pdf_cache=None, cancel=None,
+                     chunk_bytes=DEFAULT_SCAN_CHUNK_BYTES, ranker=None):
+    """Search a list of files, return (matches, errors, stages) and stop once limit matches are found or cancel is set.
+
+    An item of file_paths may also be a (file, first page, last page) range
+    of a PDF from split_pdfs. stages maps the name of a stage to the Histogram of its durations, one per
+    file. With a ranker every file is searched and matches is the number of
+    matching lines and the ranker's best (score, order, match) entries, order
+    counting the matches of the partition in file order.
+    """
+    if pdf_cache is None:
+        pdf_cache = worker_pdf_cache
+    matcher = keyword_matcher(keywords)
+    matches = []
+    errors = []
+    stages = {}
+    top = ranker.top() if ranker is not None else None
+    order = 0
+    for item in file_paths:
+        if cancel is not None and cancel.is_set():
+            break
+        file_path, pages = (item[0], item[1:]) if isinstance(item, tuple) else (item, None)
+        try:
+            if file_path.lower().endswith('.pdf'):
+                file_limit = limit - len(matches) if limit is not None else None
+                file_matches = search_pdf(files_dir, file_path, matcher, pdf_cache, stages, pages, file_limit, cancel)
+            else:
+                file_matches = search_text_file(files_dir, file_path, matcher, chunk_bytes, stages)
+        except Exception as e:
+            errors.append(f"{file_path}: {e}")
+            continue
+        if top is not None:
+            ranker.rank_file(file_matches, top, order)
+            order += len(file_matches)
+            continue
+        matches.extend(file_matches)
+        if limit is not None and len(matches) >= limit:
+            break
+    if top is not None:
+        matches = (top.seen, top.entries())
+    return matches, errors, stages
@@ -0,0 +1,513 @@
+# Copyright 2024 by moshix
+# Inverted index over the FILES/ directory for the search servers
+#
+# Every text file line and every PDF page line is tokenized once into
+# positional postings (line, token position). A /search keyword is turned
+# into a set of candidate lines from the postings and only those lines are
+# checked with the same whitespace-insensitive substring test the scanning
+# search uses, so the results are identical without rereading any file.
+#
+# The index is kept per file so that a new generation can be built from the
+# previous one by reindexing only the files whose stat signature changed.
+# A file is kept as its lines, as read; where each line is and how it is
+# matched is worked out from them when a search needs it. Text files bigger
+# than max_index_bytes are not kept at all, searches scan them in chunks.
+
+import os
+import re
+import time
+import bisect
+import select
+import ctypes
+import ctypes.util
+import threading
+from array import array
+from pdf_cache import read_pdf_pages
+from search_engine import keyword_matcher, search_text_file, DEFAULT_SCAN_CHUNK_BYTES
+from trigram import word_trigrams, query_predicate, query_documents
+
+TOKEN_RE = re.compile(r'\w+')
+WHITESPACE_RE = re.compile(r'\s+')
+
+# Text files bigger than this are scanned by searches instead of indexed
+DEFAULT_MAX_INDEX_BYTES = 64 * 1024 * 1024
+
+# Characters str.splitlines() splits at, after universal newlines turned \r into \n
+LINE_BREAKS = frozenset('\n\x0b\x0c\x1c\x1d\x1e\x85\u2028\u2029')
+
+
+def snapshot(files_dir):
+    """Return ({file_path: (mtime_ns, size, inode)}, [directories]) for files_dir in walk order."""
+    signatures = {}
+    directories = []
+    for root, dirs, files in os.walk(files_dir):
+        directories.append(root)
+        for file in files:
+            full_path = os.path.join(root, file)
+            try:
+                st = os.stat(full_path)
+            except OSError:
+                continue
+            signatures[full_path.replace(files_dir, "")] = (st.st_mtime_ns, st.st_size, st.st_ino)
+    return signatures, directories
+
+
+def text_lines(f, chunk_chars=DEFAULT_SCAN_CHUNK_BYTES):
+    """Yield the lines of a text file object as str.splitlines() splits its content, reading chunk_chars at a time."""
+    carry = ''
+    while True:
+        chunk = f.read(chunk_chars)
+        if not chunk:
+            if carry:
+                yield carry
+            return
+        text = carry + chunk
+        lines = text.splitlines()
+        # The last line goes on in the next chunk unless a line break ends the text
+        carry = '' if text[-1] in LINE_BREAKS else lines.pop()
+        yield from lines
+
+
+def index_file(files_dir, file_path, signature, pdf_cache=None, scanned=False):
+    """Read and tokenize a single text file or PDF.
+
+    With scanned the lines of a text file are only counted, searches scan
+    the file instead.
+    """
+    document = DocumentIndex(file_path, signature)
+    full_path = os.path.join(files_dir, file_path)
+    if document.pages is not None:
+        # Index the lines of every PDF page the way search_pdf reads them
+        for page_number, text in enumerate(read_pdf_pages(full_path, pdf_cache), 1):
+            if not text:
+                continue
+            for line in text.split('\n'):
+                document.add_line(line, page_number)
+    else:
+        # Index the lines of a text file the way search_text_file reads them
+        document.scanned = scanned
+        with open(full_path, 'r', errors='ignore') as f:
+            for line in text_lines(f):
+                if scanned:
+                    document.line_count += 1
+                    document.token_count += len(TOKEN_RE.findall(line.lower()))
+                else:
+                    document.add_line(line.lower())
+    return document
+
+
+class DocumentIndex:
+    def __init__(self, file_path, signature):
+        self.file_path = file_path
+        self.signature = signature
+        self.lines = []       # line_no -> line, lowercased in a text file
+        self.pages = array('I') if file_path.lower().endswith('.pdf') else None  # line_no -> page number in a PDF
+        self.scanned = False  # too big to index, the file is scanned instead
+        self.postings = {}    # token -> array of (line_no, position) pairs
+        self.line_count = 0
+        self.token_count = 0
+        self.trigrams = None  # trigrams of the tokens, computed on the first /regex
+
+    def __getstate__(self):
+        # Snapshots leave out the trigrams, they are quickly computed again
+        state = self.__dict__.copy()
+        state['trigrams'] = None
+        return state
+
+    def add_line(self, line, page_number=None):
+        line_no = len(self.lines)
+        self.lines.append(line)
+        if self.pages is not None:
+            self.pages.append(page_number)
+        self.line_count += 1
+        tokens = TOKEN_RE.findall(self.normalized(line))
+        self.token_count += len(tokens)
+        for position, token in enumerate(tokens):
+            postings = self.postings.get(token)
+            if postings is None:
+                postings = self.postings[token] = array('I')
+            postings.append(line_no)
+            postings.append(position)
+
+    def normalized(self, line):
+        """Return a line the way searches test it, lowercased with every run of whitespace as one space."""
+        if self.pages is None:
+            return WHITESPACE_RE.sub(' ', line)
+        return WHITESPACE_RE.sub(' ', line.lower()).strip()
+
+    def match(self, line_no, line):
+        """Return the (file, location, content) match of a line."""
+        if self.pages is None:
+            return (self.file_path, f"Line {line_no + 1}", line.strip())
+        return (self.file_path, f"Page {self.pages[line_no]}", line.replace("/bulletmed", "").strip())
+
+    def read_lines(self, files_dir):
+        """Return the lines of the document, read from the file again if it is scanned."""
+        if not self.scanned:
+            return self.lines
+        return self.scan_lines(files_dir)
+
+    def scan_lines(self, files_dir):
+        with open(os.path.join(files_dir, self.file_path), 'r', errors='ignore') as f:
+            for line in text_lines(f):
+                yield line.lower()
+
+    def token_trigrams(self):
+        """Return the set of trigrams inside the tokens of the document."""
+        if self.trigrams is None:
+            trigrams = set()
+            for token in self.postings:
+                if len(token) >= 3:
+                    trigrams.update(word_trigrams(token))
+            self.trigrams = trigrams
+        return self.trigrams
+
+    def candidate_lines(self, keyword_tokens):
+        """Return the line numbers where the keyword tokens occur at consecutive positions."""
+        candidates = None
+        for offset, tokens in enumerate(keyword_tokens):
+            positions = set()
+            for token in tokens:
+                postings = self.postings.get(token)
+                if postings is None:
+                    continue
+                for i in range(0, len(postings), 2):
+                    positions.add((postings[i], postings[i + 1] - offset))
+            candidates = positions if candidates is None else candidates & positions
+            if not candidates:
+                return set()
+        return {line_no for line_no, position in candidates}
+
+
+class Vocabulary:
+    """Sorted tokens of an index, searched with str.find for partial tokens."""
+
+    def __init__(self, tokens):
+        self.tokens = sorted(tokens)
+        self.token_set = set(self.tokens)
+        self.offsets = []
+        offset = 1
+        for token in self.tokens:
+            self.offsets.append(offset)
+            offset += len(token) + 1
+        self.text = "\n" + "\n".join(self.tokens) + "\n"
+
+    def matching_tokens(self, fragment, prefix, suffix):
+        """Return vocabulary tokens that start with, end with or contain fragment."""
+        if prefix and suffix:
+            return [fragment] if fragment in self.token_set else []
+        if prefix:
+            # Tokens starting with fragment are next to each other in sorted order
+            tokens = []
+            for token_index in range(bisect.bisect_left(self.tokens, fragment), len(self.tokens)):
+                token = self.tokens[token_index]
+                if not token.startswith(fragment):
+                    break
+                tokens.append(token)
+            return tokens
+        needle = ("\n" if prefix else "") + fragment + ("\n" if suffix else "")
+        tokens = []
+        last = None
+        position = self.text.find(needle)
+        while position != -1:
+            token_index = bisect.bisect_right(self.offsets, position + (1 if prefix else 0)) - 1
+            if token_index != last:
+                tokens.append(self.tokens[token_index])
+                last = token_index
+            position = self.text.find(needle, position + 1)
+        return tokens
+
+    def keyword_tokens(self, keyword):
+        """Return the vocabulary tokens each token of keyword can match, or None if it has no tokens."""
+        matches = list(TOKEN_RE.finditer(keyword))
+        if not matches:
+            return None
+        # Tokens inside the keyword must match whole tokens of the line,
+        # the ones touching the keyword ends may be cut off in the line.
+        return [
+            self.matching_tokens(match.group(), match.start() > 0, match.end() < len(keyword))
+            for match in matches
+        ]
+
+
+class SearchIndex:
+    def __init__(self, files_dir, documents=(), generation=0, max_index_bytes=DEFAULT_MAX_INDEX_BYTES):
+        self.files_dir = files_dir
+        self.generation = generation
+        self.max_index_bytes = max_index_bytes
+        self.documents = list(documents)
+        self.line_count = sum(document.line_count for document in self.documents)
+        self.token_count = sum(document.token_count for document in self.documents)
+
+        # Ids of the documents searches scan, they have no postings
+        self.scanned_documents = {doc_id for doc_id, document in enumerate(self.documents) if document.scanned}
+
+        # token -> ids of the documents containing it
+        self.token_documents = {}
+        for doc_id, document in enumerate(self.documents):
+            for token in document.postings:
+                doc_ids = self.token_documents.get(token)
+                if doc_ids is None:
+                    self.token_documents[token] = [doc_id]
+                else:
+                    doc_ids.append(doc_id)
+
+        self.vocabulary = Vocabulary(self.token_documents)
+
+        # trigram -> ids of the documents containing it, built for the first /regex
+        self.trigram_documents = None
+        self.trigram_lock = threading.Lock()
+
+    def update(self, signatures, log=None, pdf_cache=None):
+        """Return the next generation with added and modified files reindexed, or self if nothing changed."""
+        current = {document.file_path: document for document in self.documents}
+        documents = []
+        added = modified = 0
+        for file_path, signature in signatures.items():
+            document = current.get(file_path)
+            # A text file is reindexed when it got bigger or smaller than max_index_bytes, signature[1] is its size
+            scanned = (self.max_index_bytes > 0 and signature[1] > self.max_index_bytes and
+                       not file_path.lower().endswith('.pdf'))
+            if document is not None and document.signature == signature and document.scanned == scanned:
+                documents.append(document)
+                continue
+            if document is None:
+                added += 1
+            else:
+                modified += 1
+            try:
+                document = index_file(self.files_dir, file_path, signature, pdf_cache, scanned)
+            except Exception as e:
+                # Keep an empty entry so the file is only retried once it changes again
+                if log:
+                    log(f"Error indexing {file_path}: {e}")
+                document = DocumentIndex(file_path, signature)
+            documents.append(document)
+
+        deleted = len(current) - (len(documents) - added)
+        if not (added or modified or deleted):
+            return self
+        if log:
+            log(f"Reindexed {added} added, {modified} modified, {deleted} deleted files")
+        return SearchIndex(self.files_dir, documents, self.generation + 1, self.max_index_bytes)
+
+    def keyword_tokens(self, keyword):
+        """Return the vocabulary tokens each token of keyword can match, or None if it has no tokens."""
+        return self.vocabulary.keyword_tokens(keyword)
+
+    def document_frequency(self, keyword):
+        """Return about how many documents contain keyword, the number of documents with its rarest token."""
+        tokens = self.keyword_tokens(keyword)
+        if tokens is None:
+            return len(self.documents)
+        doc_ids = set()
+        for token in min(tokens, key=lambda tokens: sum(len(self.token_documents[token]) for token in tokens)):
+            doc_ids.update(self.token_documents[token])
+        return len(doc_ids)
+
+    def iter_search(self, keywords, with_documents=False):
+        """Yield the (file, location, content) matches of each document containing all keywords.
+
+        With with_documents (DocumentIndex, matches) pairs are yielded instead.
+        """
+        matcher = keyword_matcher(keywords)
+        keyword_tokens = []
+        candidate_docs = None
+        for keyword in matcher.needles:
+            tokens = self.keyword_tokens(keyword)
+            if tokens is None:
+                continue
+            if not all(tokens):
+                # No indexed document has the keyword, only scanned ones can
+                candidate_docs = set()
+                break
+            doc_ids = set()
+            for token in min(tokens, key=len):
+                doc_ids.update(self.token_documents[token])
+            keyword_tokens.append(tokens)
+            candidate_docs = doc_ids if candidate_docs is None else candidate_docs & doc_ids
+            if not candidate_docs:
+                break
+
+        doc_ids = range(len(self.documents)) if candidate_docs is None else sorted(candidate_docs | self.scanned_documents)
+        for doc_id in doc_ids:
+            document = self.documents[doc_id]
+            if document.scanned:
+                matches = search_text_file(self.files_dir, document.file_path, matcher)
+                if matches:
+                    yield (document, matches) if with_documents else matches
+                continue
+
+            candidates = None
+            for tokens in keyword_tokens:
+                lines = document.candidate_lines(tokens)
+                candidates = lines if candidates is None else candidates & lines
+                if not candidates:
+                    break
+            if candidates is not None and not candidates:
+                continue
+
+            matches = []
+            line_numbers = range(len(document.lines)) if candidates is None else sorted(candidates)
+            for line_no in line_numbers:
+                line = document.lines[line_no]
+                if matcher.matches(document.normalized(line)):
+                    matches.append(document.match(line_no, line))
+            if matches:
+                yield (document, matches) if with_documents else matches
+
+
+    def trigram_index(self):
+        """Return the trigram -> document ids index, building it on first use."""
+        with self.trigram_lock:
+            if self.trigram_documents is None:
+                trigram_documents = {}
+                for doc_id, document in enumerate(self.documents):
+                    for trigram in document.token_trigrams():
+                        doc_ids = trigram_documents.get(trigram)
+                        if doc_ids is None:
+                            trigram_documents[trigram] = [doc_id]
+                        else:
+                            doc_ids.append(doc_id)
+                self.trigram_documents = trigram_documents
+            return self.trigram_documents
+
+    def iter_regex(self, regex, query):
+        """Yield the (file, location, content) matches of each document with lines matching regex.
+
+        query is the trigram query of the regex, it selects the candidate
+        documents and lines the regex is tried on.
+        """
+        doc_ids = query_documents(query, self.trigram_index())
+        doc_ids = range(len(self.documents)) if doc_ids is None else sorted(doc_ids | self.scanned_documents)
+        candidate = query_predicate(query)
+        for doc_id in doc_ids:
+            document = self.documents[doc_id]
+            matches = []
+            for line_no, line in enumerate(document.read_lines(self.files_dir)):
+                normalized = document.normalized(line)
+                # Without a query every line is a candidate, an empty one too
+                if (candidate is None or candidate(normalized)) and regex.search(normalized):
+                    matches.append(document.match(line_no, line))
+            if matches:
+                yield matches
+
+
+class InotifyWatcher:
+    """Wake up the index maintainer on changes in files_dir, using Linux inotify through ctypes."""
+
+    # IN_MODIFY | IN_ATTRIB | IN_CLOSE_WRITE | IN_MOVED_FROM | IN_MOVED_TO | IN_CREATE | IN_DELETE
+    MASK = 0x002 | 0x004 | 0x008 | 0x040 | 0x080 | 0x100 | 0x200
+
+    def __init__(self, libc, fd):
+        self.libc = libc
+        self.fd = fd
+
+    @classmethod
+    def create(cls):
+        """Return a watcher, or None where inotify is not available."""
+        try:
+            libc = ctypes.CDLL(ctypes.util.find_library('c') or 'libc.so.6', use_errno=True)
+            fd = libc.inotify_init1(os.O_NONBLOCK | os.O_CLOEXEC)
+        except (OSError, AttributeError):
+            return None
+        return cls(libc, fd) if fd >= 0 else None
+
+    def watch(self, directories):
+        # Adding a watch for an already watched directory is a no-op
+        for directory in directories:
+            self.libc.inotify_add_watch(self.fd, os.fsencode(directory), self.MASK)
+
+    def wait(self, timeout, settle=0.2):
+        """Block until something changed or timeout passed, return True on change."""
+        readable, _, _ = select.select([self.fd], [], [], timeout)
+        if not readable:
+            return False
+        # Let a burst of writes settle, then drain the queued events
+        time.sleep(settle)
+        try:
+            while os.read(self.fd, 65536):
+                pass
+        except BlockingIOError:
+            pass
+        return True
+
+    def close(self):
+        os.close(self.fd)
+
+
+class IndexMaintainer:
+    """Keep a SearchIndex of files_dir current from a background thread.
+
+    With build_index=False only the changes are tracked: corpus_generation
+    goes up whenever a file in files_dir is added, modified or deleted. A
+    warm_index loaded from a snapshot is brought up to date by the first
+    refresh, which only reindexes the files that changed since.
+    """
+
+    def __init__(self, files_dir, interval=5.0, log=None, pdf_cache=None, build_index=True, warm_index=None,
+                 max_index_bytes=DEFAULT_MAX_INDEX_BYTES):
+        self.files_dir = files_dir
+        self.interval = interval
+        self.max_index_bytes = max_index_bytes
+        self.log = log
+        self.pdf_cache = pdf_cache
+        self.build_index = build_index
+        self.index = None
+        self.warm_index = warm_index
+        self.signatures = None
+        self.corpus_generation = 0
+        self.last_reindex_duration = 0.0
+        self.running = False
+        self.watcher = InotifyWatcher.create()
+        self.thread = threading.Thread(target=self.run, daemon=True)
+
+    @property
+    def generation(self):
+        index = self.index
+        return index.generation if index is not None else 0
+
+    def start(self):
+        self.running = True
+        self.thread.start()
+
+    def stop(self):
+        self.running = False
+
+    def run(self):
+        while self.running:
+            try:
+                self.refresh()
+            except Exception as e:
+                if self.log:
+                    self.log(f"Error maintaining search index: {e}")
+            if self.watcher is not None:
+                self.watcher.wait(self.interval)
+            else:
+                time.sleep(self.interval)
+
+    def refresh(self):
+        """Reindex changed files and swap in the new generation."""
+        start_time = time.time()
+        signatures, directories = snapshot(self.files_dir)
+        if self.watcher is not None:
+            self.watcher.watch(directories)
+        if signatures == self.signatures:
+            return
+        self.signatures = signatures
+
+        if self.build_index:
+            current = self.index or self.warm_index or SearchIndex(self.files_dir, max_index_bytes=self.max_index_bytes)
+            index = current.update(signatures, log=self.log, pdf_cache=self.pdf_cache)
+            self.warm_index = None
+
+            # Searches hold a reference to the generation they started with,
+            # so replacing the reference is all it takes to switch over.
+            self.index = index
+            self.last_reindex_duration = time.time() - start_time
+            if self.log:
+                self.log(f"Search index generation {index.generation}: {len(index.documents)} files, "
+                         f"{index.line_count} lines in {self.last_reindex_duration:.2f} seconds")
+
+        # Only bump after the swap so nothing cached from the old index survives
+        self.corpus_generation += 1
@@ -0,0 +1,466 @@
+# Copyright 2024 by moshix
+# Search engine shared by the telnet and SSH servers
+#
+# SearchService owns everything a /search or /videosearch needs: the pool of
+# search workers, the PDF text cache, the background index maintainer, the
+# result cache and the videos catalog. The servers only parse commands and
+# format the matches it hands back, so both front ends get the same
+# parallel, bounded and cached searches. The time spent in each stage of a
+# search is recorded in its Metrics. Searches that do real work go through a
+# QueryScheduler, which caps how many run at once and stops them at their
+# deadline. The index and the videos catalog index are saved to a snapshot
+# on shutdown and now and then, so a restart only reindexes what changed.
+
+import os
+import time
+import threading
+import multiprocessing
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor, TimeoutError
+from concurrent.futures.process import BrokenProcessPool
+from search_index import IndexMaintainer, SearchIndex
+from pdf_cache import PdfTextCache, pdf_page_count
+from result_cache import ResultCache
+from video_index import VideoCatalog
+from metrics import Metrics
+from scheduler import QueryScheduler, DeadlineExceeded
+from snapshot import Snapshot, save_snapshot, load_snapshot
+from ranking import Ranker, RankingStatistics
+import trigram
+import search_engine
+
+
+def add_search_arguments(parser, snapshot_file='.search_snapshot'):
+    """Add the options of the search service to an argparse parser, read back by SearchService.from_args."""
+    parser.add_argument('--files_dir', type=str, default='FILES/', help='Directory to search files in')
+    parser.add_argument('--max_results', type=int, default=30, help='Maximum number of search results before stopping the search')
+    parser.add_argument('--no_index', action='store_true', help='Scan FILES/ on every search instead of building a search index')
+    parser.add_argument('--index_interval', type=float, default=5.0, help='Seconds between checks of FILES/ for changed files to reindex')
+    parser.add_argument('--max_index_mb', type=float, default=64, help='Scan text files bigger than this many MB instead of indexing them, 0 to index every file')
+    parser.add_argument('--pdf_cache_dir', type=str, default='.pdf_cache', help='Directory to cache extracted PDF text in')
+    parser.add_argument('--pdf_cache_mb', type=int, default=256, help='Size limit of the PDF text cache in MB, 0 to disable it')
+    parser.add_argument('--search_backend', choices=['threads', 'processes'], default='threads', help='Scan files with a thread pool or a pool of worker processes')
+    parser.add_argument('--search_workers', type=int, default=8, help='Number of search worker threads or processes')
+    parser.add_argument('--cache_entries', type=int, default=1000, help='Maximum number of cached search results, 0 to disable the cache')
+    parser.add_argument('--cache_mb', type=int, default=64, help='Maximum memory in MB used by cached search results')
+    parser.add_argument('--scan_chunk_bytes', type=int, default=search_engine.DEFAULT_SCAN_CHUNK_BYTES, help='Bytes of a text file read at a time when scanning FILES/')
+    parser.add_argument('--pdf_range_pages', type=int, default=64, help='Search PDFs with more pages than this in ranges of pages on several workers, 0 to search every PDF whole')
+    parser.add_argument('--videos_file', type=str, default='videos.txt', help='Catalog of videos searched by /videosearch')
+    parser.add_argument('--max_searches', type=int, default=4, help='Searches that may run at the same time, the others wait their turn')
+    parser.add_argument('--search_queue', type=int, default=32, help='Searches that may wait for a turn before new ones are turned away as busy')
+    parser.add_argument('--search_timeout', type=float, default=30.0, help='Seconds a search may wait and run before it is stopped, 0 for no limit')
+    parser.add_argument('--snapshot_file', type=str, default=snapshot_file, help='File the search state is saved to and warm started from, empty to disable snapshots')
+    parser.add_argument('--snapshot_interval', type=float, default=300.0, help='Seconds between snapshots of the search state, 0 to only save one on shutdown')
+    return parser
+
+
+class SearchService:
+    def __init__(self, files_dir='FILES/', max_results=30, use_index=True, index_interval=5.0,
+                 pdf_cache_dir='.pdf_cache', pdf_cache_mb=256, search_backend='threads', search_workers=8,
+                 cache_entries=1000, cache_mb=64, scan_chunk_bytes=search_engine.DEFAULT_SCAN_CHUNK_BYTES,
+                 videos_file='videos.txt', pdf_range_pages=64, max_searches=4, search_queue=32,
+                 search_timeout=30.0, snapshot_file='.search_snapshot', snapshot_interval=300.0, max_index_mb=64, log=None):
+        self.files_dir = files_dir
+        self.max_results = max_results
+        self.use_index = use_index
+        self.index_interval = index_interval
+        self.max_index_bytes = int(max_index_mb * 1024 * 1024)
+        self.pdf_cache_dir = pdf_cache_dir
+        self.pdf_cache_bytes = pdf_cache_mb * 1024 * 1024
+        self.pdf_cache = PdfTextCache(pdf_cache_dir, self.pdf_cache_bytes) if pdf_cache_mb > 0 else None
+        self.search_backend = search_backend
+        self.search_workers = search_workers
+        self.result_cache = ResultCache(cache_entries, cache_mb * 1024 * 1024)
+        self.scan_chunk_bytes = max(1, scan_chunk_bytes)
+        self.pdf_range_pages = pdf_range_pages
+        self.pdf_page_counts = {}
+        self.videos_file = videos_file
+        self.log = log or (lambda message: None)
+        self.metrics = Metrics()
+        self.scheduler = QueryScheduler(max_searches, search_queue, search_timeout)
+
+        # Start from the last snapshot, if there is a usable one
+        self.snapshot_file = snapshot_file
+        self.snapshot_interval = snapshot_interval
+        self.snapshot_lock = threading.Lock()
+        self.snapshot_stop = threading.Event()
+        self.snapshot_thread = None
+        self.snapshot_loaded = "none"
+        self.snapshot_saved = "never"
+        self.saved_state = None
+        snapshot = self.load_snapshot()
+        warm_index = None
+        if snapshot is not None and snapshot.documents is not None and self.use_index:
+            warm_index = SearchIndex(self.files_dir, snapshot.documents, snapshot.generation, self.max_index_bytes)
+        self.video_catalog = VideoCatalog(videos_file, snapshot.video_index if snapshot is not None else None)
+
+        # Worker pool for concurrent file searches
+        self.executor = self.create_executor()
+
+        # Maintain the search index in the background, /search scans files_dir until it is ready.
+        # Without an index the maintainer still tracks changes to invalidate cached results.
+        self.index_maintainer = IndexMaintainer(self.files_dir, interval=self.index_interval, log=self.log,
+                                               pdf_cache=self.pdf_cache, build_index=self.use_index,
+                                               warm_index=warm_index, max_index_bytes=self.max_index_bytes)
+
+    @classmethod
+    def from_args(cls, args, log=None):
+        """Return a SearchService set up from the options added by add_search_arguments."""
+        return cls(files_dir=args.files_dir, max_results=args.max_results, use_index=not args.no_index,
+                   index_interval=args.index_interval, pdf_cache_dir=args.pdf_cache_dir, pdf_cache_mb=args.pdf_cache_mb,
+                   search_backend=args.search_backend, search_workers=args.search_workers,
+                   cache_entries=args.cache_entries, cache_mb=args.cache_mb, scan_chunk_bytes=args.scan_chunk_bytes,
+                   videos_file=args.videos_file, pdf_range_pages=args.pdf_range_pages, max_searches=args.max_searches,
+                   search_queue=args.search_queue, search_timeout=args.search_timeout,
+                   snapshot_file=args.snapshot_file, snapshot_interval=args.snapshot_interval,
+                   max_index_mb=args.max_index_mb, log=log)
+
+    def create_executor(self):
+        """Create the search worker pool, worker processes are started once and reused."""
+        if self.search_backend == 'processes':
+            return ProcessPoolExecutor(max_workers=self.search_workers, mp_context=multiprocessing.get_context('spawn'),
+                                       initializer=search_engine.init_worker, initargs=(self.pdf_cache_dir, self.pdf_cache_bytes))
+        return ThreadPoolExecutor(max_workers=self.search_workers)
+
+    def start(self):
+        self.index_maintainer.start()
+        if self.snapshot_file and self.snapshot_interval > 0:
+            self.snapshot_thread = threading.Thread(target=self.run_snapshots, daemon=True)
+            self.snapshot_thread.start()
+
+    def stop(self):
+        """Stop reindexing, wait for running searches to finish and save a last snapshot."""
+        self.index_maintainer.stop()
+        self.snapshot_stop.set()
+        if self.snapshot_thread is not None:
+            self.snapshot_thread.join()
+        self.executor.shutdown(wait=True)
+        self.save_snapshot()
+
+    def load_snapshot(self):
+        """Return the snapshot saved by an earlier run, None if there is no usable one."""
+        if not self.snapshot_file:
+            return None
+        start = time.perf_counter()
+        try:
+            snapshot = load_snapshot(self.snapshot_file, self.files_dir, self.videos_file)
+        except Exception as e:
+            self.log(f"Error loading snapshot {self.snapshot_file}, starting from scratch: {e}")
+            return None
+        if snapshot is None:
+            return None
+        files = len(snapshot.documents) if snapshot.documents is not None else 0
+        video_signature = snapshot.video_index.signature if snapshot.video_index is not None else None
+        self.saved_state = (snapshot.generation if snapshot.documents is not None else None, video_signature)
+        self.snapshot_loaded = f"{files} files in {time.perf_counter() - start:.2f}s"
+        self.log(f"Loaded snapshot {self.snapshot_file}: {self.snapshot_loaded}")
+        return snapshot
+
+    def save_snapshot(self):
+        """Save the search index and the videos catalog index, unless nothing changed since the last save."""
+        if not self.snapshot_file:
+            return
+        with self.snapshot_lock:
+            index = self.index_maintainer.index
+            if index is None and self.use_index:
+                # Not built yet, keep the snapshot we have
+                return
+            video_index = self.video_catalog.index
+            state = (index.generation if index is not None else None, video_index.signature)
+            if state == self.saved_state:
+                return
+            start = time.perf_counter()
+            snapshot = Snapshot(self.files_dir, self.videos_file, index.documents if index is not None else None,
+                                index.generation if index is not None else 0, video_index)
+            try:
+                save_snapshot(self.snapshot_file, snapshot)
+            except Exception as e:
+                self.log(f"Error saving snapshot {self.snapshot_file}: {e}")
+                return
+            self.saved_state = state
+            self.snapshot_saved = f"{time.strftime('%H:%M:%S')} in {time.perf_counter() - start:.2f}s"
+            self.log(f"Saved snapshot {self.snapshot_file} in {time.perf_counter() - start:.2f} seconds")
+
+    def run_snapshots(self):
+        while not self.snapshot_stop.wait(self.snapshot_interval):
+            self.save_snapshot()
+
+    def search(self, keywords, client=None):
+        """Yield lists of (file, location, line) matches for the keywords.
+
+        At most max_results + 1 matches are yielded in all, so the caller can
+        tell there were too many. Results stay cached until the index
+        maintainer notices a change in files_dir. A search that isn't cached
+        waits for its turn with the scheduler as client and raises
+        ServerBusy or DeadlineExceeded if it can't run or finish in time.
+        """
+        return self.limited_search(('search',) + tuple(keywords), lambda ticket: self.iter_matches(keywords, ticket), client)
+
+    def regex_search(self, regex, client=None):
+        """Yield lists of (file, location, line) matches for lines matching the compiled regex, like search.
+
+        Only the search index can answer it, with the trigram query of the
+        regex picking the documents and lines the regex is tried on.
+        """
+        return self.limited_search(('regex', regex.pattern), lambda ticket: self.iter_regex_matches(regex, ticket), client)
+
+    def regex_ready(self):
+        """Return True if the search index /regex needs is there."""
+        return self.index_maintainer.index is not None
+
+    def limited_search(self, key, iter_matches, client=None):
+        """Yield the batches of iter_matches(ticket) up to max_results + 1 matches, cached under key."""
+        generation = self.index_maintainer.corpus_generation
+        cached = self.result_cache.get(key, generation)
+        if cached is not None:
+            if cached:
+                yield cached
+            return
+
+        # Cached before the last batch is handed on, the caller may stop reading after it
+        yield from self.scheduled_search(iter_matches, client,
+                                         lambda found: self.result_cache.put(key, generation, found))
+
+    def scheduled_search(self, iter_matches, client=None, finished=None):
+        """Yield the batches of iter_matches(ticket), run as a search of client, up to max_results + 1 matches.
+
+        The batches are handed on as they are found. The slot of the search
+        is given back as soon as the matches run out or reach the limit, not
+        when the caller has read them all, and finished is then called with
+        all the matches. A search stopped at its deadline raises
+        DeadlineExceeded after the batches found until then.
+        """
+        limit = self.max_results + 1
+        found = []
+        last = None
+        ticket = self.scheduler.admit(client)
+        timed_out = False
+        matches = iter_matches(ticket)
+        try:
+            for batch in matches:
+                batch = batch[:limit - len(found)]
+                found.extend(batch)
+                if len(found) >= limit:
+                    # Closing the match iterator cancels the rest of the search
+                    last = batch
+                    break
+                if batch:
+                    yield batch
+        except DeadlineExceeded:
+            timed_out = True
+            raise
+        finally:
+            matches.close()
+            self.scheduler.release(ticket, timed_out)
+
+        if finished is not None:
+            finished(found)
+        if last:
+            yield last
+
+    def iter_matches(self, keywords, ticket=None):
+        """Yield lists of (file, location, line) matches in file order, from the index or by scanning files_dir.
+
+        The search stops with DeadlineExceeded once the ticket is past its deadline.
+        """
+        matcher = search_engine.KeywordMatcher(keywords)
+        index = self.index_maintainer.index
+        if index is not None:
+            # Only the time spent inside the index counts, not the time the caller holds on to a batch
+            lookup_seconds = 0.0
+            document_matches = index.iter_search(matcher)
+            try:
+                while True:
+                    start = time.perf_counter()
+                    batch = next(document_matches, None)
+                    lookup_seconds += time.perf_counter() - start
+                    if batch is None:
+                        break
+                    yield batch
+                    if ticket is not None:
+                        ticket.check()
+            finally:
+                document_matches.close()
+                self.metrics.observe_stage('index_lookup', lookup_seconds)
+        else:
+            yield from self.scan_files(matcher, ticket=ticket)
+
+    def iter_regex_matches(self, regex, ticket=None):
+        """Yield lists of (file, location, line) matches of the regex in file order from the index."""
+        index = self.index_maintainer.index
+        if index is None:
+            return
+        query = trigram.regex_query(regex.pattern)
+        regex_seconds = 0.0
+        document_matches = index.iter_regex(regex, query)
+        try:
+            while True:
+                start = time.perf_counter()
+                batch = next(document_matches, None)
+                regex_seconds += time.perf_counter() - start
+                if batch is None:
+                    break
+                yield batch
+                if ticket is not None:
+                    ticket.check()
+        finally:
+            document_matches.close()
+            self.metrics.observe_stage('regex', regex_seconds)
+
+    def scan_files(self, keywords, ranker=None, ticket=None):
+        """Scan every file in files_dir for the keywords, yielding the matches of each partition of files.
+
+        With a ranker every match is scored and each partition yields the
+        number of its matches and its best entries, see search_partition.
+        With a ticket the partitions not done by its deadline are dropped
+        and DeadlineExceeded is raised.
+        """
+        limit = self.max_results + 1 if ranker is None else None
+
+        # Small partitions let the first results through early and keep the
+        # workers busy when some files take longer than others.
+        with self.metrics.timer('walk'):
+            file_paths = search_engine.list_files(self.files_dir)
+        items = search_engine.split_pdfs(file_paths, self.pdf_page_count, self.pdf_range_pages, self.search_workers)
+        parts = search_engine.partition_work(items, max(self.search_workers * 4, len(file_paths) // 32))
+        if self.search_backend == 'threads':
+            # The scheduler sets the ticket's cancel event when the search runs past its deadline
+            pdf_cache, cancel = self.pdf_cache, ticket.cancel if ticket is not None else threading.Event()
+        else:
+            pdf_cache, cancel = None, None
+        tasks = [
+            self.executor.submit(search_engine.search_partition, self.files_dir, part, keywords, limit, pdf_cache, cancel,
+                                 self.scan_chunk_bytes, ranker)
+            for part in parts
+        ]
+
+        try:
+            for future in tasks:
+                try:
+                    matches, errors, stages = future.result(timeout=ticket.remaining() if ticket is not None else None)
+                    self.metrics.merge_stages(stages)
+                    for error in errors:
+                        self.log(f"Error during search: {error}")
+                except TimeoutError:
+                    raise DeadlineExceeded("The search took too long and was stopped.")
+                except BrokenProcessPool as e:
+                    # A worker process died, start a fresh pool for the next searches
+                    self.log(f"Error during search: {e}")
+                    self.executor = self.create_executor()
+                    break
+                except Exception as e:
+                    self.log(f"Error during search: {e}")
+                    continue
+                if ticket is not None:
+                    # A cancelled partition stops early, its matches are incomplete
+                    ticket.check()
+                yield matches
+        finally:
+            # Drop the partitions nobody is waiting for anymore
+            for future in tasks:
+                future.cancel()
+            if cancel is not None:
+                cancel.set()
+
+    def pdf_page_count(self, file_path):
+        """Return the number of pages of a PDF in files_dir, None if it can't be read."""
+        full_path = os.path.join(self.files_dir, file_path)
+        try:
+            st = os.stat(full_path)
+            signature = (st.st_size, st.st_mtime_ns)
+            cached = self.pdf_page_counts.get(file_path)
+            if cached is not None and cached[0] == signature:
+                return cached[1]
+            pages = pdf_page_count(full_path)
+        except Exception as e:
+            self.log(f"Error counting pages of {file_path}: {e}")
+            return None
+        self.pdf_page_counts[file_path] = (signature, pages)
+        return pages
+
+    def ranked_search(self, keywords, k=None, client=None):
+        """Return (number of matching lines, [(score, file, location, line)]) for the best k lines containing the keywords.
+
+        Unlike search every matching line is looked at, but only the best k
+        are kept while the search runs. It is scheduled like search.
+        """
+        k = k or self.max_results
+        key = ('rank', k) + tuple(keywords)
+        generation = self.index_maintainer.corpus_generation
+        cached = self.result_cache.get(key, generation)
+        if cached is not None:
+            return cached
+
+        matcher = search_engine.KeywordMatcher(keywords)
+        index = self.index_maintainer.index
+        statistics = RankingStatistics.from_index(index, matcher.needles) if index is not None else None
+        ranker = Ranker(matcher.needles, k, statistics)
+        top = ranker.top()
+        with self.scheduler.slot(client) as ticket, self.metrics.timer('rank'):
+            if index is not None:
+                order = 0
+                for document, matches in index.iter_search(matcher, with_documents=True):
+                    ranker.rank_file(matches, top, order, document.token_count)
+                    order += len(matches)
+                    ticket.check()
+                seen = top.seen
+            else:
+                # Orders of later partitions come after those of earlier ones
+                seen = 0
+                for part_no, (part_seen, entries) in enumerate(self.scan_files(matcher, ranker, ticket)):
+                    seen += part_seen
+                    for score, order, match in entries:
+                        top.push(score, (part_no << 40) + order, match)
+
+        ranked = (seen, [(score,) + match for score, order, match in top.entries()])
+        self.result_cache.put(key, generation, ranked)
+        return ranked
+
+    def search_videos(self, keyword):
+        """Return (line number, line) for every line of the videos file containing keyword."""
+        index = self.video_catalog.current()
+        key = ('videosearch', keyword)
+        matching_lines = self.result_cache.get(key, index.signature)
+        if matching_lines is None:
+            matching_lines = index.search(keyword)
+            self.result_cache.put(key, index.signature, matching_lines)
+        return matching_lines
+
+    def stats(self):
+        """Return (label, value) rows describing the index and the result cache."""
+        if self.use_index:
+            index_generation = self.index_maintainer.generation
+            last_reindex = f"{self.index_maintainer.last_reindex_duration:.2f}s"
+        else:
+            index_generation = last_reindex = "disabled"
+        cache = self.result_cache
+        return [
+            ('Index Generation', index_generation),
+            ('Last Reindex', last_reindex),
+            ('Cache Hits', cache.hits),
+            ('Cache Misses', cache.misses),
+            ('Cache Entries / Memory', f"{len(cache.entries)} / {cache.bytes // 1024} KB"),
+            ('Video Catalog Lines', len(self.video_catalog.index.lines)),
+            ('Snapshot Loaded', self.snapshot_loaded),
+            ('Snapshot Saved', self.snapshot_saved),
+        ] + self.scheduler.stats() + self.metrics.summary()
+
+    def metrics_text(self, counters=(), gauges=()):
+        """Return the latency histograms and the given and own (name, help, value) counters and gauges for /metrics."""
+        cache = self.result_cache
+        counters = list(counters) + [
+            ('cache_hits_total', 'Searches answered from the result cache', cache.hits),
+            ('cache_misses_total', 'Searches not found in the result cache', cache.misses),
+            ('video_catalog_reloads_total', 'Times the videos catalog was reloaded', self.video_catalog.reloads),
+            ('searches_admitted_total', 'Searches the scheduler let run', self.scheduler.admitted),
+            ('searches_rejected_total', 'Searches turned away because the search queue was full', self.scheduler.rejected),
+            ('searches_timed_out_total', 'Searches stopped at their deadline', self.scheduler.timeouts),
+        ]
+        gauges = list(gauges) + [
+            ('index_generation', 'Number of times the search index was updated', self.index_maintainer.generation),
+            ('cache_entries', 'Entries in the result cache', len(cache.entries)),
+            ('cache_bytes', 'Estimated memory used by the result cache', cache.bytes),
+            ('video_catalog_lines', 'Lines in the videos catalog', len(self.video_catalog.index.lines)),
+            ('searches_running', 'Searches running now', len(self.scheduler.running)),
+            ('searches_queued', 'Searches waiting for a free slot', self.scheduler.queued),
+        ]
+        return self.metrics.render(counters, gauges)
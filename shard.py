@@ -0,0 +1,293 @@
+# Copyright 2024 by moshix
+# Sharded search: shard servers and the scatter-gather coordinator
+#
+# A shard is a server process that owns part of the corpus (its own
+# --files_dir) and answers searches over a small internal protocol, one JSON
+# object per line in each direction on a plain TCP connection:
+#
+#   {"op": "search", "keywords": ["vsam", "dataset"], "limit": 31, "client": "10.0.0.7"}
+#   {"matches": [["file.txt", "Line 12", "..."], ...]}
+#
+#   {"op": "ping"}
+#   {"ok": true, "files_dir": "FILES1/"}
+#
+# and {"error": "..."} when a request can't be answered. client names the
+# user of the front end the search is for, the shard queues it for that user
+# and not for the front end, so fairness between users holds on every
+# shard. A front end started with --shards admits a /search with its own
+# scheduler first and then sends it to all shards at once through a
+# ShardCoordinator, which hands on the matches shard by shard, in the order
+# the shards were given, until max_results + 1 are there. A shard that is
+# down or doesn't answer within --shard_timeout seconds is left out of the
+# results and counted in /stats.
+#
+# On one machine:
+#   python3 shard.py --port 9001 --files_dir FILES1/
+#   python3 shard.py --port 9002 --files_dir FILES2/
+#   python3 telnet.py --port 8023 --shards localhost:9001,localhost:9002
+
+import json
+import time
+import socket
+import argparse
+import threading
+from datetime import datetime
+from concurrent.futures import ThreadPoolExecutor, TimeoutError
+from search_service import SearchService, add_search_arguments
+
+# Largest request or response line accepted
+MAX_LINE_BYTES = 64 * 1024 * 1024
+
+
+class ShardError(Exception):
+    """A shard could not be reached or refused a request."""
+
+
+def parse_shards(shards):
+    """Return the (host, port) addresses of a comma separated list of host:port."""
+    addresses = []
+    for shard in shards.split(','):
+        shard = shard.strip()
+        if not shard:
+            continue
+        host, _, port = shard.rpartition(':')
+        addresses.append((host or 'localhost', int(port)))
+    return addresses
+
+
+class ShardServer:
+    def __init__(self, host='0.0.0.0', port=9001, search_service=None, backlog=128):
+        self.host = host
+        self.port = port
+        self.search_service = search_service
+        self.running = True
+        self.request_count = 0
+        self.lock = threading.Lock()
+
+        self.server_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self.server_socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        self.server_socket.bind((self.host, self.port))
+        self.server_socket.listen(backlog)
+        print(f"Shard server for {self.search_service.files_dir} started on {self.host}:{self.port}")
+
+    def log(self, message, client_address=None):
+        timestamp = datetime.now().strftime('%Y-%m-%d %H:%M:%S')
+        print(f"{timestamp} - {client_address} - {message}" if client_address else f"{timestamp} - {message}")
+
+    def start(self):
+        """Accept coordinator connections until stopped, each one served by its own thread."""
+        self.search_service.start()
+        try:
+            while self.running:
+                try:
+                    connection, client_address = self.server_socket.accept()
+                except OSError:
+                    break
+                threading.Thread(target=self.handle_connection, args=(connection, client_address), daemon=True).start()
+        except KeyboardInterrupt:
+            print("Shard server shutting down...")
+        finally:
+            self.stop()
+
+    def stop(self):
+        if not self.running:
+            return
+        self.running = False
+        self.server_socket.close()
+        self.search_service.stop()
+
+    def handle_connection(self, connection, client_address):
+        """Answer the requests of one coordinator connection in turn."""
+        with connection, connection.makefile('rb') as reader:
+            while self.running:
+                line = reader.readline(MAX_LINE_BYTES)
+                if not line:
+                    break
+                try:
+                    response = self.handle_request(json.loads(line), client_address)
+                except Exception as e:
+                    self.log(f"Error handling shard request: {e}", client_address)
+                    response = {'error': str(e)}
+                try:
+                    connection.sendall(json.dumps(response).encode('utf-8') + b"\n")
+                except OSError:
+                    break
+
+    def handle_request(self, request, client_address=None):
+        with self.lock:
+            self.request_count += 1
+        op = request.get('op')
+        if op == 'ping':
+            return {'ok': True, 'files_dir': self.search_service.files_dir}
+        if op == 'search':
+            keywords = [str(keyword).lower().strip() for keyword in request.get('keywords', [])]
+            limit = min(int(request.get('limit', self.search_service.max_results + 1)), self.search_service.max_results + 1)
+            matches = []
+            client = request.get('client') or (client_address[0] if client_address else None)
+            batches = self.search_service.search(keywords, client)
+            try:
+                for batch in batches:
+                    matches.extend(batch[:limit - len(matches)])
+                    if len(matches) >= limit:
+                        break
+            finally:
+                batches.close()
+            return {'matches': matches}
+        raise ShardError(f"Unknown request: {op}")
+
+
+class ShardClient:
+    """Connections to one shard, reused by the searches that follow."""
+
+    def __init__(self, address, timeout=2.0):
+        self.address = address
+        self.timeout = timeout
+        self.idle = []
+        self.lock = threading.Lock()
+
+    @property
+    def name(self):
+        return f"{self.address[0]}:{self.address[1]}"
+
+    def connect(self):
+        """Return (connection, reader, reused), an idle connection if there is one."""
+        with self.lock:
+            if self.idle:
+                return self.idle.pop() + (True,)
+        connection = socket.create_connection(self.address, timeout=self.timeout)
+        return connection, connection.makefile('rb'), False
+
+    def request(self, message, timeout=None):
+        """Send a request to the shard and return its response, raising ShardError or socket.timeout."""
+        while True:
+            connection, reader, reused = self.connect()
+            try:
+                connection.settimeout(timeout or self.timeout)
+                connection.sendall(json.dumps(message).encode('utf-8') + b"\n")
+                line = reader.readline(MAX_LINE_BYTES)
+                if not line:
+                    raise ShardError(f"Shard {self.name} closed the connection")
+                response = json.loads(line)
+                break
+            except BaseException as e:
+                # The answer may still arrive later, never reuse this connection
+                reader.close()
+                connection.close()
+                # An idle connection may have been closed by a restarted shard, try a new one
+                if reused and isinstance(e, (ShardError, ConnectionError)):
+                    continue
+                raise
+        with self.lock:
+            self.idle.append((connection, reader))
+        if 'error' in response:
+            raise ShardError(f"Shard {self.name}: {response['error']}")
+        return response
+
+    def close(self):
+        with self.lock:
+            idle, self.idle = self.idle, []
+        for connection, reader in idle:
+            reader.close()
+            connection.close()
+
+
+class ShardCoordinator:
+    def __init__(self, addresses, max_results=30, timeout=2.0, metrics=None, log=None):
+        self.max_results = max_results
+        self.timeout = timeout
+        self.metrics = metrics
+        self.log = log or (lambda message: None)
+        self.shards = [ShardClient(address, timeout) for address in addresses]
+        self.executor = ThreadPoolExecutor(max_workers=max(4, len(self.shards) * 8))
+        self.lock = threading.Lock()
+        self.timeouts = 0
+        self.errors = 0
+        self.failed = set()
+
+    def query(self, shard, message):
+        start = time.perf_counter()
+        try:
+            return shard.request(message, self.timeout)
+        finally:
+            if self.metrics is not None:
+                self.metrics.observe_stage('shard', time.perf_counter() - start)
+
+    def search(self, keywords, client=None):
+        """Yield lists of (file, location, line) matches from all shards, like SearchService.search.
+
+        The search is sent to every shard at once, their matches are handed
+        on in shard order until max_results + 1 are there. Shards that fail
+        or take longer than timeout seconds are skipped. client is who the
+        shards queue the search for.
+        """
+        limit = self.max_results + 1
+        message = {'op': 'search', 'keywords': list(keywords), 'limit': limit, 'client': client}
+        futures = [self.executor.submit(self.query, shard, message) for shard in self.shards]
+        deadline = time.monotonic() + self.timeout
+        found = 0
+        try:
+            for shard, future in zip(self.shards, futures):
+                try:
+                    response = future.result(timeout=max(0.0, deadline - time.monotonic()))
+                except (TimeoutError, socket.timeout):
+                    self.shard_failed(shard, "timed out", timeout=True)
+                    continue
+                except (OSError, ValueError, ShardError) as e:
+                    self.shard_failed(shard, e)
+                    continue
+                with self.lock:
+                    self.failed.discard(shard.name)
+                batch = [tuple(match) for match in response.get('matches', [])][:limit - found]
+                if batch:
+                    found += len(batch)
+                    yield batch
+                if found >= limit:
+                    break
+        finally:
+            for future in futures:
+                future.cancel()
+
+    def shard_failed(self, shard, error, timeout=False):
+        with self.lock:
+            if timeout:
+                self.timeouts += 1
+            else:
+                self.errors += 1
+            self.failed.add(shard.name)
+        self.log(f"Error during search on shard {shard.name}: {error}")
+
+    def stats(self):
+        """Return (label, value) rows describing the shards."""
+        with self.lock:
+            return [
+                ('Shards Up / Total', f"{len(self.shards) - len(self.failed)} / {len(self.shards)}"),
+                ('Shard Timeouts', self.timeouts),
+                ('Shard Errors', self.errors),
+            ]
+
+    def counters(self):
+        """Return the (name, help, value) counters of the shards for /metrics."""
+        with self.lock:
+            return [
+                ('shard_timeouts_total', 'Shard searches that took longer than the shard timeout', self.timeouts),
+                ('shard_errors_total', 'Shard searches that failed', self.errors),
+            ]
+
+    def stop(self):
+        self.executor.shutdown(wait=False)
+        for shard in self.shards:
+            shard.close()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Shard server answering searches of a coordinating front end.')
+    parser.add_argument('--port', type=int, default=9001, help='Port to answer shard requests on')
+    # The files_dir of a shard is the part of the corpus it owns
+    add_search_arguments(parser, snapshot_file=None)
+    args = parser.parse_args()
+    if args.snapshot_file is None:
+        # Shards on one machine each keep their own snapshot
+        args.snapshot_file = f".search_snapshot.{args.port}"
+
+    service = SearchService.from_args(args, log=print)
+    ShardServer(port=args.port, search_service=service).start()
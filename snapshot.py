@@ -0,0 +1,71 @@
+# Copyright 2024 by moshix
+# Snapshots of the search state for a warm start
+#
+# Building the search index means reading and tokenizing every file in
+# FILES/ and extracting the text of every PDF, and the videos catalog has to
+# be tokenized as well. SearchService saves all of it to one snapshot file
+# when the server shuts down and every snapshot_interval seconds if anything
+# changed, and loads it again on startup. The loaded index only becomes the
+# current one after the index maintainer has compared the stat signatures of
+# its files with FILES/ and reindexed the files that changed, and the videos
+# index is only used while videos.txt has the signature it was built from,
+# so a snapshot never serves stale results.
+#
+# The snapshot is a pickle the server writes for itself: a small header with
+# the format version and the directories it describes, then the state. A
+# snapshot of another version or other directories, or one that can't be
+# read, is ignored and everything is built from scratch.
+
+import os
+import pickle
+import tempfile
+
+# Bump whenever the pickled classes change
+SNAPSHOT_VERSION = 2
+
+
+class Snapshot:
+    def __init__(self, files_dir, videos_file, documents=None, generation=0, video_index=None):
+        self.files_dir = files_dir
+        self.videos_file = videos_file
+        self.documents = documents      # DocumentIndex list of the search index, None without one
+        self.generation = generation
+        self.video_index = video_index
+
+    def header(self):
+        return {
+            'version': SNAPSHOT_VERSION,
+            'files_dir': os.path.abspath(self.files_dir),
+            'videos_file': os.path.abspath(self.videos_file),
+        }
+
+
+def save_snapshot(path, snapshot):
+    """Write snapshot to path, replacing the previous one only once it is complete."""
+    directory = os.path.dirname(os.path.abspath(path))
+    fd, tmp_path = tempfile.mkstemp(dir=directory, prefix=os.path.basename(path), suffix='.tmp')
+    try:
+        with os.fdopen(fd, 'wb') as f:
+            pickle.dump(snapshot.header(), f, protocol=pickle.HIGHEST_PROTOCOL)
+            pickle.dump((snapshot.documents, snapshot.generation, snapshot.video_index), f,
+                        protocol=pickle.HIGHEST_PROTOCOL)
+        os.replace(tmp_path, path)
+    except BaseException:
+        try:
+            os.unlink(tmp_path)
+        except OSError:
+            pass
+        raise
+
+
+def load_snapshot(path, files_dir, videos_file):
+    """Return the Snapshot saved at path for files_dir and videos_file, None if there is no usable one."""
+    expected = Snapshot(files_dir, videos_file).header()
+    try:
+        with open(path, 'rb') as f:
+            if pickle.load(f) != expected:
+                return None
+            documents, generation, video_index = pickle.load(f)
+    except FileNotFoundError:
+        return None
+    return Snapshot(files_dir, videos_file, documents, generation, video_index)
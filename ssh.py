@@ -13,17 +13,30 @@
 # v0.9    Handle PTY
 # v0.91   Handle shell
 # 0.93    Handle client typing better
+# 1.1     search with the engine shared with the telnet server: parallel, PDFs, max results, cached
+# 1.2     keep an index of videos.txt (or --videos_file) in memory, reloaded when the file changes
+# 1.3     time every command and search stage into latency histograms, /metrics and a summary in /stats
+# 1.4     search big PDFs in ranges of pages on several workers, extracting only the pages needed
+# 1.5     limit the searches running at once, queue the rest fairly per client, stop searches at a deadline
+# 1.6     save the search index and videos index to a snapshot on shutdown and periodically, warm start from it
+#
+# invoke with:
+#   python3 ssh.py --port 8023 --files_dir FILES/ --max_results 30
+#   the search options of telnet.py (--no_index, --search_backend, --search_workers, ...) work here too
 import socket
 import threading
-import os
+import re
 import signal
 import time
+import argparse
 import paramiko
 from datetime import datetime
 from paramiko import RSAKey, ServerInterface, AUTH_SUCCESSFUL, OPEN_SUCCEEDED
+from search_service import SearchService, add_search_arguments
+from scheduler import SchedulerError
 
 # Version information
-version = "1.0"
+version = "1.6"
 
 # ANSI color codes for formatting
 COLOR_RESET = "\033[0m"
@@ -32,8 +45,8 @@ COLOR_BLUE = "\033[1;34m"
 COLOR_RED = "\033[1;31m"
 COLOR_YELLOW = "\033[1;33m"
 
-FILES_DIR = "FILES/"
-VIDEOS_FILE = "videos.txt"
+# Commands with their own latency histogram, anything else is counted as unknown
+COMMANDS = {"/help", "/search", "/videosearch", "/logoff", "/stats", "/metrics", "/uptime"}
 
 class SSHServerInterface(ServerInterface):
     def check_auth_password(self, username, password):
@@ -55,9 +68,14 @@ class SSHServerInterface(ServerInterface):
         return True
 
 class SSHServer:
-    def __init__(self, host='0.0.0.0', port=8023):
+    def __init__(self, host='0.0.0.0', port=8023, search_args=None, max_keywords=8):
+        # search_args holds the options of add_search_arguments, their defaults when None
+        if search_args is None:
+            search_args = add_search_arguments(argparse.ArgumentParser()).parse_args([])
         self.host = host
         self.port = port
+        self.max_results = search_args.max_results
+        self.max_keywords = max(1, max_keywords)
 
         # Initialize server socket
         self.server_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
@@ -83,10 +101,15 @@ class SSHServer:
         # Handle SIGINT (Control-C) to shut down the server gracefully
         signal.signal(signal.SIGINT, self.handle_sigint)
 
+        # Searches run on the engine shared with the telnet server
+        self.search_service = SearchService.from_args(search_args, log=print)
+        self.search_service.start()
+
     def handle_sigint(self, signum, frame):
         print("\nSIGINT received. Shutting down the server.")
         self.running = False
         self.server_socket.close()
+        self.search_service.stop()
 
     def handle_client(self, client_socket, client_address):
         transport = paramiko.Transport(client_socket)
@@ -141,14 +164,20 @@ class SSHServer:
                         with self.lock:
                             self.total_messages += 1
 
+                        start_counter = time.perf_counter()
                         if message.startswith("/"):
                             # Increment command count
                             with self.lock:
                                 self.total_commands += 1
 
+                            command = message.split(" ", 1)[0].lower()
+                            if command not in COMMANDS:
+                                command = "unknown"
                             response = self.handle_command(message, client_address)
                         else:
+                            command = "message"
                             response = message
+                        self.search_service.metrics.observe_command(command, time.perf_counter() - start_counter)
 
                         # Add two clear lines before responding
                         clear_lines = "\n\n"
@@ -181,10 +210,12 @@ class SSHServer:
 
         elif cmd == "/search":
             if len(parts) > 1:
-                keyword = parts[1]
+                keywords = self.parse_search_args(parts[1])
+                if not keywords or len(keywords) > self.max_keywords:
+                    return self.invalid_command(f"Usage: /search <keyword> or /search \"<keyword1>\" [\"<keyword2>\" ...] (at most {self.max_keywords} keywords)")
                 with self.lock:
                     self.search_count += 1
-                return self.search_files(keyword)
+                return self.search_files(keywords, client_address[0] if client_address else None)
             else:
                 return self.invalid_command(f"Usage: /search <keyword>")
 
@@ -203,6 +234,9 @@ class SSHServer:
         elif cmd == "/stats":
             return self.get_stats()
 
+        elif cmd == "/metrics":
+            return self.get_metrics()
+
         elif cmd == "/uptime":
             return self.get_uptime()
 
@@ -220,54 +254,62 @@ class SSHServer:
             f"{'-'*40}\r\n"
             f"{COLOR_BLUE}/help{COLOR_RESET:<15} Show this help message\r\n"
             f"{COLOR_BLUE}/search <keyword>{COLOR_RESET:<15} Search files in the FILES/ directory for a keyword\r\n"
+            f"{COLOR_BLUE}/search \"<keyword1>\" [\"<keyword2>\" ...]{COLOR_RESET:<15} Search files for up to {self.max_keywords} keywords (all must be present)\r\n"
             f"{COLOR_BLUE}/videosearch <keyword>{COLOR_RESET:<15} Search for lines containing the keyword in videos.txt\r\n"
             f"{COLOR_BLUE}/logoff{COLOR_RESET:<15} Log off from the server\r\n"
             f"{COLOR_BLUE}/stats{COLOR_RESET:<15} Show server statistics\r\n"
+            f"{COLOR_BLUE}/metrics{COLOR_RESET:<15} Show counters and latency histograms in Prometheus text format\r\n"
             f"{COLOR_BLUE}/uptime{COLOR_RESET:<15} Show server uptime and start time"
         )
         return help_text
 
-    def search_files(self, keyword):
-        # Search for a keyword in files within the FILES/ directory
+    def parse_search_args(self, args_str):
+        # Keywords in double quotes like telnet.py, otherwise the whole argument is one keyword
+        if '"' in args_str:
+            return re.findall(r'"(.*?)"', args_str)
+        return [args_str]
+
+    def search_files(self, keywords, client=None):
+        # Search for the keywords in files within the FILES/ directory
+        keywords = [keyword.lower().strip() for keyword in keywords]
         matching_files = []
-        keyword = keyword.lower()
-        for root, dirs, files in os.walk(FILES_DIR):
-            for file in files:
-                file_path = os.path.join(root, file)
-                with open(file_path, 'r', errors='ignore') as f:
-                    for line_number, line in enumerate(f, 1):
-                        if keyword in line.lower():
-                            matching_files.append((file_path, line_number, line.strip()))
+        too_many = False
+        try:
+            for batch in self.search_service.search(keywords, client):
+                matching_files.extend(batch)
+        except SchedulerError as e:
+            return self.invalid_command(str(e))
+        if len(matching_files) > self.max_results:
+            matching_files = matching_files[:self.max_results]
+            too_many = True
 
         if matching_files:
-            results = "\r\n".join(f"{i + 1}. {file:<50} {line_number:<5} {line}" for i, (file, line_number, line) in enumerate(matching_files))
-            return (
-                f"{COLOR_GREEN}Files containing the keyword '{keyword}':{COLOR_RESET}\r\n"
-                f"{COLOR_GREEN}{'No.':<5} {'File':<50} {'Line':<5} {'Content'}{COLOR_RESET}\r\n"
+            results = "\r\n".join(f"{i + 1}. {file:<50} {location:<10} {line}" for i, (file, location, line) in enumerate(matching_files))
+            response = (
+                f"{COLOR_GREEN}Files containing the keyword '{' and '.join(keywords)}':{COLOR_RESET}\r\n"
+                f"{COLOR_GREEN}{'No.':<5} {'File':<50} {'Location':<10} {'Content'}{COLOR_RESET}\r\n"
                 f"{'-'*100}\r\n{results}"
             )
+            if too_many:
+                response += f"\r\n{COLOR_RED}Too many search results found. Stopping search.{COLOR_RESET}"
+            return response
         else:
-            return f"{COLOR_RED}No files found containing the keyword '{keyword}'.{COLOR_RESET}"
+            return f"{COLOR_RED}No files found containing the keyword '{' and '.join(keywords)}'.{COLOR_RESET}"
 
     def search_videos(self, keyword):
-        # Search for a keyword in the videos.txt file
-        matching_lines = []
+        # Search for a keyword in the videos catalog
         keyword = keyword.lower()
-        if os.path.exists(VIDEOS_FILE):
-            with open(VIDEOS_FILE, 'r', errors='ignore') as f:
-                for line_number, line in enumerate(f, 1):
-                    if keyword in line.lower():
-                        matching_lines.append(f"{line_number:<5} {line.strip()}")
+        matching_lines = [f"{line_number:<5} {line}" for line_number, line in self.search_service.search_videos(keyword)]
 
         if matching_lines:
             results = "\r\n".join(matching_lines)
             return (
-                f"{COLOR_GREEN}Lines containing the keyword '{keyword}' in {VIDEOS_FILE}:{COLOR_RESET}\r\n"
+                f"{COLOR_GREEN}Lines containing the keyword '{keyword}' in {self.search_service.videos_file}:{COLOR_RESET}\r\n"
                 f"{COLOR_GREEN}{'Line':<5} {'Content':<50}{COLOR_RESET}\r\n"
                 f"{'-'*55}\r\n{results}"
             )
         else:
-            return f"{COLOR_RED}No lines found containing the keyword '{keyword}' in {VIDEOS_FILE}.{COLOR_RESET}"
+            return f"{COLOR_RED}No lines found containing the keyword '{keyword}' in {self.search_service.videos_file}.{COLOR_RESET}"
 
     def get_uptime(self):
         # Calculate and return the server uptime
@@ -287,6 +329,8 @@ class SSHServer:
             # Directly call get_uptime() method and format its response correctly
             uptime_stats = self.get_uptime().split('\r\n')[2:]
             uptime_stats_text = "\r\n".join(uptime_stats)
+            search_stats = "".join(f"{COLOR_GREEN}{label:<25} {value:<10}{COLOR_RESET}\r\n"
+                                   for label, value in self.search_service.stats())
 
             stats_text = (
                 f"{COLOR_BLUE}Server Statistics (Version {version}):{COLOR_RESET}\r\n"
@@ -298,10 +342,27 @@ class SSHServer:
                 f"{COLOR_GREEN}{'Search Commands':<25} {self.search_count:<10}{COLOR_RESET}\r\n"
                 f"{COLOR_GREEN}{'Video Search Commands':<25} {self.videosearch_count:<10}{COLOR_RESET}\r\n"
                 f"{COLOR_GREEN}{'Total Commands':<25} {self.total_commands:<10}{COLOR_RESET}\r\n"
+                f"{search_stats}"
                 f"{uptime_stats_text}"
             )
             return stats_text
 
+    def get_metrics(self):
+        # Return the server counters and latency histograms in Prometheus text format
+        with self.lock:
+            counters = [
+                ('clients_total', 'Clients that connected', self.total_clients),
+                ('messages_total', 'Lines received from clients', self.total_messages),
+                ('commands_total', 'Commands received from clients', self.total_commands),
+                ('search_commands_total', 'Search commands', self.search_count),
+                ('videosearch_commands_total', 'Video search commands', self.videosearch_count),
+            ]
+            gauges = [
+                ('clients', 'Clients currently connected', self.client_count),
+                ('uptime_seconds', 'Seconds since the server started', round(time.time() - self.start_time, 3)),
+            ]
+        return self.search_service.metrics_text(counters, gauges)
+
     def start(self):
         # Start the server to accept connections
         try:
@@ -318,6 +379,12 @@ class SSHServer:
             self.server_socket.close()
 
 if __name__ == '__main__':
-    server = SSHServer(port=8023)
+    parser = argparse.ArgumentParser(description='Start an SSH server.')
+    parser.add_argument('--port', type=int, default=8023, help='Port to run the SSH server on')
+    add_search_arguments(parser)
+    parser.add_argument('--max_keywords', type=int, default=8, help='Maximum number of quoted keywords in a /search')
+    args = parser.parse_args()
+
+    server = SSHServer(port=args.port, search_args=args, max_keywords=args.max_keywords)
     server.start()
 
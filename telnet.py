@@ -24,23 +24,71 @@
 # v2.1 allow 2 search arguments in /search (in " ") and they will be treated as AND args
 # v2.2 add invocation parameter for max results before it's too much!
 # v2.3 read files in chunks, parallelize to speed up the search
+# v2.4 build an inverted index of FILES/ at startup and answer /search from it
+# v2.5 keep the search index current as files in FILES/ are added, changed or deleted
+# v2.6 cache extracted PDF text on disk so PDFs are only parsed once
+# v2.7 optional asyncio engine (--engine asyncio) to serve many clients on one event loop
+# v2.8 optional process pool for searches (--search_backend processes) to use all cores
+# v2.9 stream search results to the client as they are found, stop all work at max_results
+# v3.0 type out responses from one timer thread instead of sleeping in every client thread, /pace
+# v3.1 cache search results until something in FILES/ or videos.txt changes
+# v3.2 scan big text files in chunks of --scan_chunk_bytes so memory use stays bounded
+# v3.3 allow up to --max_keywords search arguments, matched with one prepared matcher per search
+# v3.4 keep an index of videos.txt (or --videos_file) in memory, reloaded when the file changes
+# v3.5 time every command and search stage into latency histograms, /metrics and a summary in /stats
+# v3.6 write the log from a background thread in batches, optionally rotating server.log
+# v3.7 show results a page at a time, /more and /page N fetch further pages of the last search
+# v3.8 /rank shows the best --max_results matches ranked by BM25 instead of stopping at too many
+# v3.9 /regex searches FILES/ for a regular expression with the help of a trigram index
+# v4.0 search big PDFs in ranges of pages on several workers, extracting only the pages needed
+# v4.1 --shards sends /search to shard servers (shard.py) owning parts of the corpus and merges their results
+# v4.2 limit the searches running at once, queue the rest fairly per client, stop searches at a deadline
+# v4.3 save the search index and videos index to a snapshot on shutdown and periodically, warm start from it
+# v4.4 run every command of a read in turn so scripts can pipeline them, /batch runs many searches at once
+# v4.5 /format json|plain sends results as newline-delimited records for scripts, /format ansi goes back
 #
 # invoke with:
 #   python3 telnet_server.py --port 8023 --delay 0.05 --delay_lines 25 --files_dir FILES/ --max_results 30
+#   add --no_index to always scan FILES/ instead of using the search index
+#   add --max_index_mb 64 to scan text files bigger than that instead of keeping them in the search index
+#   add --pdf_cache_dir .pdf_cache --pdf_cache_mb 256 to size the PDF text cache (0 disables it)
+#   add --engine asyncio --backlog 1024 to serve thousands of clients from one event loop
+#   add --search_backend processes --search_workers 16 to scan FILES/ with worker processes
+#   add --cache_entries 1000 --cache_mb 64 to size the search result cache (0 disables it)
+#   add --scan_chunk_bytes 1048576 to set how much of a text file a search reads at a time
+#   add --pdf_range_pages 64 to search PDFs with more pages in ranges on several workers (0 disables it)
+#   add --max_keywords 8 to allow more quoted keywords in /search
+#   add --videos_file videos.txt to choose the catalog /videosearch searches
+#   add --page_size 25 --cursor_timeout 300 --cursor_kb 256 to size the pages of /search and /videosearch results
+#   add --max_searches 4 --search_queue 32 --search_timeout 30 to limit running and waiting searches
+#   add --snapshot_file .search_snapshot --snapshot_interval 300 to tune warm start snapshots (empty file name disables them)
+#   add --max_batch 100 to allow more commands in a /batch
+#   add --shards localhost:9001,localhost:9002 --shard_timeout 2 to answer /search from shard servers started with shard.py
+#   add --log_file server.log --log_queue 10000 --log_policy drop|block --log_max_mb 100 --log_backups 5 to tune logging
 
 import socket
+import asyncio
+import codecs
 import threading
-import os
+import contextlib
+import heapq
+import itertools
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
 import signal
 import time
-import PyPDF2
 from datetime import datetime
 import argparse
 import re
-from concurrent.futures import ThreadPoolExecutor
+from search_service import SearchService, add_search_arguments
+from log_writer import LogWriter
+from shard import ShardCoordinator, parse_shards
+from scheduler import SchedulerError
+import output_format
+import trigram
 
 # Version information
-version = "2.3"
+version = "4.5"
 
 # ANSI color codes for formatting
 COLOR_RESET = "\033[0m"
@@ -50,19 +98,338 @@ COLOR_RED = "\033[1;31m"
 COLOR_YELLOW = "\033[1;33m"
 COLOR_CYAN = "\033[1;36m"
 
+# Commands that are run on a worker thread by the asyncio engine
+BLOCKING_COMMANDS = {"/search", "/rank", "/regex", "/videosearch", "/more", "/page"}
+
+# Commands with their own latency histogram, anything else is counted as unknown
+COMMANDS = {"/help", "/search", "/rank", "/regex", "/videosearch", "/more", "/page", "/batch", "/logoff", "/stats", "/metrics", "/pace", "/format", "/uptime"}
+
+# Commands that may be part of a /batch
+BATCH_COMMANDS = {"/search", "/rank", "/regex", "/videosearch"}
+
+# Names of the values of the matches of each kind of search, for /format json and plain
+SEARCH_FIELDS = ('file', 'location', 'line')
+RANKED_FIELDS = ('score', 'file', 'location', 'line')
+VIDEO_FIELDS = ('line_number', 'line')
+
+# Send without blocking the pacer thread, not available on every platform
+MSG_DONTWAIT = getattr(socket, 'MSG_DONTWAIT', 0)
+
+class ClientSession:
+    """State of one client connection."""
+
+    def __init__(self, connection, client_address):
+        self.connection = connection      # None for the searches of a /batch, which can't be paged through
+        self.client_address = client_address
+        self.interactive = True   # cleared when the client pipes several commands at once
+        self.pacing = None        # set by /pace, overrides the interactive guess
+        self.output = 'ansi'      # set by /format
+
+        # Received data not yet split into lines, a character may be split over two reads
+        self.decoder = codecs.getincrementaldecoder('utf-8')(errors='replace')
+        self.buffer = ""
+
+        # Output queued on the OutputPacer
+        self.pending = deque()
+        self.pending_bytes = 0
+        self.pending_since = None
+        self.scheduled = False
+        self.closing = False
+        self.closed = False
+
+        # Results of the last search, paged through with /more and /page
+        self.cursor = None
+
+        # Commands of a /batch collected until /end
+        self.batch = None
+
+    @property
+    def pageable(self):
+        """True if the session can ask for further pages of its results."""
+        return self.connection is not None
+
+    @property
+    def paced(self):
+        """True if responses should be typed out line by line."""
+        return self.pacing if self.pacing is not None else self.interactive
+
+    def read_lines(self, data):
+        """Return the commands completed by data received from the client, in the order they were sent.
+
+        What follows the last line break waits for more data.
+        """
+        self.buffer += self.decoder.decode(data)
+
+        # Several commands in one read means a script, not someone typing
+        if self.buffer.count('\n') > 1:
+            self.interactive = False
+
+        lines = self.buffer.split('\n')
+        self.buffer = lines.pop()
+        return [line.strip() for line in lines]
+
+    def close_cursor(self):
+        if self.cursor is not None:
+            self.cursor.close()
+            self.cursor = None
+
+
+class ResultCursor:
+    """The matches of a search, fetched from the search and formatted one page at a time.
+
+    source yields lists of matches and is only read as far as the pages asked
+    for so far. Matches of earlier pages are let go once the retained ones
+    take more than max_bytes, asking for those pages again is an error. A
+    search the scheduler turns away or stops ends the results with error.
+    """
+
+    def __init__(self, header, format_row, source=None, matches=(), limit=None, page_size=25, max_bytes=256 * 1024,
+                 fields=SEARCH_FIELDS):
+        self.header = header
+        self.format_row = format_row
+        self.fields = fields       # names of the values of a match
+        self.source = source
+        self.matches = list(matches) if source is not None else matches
+        self.offset = 0            # number of the first retained match
+        self.limit = limit
+        self.truncated = False     # more than limit matches were found
+        self.error = None          # why the search stopped early
+        self.page_size = page_size
+        self.max_bytes = max_bytes
+        # Estimated from a sample, a video search can return a very long list
+        sample = self.matches[:32]
+        self.bytes = len(self.matches) * sum(self.match_bytes(match) for match in sample) // max(1, len(sample))
+        self.lock = threading.Lock()
+        self.last_used = time.monotonic()
+        self.current_page = 0
+        self.format_seconds = 0.0
+
+    @staticmethod
+    def match_bytes(match):
+        return 64 + sum(len(field) for field in match if isinstance(field, str))
+
+    @property
+    def exhausted(self):
+        return self.source is None
+
+    @property
+    def available(self):
+        """Number of matches fetched so far."""
+        return self.offset + len(self.matches)
+
+    def fetch(self):
+        """Read the next batch of matches from the source, return False once there are no more."""
+        if self.source is None:
+            return False
+        try:
+            batch = next(self.source, None)
+        except SchedulerError as e:
+            self.error = str(e)
+            batch = None
+        if batch is None:
+            self.close()
+            return False
+        if self.limit is not None and self.available + len(batch) > self.limit:
+            batch = batch[:self.limit - self.available]
+            self.truncated = True
+            self.close()
+        self.matches.extend(batch)
+        self.bytes += sum(self.match_bytes(match) for match in batch)
+        return True
+
+    def read_all(self):
+        """Fetch the rest of the matches, so the search is done and gives back its slot."""
+        while self.fetch():
+            pass
+
+    def rows(self, start, end):
+        """Return the formatted rows of matches start to end, counted from 0."""
+        started = time.perf_counter()
+        rows = [self.format_row(i + 1, self.matches[i - self.offset]) for i in range(start, min(end, self.available))]
+        self.format_seconds += time.perf_counter() - started
+        return rows
+
+    def release(self, keep_from):
+        """Let go of the matches before keep_from while over max_bytes."""
+        drop = min(keep_from, self.available) - self.offset
+        if self.bytes <= self.max_bytes or drop <= 0:
+            return
+        # Slice instead of del, matches may be a list shared with the result cache
+        self.bytes -= sum(self.match_bytes(match) for match in self.matches[:drop])
+        self.matches = self.matches[drop:]
+        self.offset += drop
+
+    def records(self, output, start, end):
+        """Return matches start to end, counted from 0, as one chunk of /format records."""
+        started = time.perf_counter()
+        matches = self.matches[start - self.offset:min(end, self.available) - self.offset]
+        chunk = output_format.encode_records(output, self.fields, start + 1, matches)
+        self.format_seconds += time.perf_counter() - started
+        return chunk
+
+    def iter_page(self, number, output='ansi'):
+        """Yield the rows of a page as its matches come in, starting with the header.
+
+        With a machine readable output format chunks of encoded records are
+        yielded instead, without a header.
+        """
+        self.last_used = time.monotonic()
+        start = (number - 1) * self.page_size
+        end = start + self.page_size
+        shown = start
+        while True:
+            if self.available > shown:
+                if output != 'ansi':
+                    rows = self.records(output, shown, end)
+                else:
+                    rows = self.rows(shown, end)
+                    if shown == start:
+                        rows.insert(0, self.header)
+                shown = min(end, self.available)
+                yield rows
+            # One match past the page tells whether there is a next one
+            if self.available > end or not self.fetch():
+                break
+        self.release(start)
+        self.last_used = time.monotonic()
+
+    def page_count(self):
+        return max(1, -(-self.available // self.page_size))
+
+    def close(self):
+        if self.source is not None:
+            self.source.close()
+            self.source = None
+
+
+class OutputPacer:
+    """Write the responses of all threaded clients from a single timer thread.
+
+    Client threads only queue their output here, so typing out the first
+    lines of a response with a delay between them doesn't tie up a thread.
+    How long queued output takes to go out is recorded as the send stage.
+    """
+
+    def __init__(self, max_pending=1024 * 1024, metrics=None):
+        self.max_pending = max_pending
+        self.metrics = metrics
+        self.condition = threading.Condition()
+        self.heap = []
+        self.sequence = itertools.count()
+        self.running = True
+        self.thread = threading.Thread(target=self.run, daemon=True)
+        self.thread.start()
+
+    def write(self, session, data, delay=0.0):
+        """Queue data for the session, followed by a pause of delay seconds."""
+        with self.condition:
+            # Hold the client thread back while the client isn't reading its output
+            while session.pending_bytes > self.max_pending and not session.closed:
+                self.condition.wait()
+            if session.closed:
+                raise BrokenPipeError(f"Connection with {session.client_address} is closed")
+            if not session.pending:
+                session.pending_since = time.monotonic()
+            session.pending.append((data, delay))
+            session.pending_bytes += len(data)
+            if not session.scheduled:
+                session.scheduled = True
+                heapq.heappush(self.heap, (time.monotonic(), next(self.sequence), session))
+                self.condition.notify_all()
+
+    def close(self, session):
+        """Close the session's connection once its queued output is written."""
+        with self.condition:
+            if session.scheduled and not session.closed:
+                session.closing = True
+                return
+            session.closed = True
+        session.connection.close()
+
+    def stop(self):
+        with self.condition:
+            self.running = False
+            self.condition.notify_all()
+
+    def run(self):
+        while True:
+            with self.condition:
+                if not self.running:
+                    return
+                if not self.heap:
+                    self.condition.wait()
+                    continue
+                due, _, session = self.heap[0]
+                now = time.monotonic()
+                if due > now:
+                    self.condition.wait(due - now)
+                    continue
+                heapq.heappop(self.heap)
+                data, delay = session.pending[0]
+
+            try:
+                sent = session.connection.send(data, MSG_DONTWAIT)
+            except BlockingIOError:
+                sent = 0
+            except OSError:
+                sent = None
+
+            with self.condition:
+                if sent is None:
+                    # The client is gone, drop its output and wake up its thread
+                    session.pending.clear()
+                    session.pending_bytes = 0
+                    session.closed = True
+                    try:
+                        session.connection.shutdown(socket.SHUT_RDWR)
+                    except OSError:
+                        pass
+                elif sent < len(data):
+                    # Socket buffer full, try the rest again shortly
+                    session.pending[0] = (memoryview(data)[sent:], delay)
+                    session.pending_bytes -= sent
+                    heapq.heappush(self.heap, (now + 0.01, next(self.sequence), session))
+                else:
+                    session.pending.popleft()
+                    session.pending_bytes -= sent
+                    if session.pending:
+                        heapq.heappush(self.heap, (now + delay, next(self.sequence), session))
+
+                if not session.pending:
+                    session.scheduled = False
+                    if sent and self.metrics is not None:
+                        self.metrics.observe_stage('send', time.monotonic() - session.pending_since)
+                    if session.closing and not session.closed:
+                        session.closed = True
+                        session.connection.close()
+                self.condition.notify_all()
+
 class TelnetServer:
-    def __init__(self, host='0.0.0.0', port=8023, delay=0.05, delay_lines=25, files_dir='FILES/', max_results=30):
+    def __init__(self, host='0.0.0.0', port=8023, delay=0.05, delay_lines=25, search_args=None, engine='threads', backlog=128,
+                 max_keywords=8, log_file='server.log', log_queue=10000, log_policy='drop',
+                 log_max_mb=0, log_backups=5, page_size=25, cursor_timeout=300.0, cursor_kb=256,
+                 shards=None, shard_timeout=2.0, max_batch=100):
+        # search_args holds the options of add_search_arguments, their defaults when None
+        if search_args is None:
+            search_args = add_search_arguments(argparse.ArgumentParser()).parse_args([])
         self.host = host
         self.port = port
         self.delay = delay
         self.delay_lines = delay_lines
-        self.files_dir = files_dir
-        self.max_results = max_results
+        self.files_dir = search_args.files_dir
+        self.max_results = search_args.max_results
+        self.engine = engine
+        self.backlog = backlog
+        self.max_keywords = max(1, max_keywords)
+        self.page_size = max(1, page_size)
+        self.cursor_timeout = cursor_timeout
+        self.cursor_bytes = cursor_kb * 1024
+        self.max_batch = max(1, max_batch)
 
         # Initialize server socket
         self.server_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
         self.server_socket.bind((self.host, self.port))
-        self.server_socket.listen(5)
+        self.server_socket.listen(self.backlog)
         print(f"Telnet server started on {self.host}:{self.port}")
 
         # Initialize server state and statistics
@@ -70,22 +437,47 @@ class TelnetServer:
         self.total_clients = 0
         self.total_messages = 0
         self.search_count = 0
+        self.rank_count = 0
+        self.regex_count = 0
         self.videosearch_count = 0
+        self.batch_count = 0
         self.total_commands = 0
         self.start_time = time.time()
         self.start_datetime = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
         self.lock = threading.Lock()
         self.running = True
         self.threads = []
+        self.writers = set()
+        self.sessions = set()
+        self.last_cursor_sweep = time.monotonic()
 
-        # Log file setup
-        self.log_file = open('server.log', 'a')
+        # Log lines are written to the console and the log file by a background thread
+        self.log_writer = LogWriter(log_file, max_queue=log_queue, policy=log_policy,
+                                    max_bytes=int(log_max_mb * 1024 * 1024), backups=log_backups)
 
         # Handle SIGINT (Control-C) to shut down the server gracefully
         signal.signal(signal.SIGINT, self.handle_sigint)
 
-        # Thread pool for concurrent file searches
-        self.executor = ThreadPoolExecutor(max_workers=8)
+        # Searches run on the engine shared with the SSH server
+        self.search_service = SearchService.from_args(search_args, log=self.log)
+        self.search_service.start()
+
+        # Command and stage latencies, shared with the search service
+        self.metrics = self.search_service.metrics
+
+        # With shards /search is answered by the shard servers instead of files_dir
+        self.shard_coordinator = None
+        if shards:
+            self.shard_coordinator = ShardCoordinator(parse_shards(shards), max_results=self.max_results, timeout=shard_timeout,
+                                                      metrics=self.metrics, log=self.log)
+
+        # The searches of a /batch run on their own threads, a batch keeps at most max_searches
+        # of them going and no more than the scheduler runs and queues at once are started
+        self.batch_window = max(1, search_args.max_searches)
+        self.batch_executor = ThreadPoolExecutor(max_workers=max(1, search_args.max_searches + search_args.search_queue))
+
+        # The threads engine types out responses from a single pacer thread
+        self.pacer = OutputPacer(metrics=self.metrics) if self.engine == 'threads' else None
 
     def handle_sigint(self, signum, frame):
         """Handle SIGINT signal to shut down the server gracefully."""
@@ -97,11 +489,18 @@ class TelnetServer:
         for thread in self.threads:
             thread.join()
 
-        # Close log file
-        self.log_file.close()
+        # Stop writing output
+        if self.pacer:
+            self.pacer.stop()
 
-        # Shutdown executor
-        self.executor.shutdown(wait=True)
+        # Stop reindexing and shut down the search workers
+        self.batch_executor.shutdown(wait=False, cancel_futures=True)
+        self.search_service.stop()
+        if self.shard_coordinator:
+            self.shard_coordinator.stop()
+
+        # Write what is left of the log and close it
+        self.log_writer.close()
 
         print("Server shut down successfully.")
 
@@ -109,9 +508,7 @@ class TelnetServer:
         """Log messages to both the console and log file."""
         timestamp = datetime.now().strftime('%Y-%m-%d %H:%M:%S')
         log_message = f"{timestamp} - {client_address} - {message}" if client_address else f"{timestamp} - {message}"
-        print(log_message)
-        self.log_file.write(log_message + '\n')
-        self.log_file.flush()
+        self.log_writer.write(log_message)
 
     def handle_client(self, client_socket, client_address):
         """Handle client connections and process commands."""
@@ -119,67 +516,240 @@ class TelnetServer:
             self.client_count += 1
             self.total_clients += 1
         self.log(f"Accepted connection from {client_address}", client_address)
+        session = ClientSession(client_socket, client_address)
+        with self.lock:
+            self.sessions.add(session)
 
         try:
             # Send welcome message and help message to the client
             client_socket.sendall(f"\n{COLOR_GREEN}Welcome to the Telnet server! Version: {version}{COLOR_RESET}\r\n".encode('utf-8'))
             client_socket.sendall(self.show_help().encode('utf-8') + b'\r\n')
 
-            buffer = ""
-            while self.running:
+            logged_off = False
+            while self.running and not logged_off:
                 data = client_socket.recv(1024)
                 if not data:
                     break
-                buffer += data.decode('utf-8')
 
-                if '\n' in buffer:
-                    message, buffer = buffer.split('\n', 1)
-                    message = message.strip()
-                    self.log(f"Received command: {message}", client_address)
+                # Run every complete line in the order it was sent
+                for message in session.read_lines(data):
+                    response = self.process_message(message, client_address, session)
+                    if response is not None:
+                        self.send_response(session, response)
 
-                    start_time = time.time()
+                    if message == "/logoff":
+                        logged_off = True
+                        break
 
-                    with self.lock:
-                        self.total_messages += 1
+        except (ConnectionResetError, BrokenPipeError, KeyboardInterrupt):
+            self.log(f"Connection with {client_address} was interrupted.", client_address)
+        except Exception as e:
+            self.log(f"Unexpected error with {client_address}: {e}", client_address)
+        finally:
+            self.pacer.close(session)
+            with self.lock:
+                self.sessions.discard(session)
+                self.client_count -= 1
+            session.close_cursor()
+            self.log(f"Connection with {client_address} closed.", client_address)
 
-                    if message.startswith("/"):
-                        with self.lock:
-                            self.total_commands += 1
+    async def handle_client_async(self, reader, writer):
+        """Handle a client connection on the asyncio engine."""
+        client_address = writer.get_extra_info('peername')
+        with self.lock:
+            self.client_count += 1
+            self.total_clients += 1
+        self.log(f"Accepted connection from {client_address}", client_address)
+        self.writers.add(writer)
+        session = ClientSession(writer, client_address)
+        with self.lock:
+            self.sessions.add(session)
+        loop = asyncio.get_running_loop()
 
-                        response = self.handle_command(message, client_address)
-                    else:
-                        response = message
+        try:
+            # Send welcome message and help message to the client
+            writer.write(f"\n{COLOR_GREEN}Welcome to the Telnet server! Version: {version}{COLOR_RESET}\r\n".encode('utf-8'))
+            writer.write(self.show_help().encode('utf-8') + b'\r\n')
+            await writer.drain()
 
-                    response_time = time.time() - start_time
-                    response += f"\n{COLOR_CYAN}Response time: {response_time:.4f} seconds{COLOR_RESET}"
+            logged_off = False
+            while self.running and not logged_off:
+                data = await reader.read(1024)
+                if not data:
+                    break
 
-                    clear_lines = "\n\n"
-                    self.send_response(client_socket, clear_lines + response)
+                # Run every complete line in the order it was sent
+                for message in session.read_lines(data):
+                    # Searches would block the event loop, run them on a worker thread.
+                    # The lines of a /batch are only collected, /end starts them as a stream.
+                    if session.batch is None and message.split(" ", 1)[0].lower() in BLOCKING_COMMANDS:
+                        response = await loop.run_in_executor(None, self.process_message, message, client_address, session)
+                    else:
+                        response = self.process_message(message, client_address, session)
+                    if response is not None:
+                        await self.send_response_async(session, response)
 
                     if message == "/logoff":
+                        logged_off = True
                         break
 
-        except (ConnectionResetError, BrokenPipeError, KeyboardInterrupt):
+        except (ConnectionResetError, BrokenPipeError):
             self.log(f"Connection with {client_address} was interrupted.", client_address)
         except Exception as e:
             self.log(f"Unexpected error with {client_address}: {e}", client_address)
         finally:
-            client_socket.close()
+            self.writers.discard(writer)
+            writer.close()
             with self.lock:
+                self.sessions.discard(session)
                 self.client_count -= 1
+            session.close_cursor()
             self.log(f"Connection with {client_address} closed.", client_address)
 
-    def send_response(self, client_socket, response):
-        """Send response to the client with optional delay for the first few lines."""
-        lines = response.split('\r\n')
-        for i, line in enumerate(lines):
-            if i < self.delay_lines:
-                client_socket.sendall((line + '\r\n').encode('utf-8'))
-                time.sleep(self.delay)
-            else:
-                client_socket.sendall((line + '\r\n').encode('utf-8'))
+    def process_message(self, message, client_address, session=None):
+        """Run one line received from a client and return the response to send back, None for no response."""
+        self.log(f"Received command: {message}", client_address)
+
+        start_time = time.time()
+        start_counter = time.perf_counter()
+
+        with self.lock:
+            self.total_messages += 1
+
+        self.expire_cursors()
+
+        if session is not None and session.batch is not None and message.lower() != "/logoff":
+            # Lines of a /batch are collected until /end runs them
+            response = self.collect_batch(message, client_address, session)
+            if response is None:
+                return None
+            command = "/batch"
+        elif message.startswith("/"):
+            with self.lock:
+                self.total_commands += 1
+
+            command = message.split(" ", 1)[0].lower()
+            if command not in COMMANDS:
+                command = "unknown"
+            response = self.handle_command(message, client_address, session)
+        else:
+            command = "message"
+            response = message
+
+        output = session.output if session is not None else 'ansi'
+        if output != 'ansi':
+            if isinstance(response, str):
+                self.metrics.observe_command(command, time.perf_counter() - start_counter)
+                return (output_format.encode_text(output, response) +
+                        output_format.encode_response_time(output, time.time() - start_time))
+            return self.stream_records(response, output, start_time, command, start_counter)
+
+        clear_lines = "\n\n"
+        if isinstance(response, str):
+            self.metrics.observe_command(command, time.perf_counter() - start_counter)
+            response += f"\n{self.response_time(start_time)}"
+            return clear_lines + response
+        return self.stream_response(response, clear_lines, start_time, command, start_counter)
+
+    def stream_response(self, chunks, clear_lines, start_time, command, start_counter):
+        """Pass a streamed response on, adding the clear lines and the response time."""
+        try:
+            for i, chunk in enumerate(chunks):
+                yield clear_lines + chunk if i == 0 else chunk
+        finally:
+            chunks.close()
+        self.metrics.observe_command(command, time.perf_counter() - start_counter)
+        yield self.response_time(start_time)
 
-    def handle_command(self, command, client_address):
+    def stream_records(self, chunks, output, start_time, command, start_counter):
+        """Pass a streamed response on as /format records, ending with the response time."""
+        try:
+            for chunk in chunks:
+                yield chunk if isinstance(chunk, bytes) else output_format.encode_text(output, chunk)
+        finally:
+            chunks.close()
+        self.metrics.observe_command(command, time.perf_counter() - start_counter)
+        yield output_format.encode_response_time(output, time.time() - start_time)
+
+    def response_time(self, start_time):
+        """Return the response time line for a command started at start_time."""
+        response_time = time.time() - start_time
+        return f"{COLOR_CYAN}Response time: {response_time:.4f} seconds{COLOR_RESET}"
+
+    def send_response(self, session, response):
+        """Queue response for the client with optional delay for the first few lines.
+
+        A response is either a string or, for streamed results, an iterator of
+        strings that are sent as soon as they are produced. Records of
+        /format json and plain come as bytes and are queued as they are.
+        """
+        single = isinstance(response, (str, bytes))
+        chunks = [response] if single else response
+        delay = self.delay if session.paced else 0
+        line_count = 0
+        try:
+            for chunk in chunks:
+                if isinstance(chunk, bytes):
+                    self.pacer.write(session, chunk)
+                    continue
+                # Only the lines still to be typed out are split off, the rest goes out as it is
+                typed = self.delay_lines - line_count if delay else 0
+                lines = chunk.split('\r\n', typed) if typed > 0 else [chunk]
+                # Type out the first lines one by one, the rest goes out in one write
+                while lines and delay and line_count < self.delay_lines:
+                    self.pacer.write(session, (lines.pop(0) + '\r\n').encode('utf-8'), delay)
+                    line_count += 1
+                if lines:
+                    self.pacer.write(session, ''.join(line + '\r\n' for line in lines).encode('utf-8'))
+                    line_count += len(lines)
+        finally:
+            if not single:
+                response.close()
+
+    async def send_response_async(self, session, response):
+        """Send response to an asyncio client with optional delay for the first few lines."""
+        writer = session.connection
+        delay = self.delay if session.paced else 0
+        line_count = 0
+        send_seconds = 0.0
+        async with contextlib.aclosing(self.response_chunks(response)) as chunks:
+            async for chunk in chunks:
+                start = time.perf_counter()
+                if isinstance(chunk, bytes):
+                    writer.write(chunk)
+                    await writer.drain()
+                    send_seconds += time.perf_counter() - start
+                    continue
+                typed = self.delay_lines - line_count if delay else 0
+                lines = chunk.split('\r\n', typed) if typed > 0 else [chunk]
+                while lines and delay and line_count < self.delay_lines:
+                    writer.write((lines.pop(0) + '\r\n').encode('utf-8'))
+                    await writer.drain()
+                    await asyncio.sleep(delay)
+                    line_count += 1
+                if lines:
+                    writer.write(''.join(line + '\r\n' for line in lines).encode('utf-8'))
+                    line_count += len(lines)
+                    await writer.drain()
+                send_seconds += time.perf_counter() - start
+        self.metrics.observe_stage('send', send_seconds)
+
+    async def response_chunks(self, response):
+        """Yield the chunks of a response, producing streamed results on a worker thread."""
+        if isinstance(response, (str, bytes)):
+            yield response
+            return
+        loop = asyncio.get_running_loop()
+        try:
+            while True:
+                chunk = await loop.run_in_executor(None, next, response, None)
+                if chunk is None:
+                    break
+                yield chunk
+        finally:
+            response.close()
+
+    def handle_command(self, command, client_address, session=None):
         """Handle commands received from the client."""
         parts = command.split(" ", 1)
         cmd = parts[0].lower()
@@ -190,14 +760,47 @@ class TelnetServer:
         elif cmd == "/search":
             if len(parts) > 1:
                 args = self.parse_search_args(parts[1])
-                if len(args) > 2:
-                    return self.invalid_command("Usage: /search \"<keyword1>\" [\"<keyword2>\"]")
+                if len(args) > self.max_keywords:
+                    return self.invalid_command(f"Usage: /search \"<keyword1>\" [\"<keyword2>\" ...] (at most {self.max_keywords} keywords)")
                 with self.lock:
                     self.search_count += 1
                 self.log(f"Search command with keywords: {args}", client_address)
-                return self.search_files(args)
+                return self.stream_search(args, session)
             else:
-                return self.invalid_command("Usage: /search \"<keyword1>\" [\"<keyword2>\"]")
+                return self.invalid_command(f"Usage: /search \"<keyword1>\" [\"<keyword2>\" ...] (at most {self.max_keywords} keywords)")
+
+        elif cmd == "/rank":
+            if len(parts) > 1:
+                args = self.parse_search_args(parts[1])
+                if len(args) > self.max_keywords:
+                    return self.invalid_command(f"Usage: /rank \"<keyword1>\" [\"<keyword2>\" ...] (at most {self.max_keywords} keywords)")
+                with self.lock:
+                    self.rank_count += 1
+                self.log(f"Ranked search command with keywords: {args}", client_address)
+                return self.rank_search(args, session)
+            else:
+                return self.invalid_command(f"Usage: /rank \"<keyword1>\" [\"<keyword2>\" ...] (at most {self.max_keywords} keywords)")
+
+        elif cmd == "/regex":
+            if len(parts) > 1 and parts[1].strip():
+                pattern = parts[1].strip()
+                try:
+                    regex = re.compile(pattern, re.IGNORECASE)
+                except re.error as e:
+                    return self.invalid_command(f"Invalid regular expression: {e}")
+                problem = trigram.regex_problem(pattern)
+                if problem:
+                    return self.invalid_command(problem)
+                if not self.search_service.use_index:
+                    return self.invalid_command("/regex needs the search index, the server runs with --no_index.")
+                if not self.search_service.regex_ready():
+                    return self.invalid_command("The search index is still being built, try /regex again in a moment.")
+                with self.lock:
+                    self.regex_count += 1
+                self.log(f"Regex search command with pattern: {pattern}", client_address)
+                return self.regex_search(regex, session)
+            else:
+                return self.invalid_command("Usage: /regex <pattern>")
 
         elif cmd == "/videosearch":
             if len(parts) > 1:
@@ -205,16 +808,49 @@ class TelnetServer:
                 with self.lock:
                     self.videosearch_count += 1
                 self.log(f"Video search command with keyword: {keyword}", client_address)
-                return self.search_videos(keyword)
+                return self.search_videos(keyword, session)
             else:
                 return self.invalid_command("Usage: /videosearch <keyword>")
 
+        elif cmd == "/more":
+            return self.show_page(session)
+
+        elif cmd == "/page":
+            try:
+                number = int(parts[1]) if len(parts) > 1 else 0
+            except ValueError:
+                number = 0
+            if number < 1:
+                return self.invalid_command("Usage: /page <number>")
+            return self.show_page(session, number)
+
+        elif cmd == "/batch":
+            if session is None or not session.pageable:
+                return self.invalid_command("/batch can't be used here.")
+            session.batch = []
+            return f"{COLOR_YELLOW}Send up to {self.max_batch} searches, one per line, then /end to run them.{COLOR_RESET}"
+
         elif cmd == "/logoff":
             return f"{COLOR_YELLOW}Logging off...{COLOR_RESET}"
 
         elif cmd == "/stats":
             return self.get_stats()
 
+        elif cmd == "/metrics":
+            return self.get_metrics()
+
+        elif cmd == "/pace":
+            if session is None or len(parts) < 2 or parts[1].strip().lower() not in ("on", "off"):
+                return self.invalid_command("Usage: /pace on|off")
+            session.pacing = parts[1].strip().lower() == "on"
+            return f"{COLOR_YELLOW}Output pacing {'on' if session.pacing else 'off'}.{COLOR_RESET}"
+
+        elif cmd == "/format":
+            if session is None or len(parts) < 2 or parts[1].strip().lower() not in output_format.FORMATS:
+                return self.invalid_command(f"Usage: /format {'|'.join(output_format.FORMATS)}")
+            session.output = parts[1].strip().lower()
+            return f"{COLOR_YELLOW}Output format {session.output}.{COLOR_RESET}"
+
         elif cmd == "/uptime":
             return self.get_uptime()
 
@@ -232,113 +868,302 @@ class TelnetServer:
             f"{COLOR_BLUE}{'Command':<15} {'Description'}{COLOR_RESET}\r\n"
             f"{'-'*40}\r\n"
             f"{COLOR_BLUE}/help{COLOR_RESET:<15} Show this help message\r\n"
-            f"{COLOR_BLUE}/search \"<keyword1>\" [\"<keyword2>\"]{COLOR_RESET:<15} Search files for up to two keywords (both must be present)\r\n"
+            f"{COLOR_BLUE}/search \"<keyword1>\" [\"<keyword2>\" ...]{COLOR_RESET:<15} Search files for up to {self.max_keywords} keywords (all must be present)\r\n"
+            f"{COLOR_BLUE}/rank \"<keyword1>\" [\"<keyword2>\" ...]{COLOR_RESET:<15} Show the {self.max_results} best matching lines, ranked by relevance\r\n"
+            f"{COLOR_BLUE}/regex <pattern>{COLOR_RESET:<15} Search files for lines matching a regular expression (ignoring case)\r\n"
             f"{COLOR_BLUE}/videosearch <keyword>{COLOR_RESET:<15} Search for lines containing the keyword in videos.txt\r\n"
+            f"{COLOR_BLUE}/more{COLOR_RESET:<15} Show the next page of results of the last search\r\n"
+            f"{COLOR_BLUE}/page <number>{COLOR_RESET:<15} Show a page of results of the last search\r\n"
+            f"{COLOR_BLUE}/batch{COLOR_RESET:<15} Run the searches on the following lines up to /end at once, showing their first pages in order\r\n"
             f"{COLOR_BLUE}/logoff{COLOR_RESET:<15} Log off from the server\r\n"
             f"{COLOR_BLUE}/stats{COLOR_RESET:<15} Show server statistics\r\n"
+            f"{COLOR_BLUE}/metrics{COLOR_RESET:<15} Show counters and latency histograms in Prometheus text format\r\n"
+            f"{COLOR_BLUE}/pace on|off{COLOR_RESET:<15} Type out responses line by line or send them at once\r\n"
+            f"{COLOR_BLUE}/format ansi|plain|json{COLOR_RESET:<15} Show results in color, or as tab separated or JSON lines for scripts\r\n"
             f"{COLOR_BLUE}/uptime{COLOR_RESET:<15} Show server uptime and start time"
         )
         return help_text
 
-    def paginate_response(self, header, lines, page_size=25):
-        """Paginate long responses for better readability."""
-        paginated_response = []
-        for i in range(0, len(lines), page_size):
-            page = lines[i:i + page_size]
-            paginated_response.append(header + "\r\n" + "\r\n".join(page))
-        return "\r\n".join(paginated_response)
-
     def parse_search_args(self, args_str):
         """Parse search arguments enclosed in double quotes."""
         return re.findall(r'"(.*?)"', args_str)
 
-    def search_files(self, keywords):
-        """Search files for the given keywords and return the results."""
+    def stream_search(self, keywords, session=None):
+        """Search files for the given keywords and yield the first page of results in chunks as matches come in.
+
+        The search is kept open on the session, /more and /page read on from
+        where the first page stopped.
+        """
+        keywords = [keyword.lower().strip() for keyword in keywords]
+        header = (
+            f"{COLOR_GREEN}Files containing the keywords '{' and '.join(keywords)}':{COLOR_RESET}\r\n"
+            f"{COLOR_GREEN}{'No.':<5} {'File':<43} {'Location':<10} {'Content'}{COLOR_RESET}\r\n"
+            f"{'-'*100}"
+        )
+        if self.shard_coordinator:
+            # Admitted here like any search and queued for the same client on the shards
+            client = self.client_name(session)
+            source = self.search_service.scheduled_search(lambda ticket: self.shard_coordinator.search(keywords, client), client)
+        else:
+            source = self.search_service.search(keywords, self.client_name(session))
+        cursor = ResultCursor(header, self.format_search_row, source=source,
+                              limit=self.max_results, page_size=self.page_size, max_bytes=self.cursor_bytes)
+        empty = f"{COLOR_RED}No files found containing the keywords '{' and '.join(keywords)}'.{COLOR_RESET}"
+        return self.open_cursor(session, cursor, empty)
+
+    def client_name(self, session):
+        """Return who the scheduler queues a session's searches for, its client host."""
+        return session.client_address[0] if session is not None and session.client_address else None
+
+    def format_search_row(self, number, match):
+        file, location, line = match
+        return f"{number}. {COLOR_BLUE}{file:<43} {COLOR_YELLOW}{location:<10} {COLOR_RESET}{line}"
+
+    def regex_search(self, regex, session=None):
+        """Search files for lines matching the compiled regex and yield the first page of results as matches come in."""
+        header = (
+            f"{COLOR_GREEN}Files with lines matching '{regex.pattern}':{COLOR_RESET}\r\n"
+            f"{COLOR_GREEN}{'No.':<5} {'File':<43} {'Location':<10} {'Content'}{COLOR_RESET}\r\n"
+            f"{'-'*100}"
+        )
+        cursor = ResultCursor(header, self.format_search_row, source=self.search_service.regex_search(regex, self.client_name(session)),
+                              limit=self.max_results, page_size=self.page_size, max_bytes=self.cursor_bytes)
+        empty = f"{COLOR_RED}No lines found matching '{regex.pattern}'.{COLOR_RESET}"
+        return self.open_cursor(session, cursor, empty)
+
+    def rank_search(self, keywords, session=None):
+        """Search files for the given keywords and return the first page of the best matches, best first."""
         keywords = [keyword.lower().strip() for keyword in keywords]
-        matching_files = []
-        tasks = []
-
-        for root, dirs, files in os.walk(self.files_dir):
-            for file in files:
-                file_path = os.path.join(root, file).replace(self.files_dir, "")
-                if file.lower().endswith('.pdf'):
-                    tasks.append(self.executor.submit(self.search_pdf, file_path, keywords))
+        try:
+            seen, ranked = self.search_service.ranked_search(keywords, client=self.client_name(session))
+        except SchedulerError as e:
+            return self.invalid_command(str(e))
+        header = (
+            f"{COLOR_GREEN}Best {len(ranked)} of {seen} lines containing the keywords '{' and '.join(keywords)}':{COLOR_RESET}\r\n"
+            f"{COLOR_GREEN}{'No.':<5} {'File':<43} {'Location':<10} {'Score':<7} {'Content'}{COLOR_RESET}\r\n"
+            f"{'-'*100}"
+        )
+        cursor = ResultCursor(header, self.format_ranked_row, matches=ranked, page_size=self.page_size,
+                              max_bytes=self.cursor_bytes, fields=RANKED_FIELDS)
+        empty = f"{COLOR_RED}No files found containing the keywords '{' and '.join(keywords)}'.{COLOR_RESET}"
+        return self.open_cursor(session, cursor, empty)
+
+    def format_ranked_row(self, number, match):
+        score, file, location, line = match
+        return f"{number}. {COLOR_BLUE}{file:<43} {COLOR_YELLOW}{location:<10} {COLOR_CYAN}{score:<7.2f} {COLOR_RESET}{line}"
+
+    def open_cursor(self, session, cursor, empty):
+        """Make cursor the session's current results and return its first page."""
+        if session is not None:
+            session.close_cursor()
+            session.cursor = cursor
+        return self.stream_page(session, cursor, 1, empty)
+
+    def stream_page(self, session, cursor, number, empty=None):
+        """Yield a page of the cursor in chunks as its matches come in, followed by where it is in the results."""
+        output = session.output if session is not None else 'ansi'
+        with cursor.lock:
+            shown = False
+            try:
+                for rows in cursor.iter_page(number, output):
+                    shown = True
+                    yield rows if output != 'ansi' else "\r\n".join(rows)
+                cursor.current_page = number
+                if session is not None and session.pageable:
+                    # The search holds its slot until its matches are read, read them now
+                    # instead of when the next page is asked for, if ever
+                    cursor.read_all()
+            finally:
+                self.metrics.observe_stage('format', cursor.format_seconds)
+                cursor.format_seconds = 0.0
+                if session is None or not session.pageable:
+                    # Without a session nobody can ask for the next page
+                    cursor.close()
+
+            if not shown:
+                if cursor.available == 0 and (empty is not None or cursor.error):
+                    if session is not None and session.cursor is cursor:
+                        session.cursor = None
+                    if cursor.error:
+                        yield self.invalid_command(cursor.error)
+                    elif output != 'ansi':
+                        # Scripts get an empty page, not a message to parse
+                        yield output_format.encode_page(output, {
+                            'page': 1, 'pages': 1, 'results': 0, 'more': False, 'truncated': False, 'error': None,
+                        })
+                    else:
+                        yield empty
+                elif cursor.error:
+                    yield self.invalid_command(f"{cursor.error} The results have {cursor.page_count()} pages.")
                 else:
-                    tasks.append(self.executor.submit(self.search_text_file, file_path, keywords))
+                    yield self.invalid_command(f"There is no page {number}, the results have {cursor.page_count()} pages.")
+                return
+
+            pages = cursor.page_count()
+            pageable = session is not None and session.pageable
+            if output != 'ansi':
+                # Only a session that can ask for the next page has more to come
+                yield output_format.encode_page(output, {
+                    'page': number, 'pages': pages, 'results': cursor.available,
+                    'more': pageable and (not cursor.exhausted or number < pages),
+                    'truncated': cursor.truncated,
+                    'error': cursor.error,
+                })
+                return
+            more = ", type /more for the next page." if pageable else ", there are more results."
+            if not cursor.exhausted:
+                footer = f"{COLOR_CYAN}Page {number}{more}{COLOR_RESET}"
+            elif number < pages:
+                footer = f"{COLOR_CYAN}Page {number} of {pages} ({cursor.available} results){more}{COLOR_RESET}"
+            else:
+                footer = f"{COLOR_CYAN}Page {number} of {pages} ({cursor.available} results).{COLOR_RESET}"
+                if cursor.truncated:
+                    footer = f"{COLOR_RED}Too many search results found. Stopping search.{COLOR_RESET}\r\n{footer}"
+                elif cursor.error:
+                    footer = f"{COLOR_RED}{cursor.error} The results are incomplete.{COLOR_RESET}\r\n{footer}"
+            yield footer
+
+    def show_page(self, session, number=None):
+        """Return the next page, or page number, of the session's last search."""
+        cursor = session.cursor if session is not None else None
+        if cursor is not None and time.monotonic() - cursor.last_used > self.cursor_timeout:
+            self.expire_cursor(session, cursor)
+            cursor = None
+        if cursor is None:
+            return self.invalid_command("No search results to page through, run /search or /videosearch first.")
+        if number is None:
+            number = cursor.current_page + 1
+        start = (number - 1) * cursor.page_size
+        if start < cursor.offset:
+            return self.invalid_command(f"Page {number} is no longer kept, run the search again to see it.")
+        if cursor.exhausted and start >= cursor.available:
+            return self.invalid_command(f"There is no page {number}, the results have {cursor.page_count()} pages.")
+        return self.stream_page(session, cursor, number)
 
-        for future in tasks:
+    def expire_cursor(self, session, cursor, blocking=True):
+        """Drop the results of the session's last search unless the session is reading them right now."""
+        if not cursor.lock.acquire(blocking=blocking):
+            return
+        try:
+            if session.cursor is cursor:
+                session.cursor = None
+            cursor.close()
+        finally:
+            cursor.lock.release()
+
+    def expire_cursors(self):
+        """Drop the search results of sessions that haven't paged through them for cursor_timeout seconds."""
+        now = time.monotonic()
+        if now - self.last_cursor_sweep < 1.0:
+            return
+        self.last_cursor_sweep = now
+        with self.lock:
+            sessions = list(self.sessions)
+        for session in sessions:
+            cursor = session.cursor
+            if cursor is not None and now - cursor.last_used > self.cursor_timeout:
+                self.expire_cursor(session, cursor, blocking=False)
+
+    def collect_batch(self, message, client_address, session):
+        """Add a line to the session's /batch, return the responses of the batch at /end and None before."""
+        if message.lower() != "/end":
+            # One past the limit is enough to tell the batch is too long
+            if len(session.batch) <= self.max_batch:
+                session.batch.append(message)
+            return None
+        commands, session.batch = session.batch, None
+        if not commands:
+            return self.invalid_command("The batch is empty.")
+        if len(commands) > self.max_batch:
+            return self.invalid_command(f"A batch may have at most {self.max_batch} searches.")
+        with self.lock:
+            self.batch_count += 1
+        self.log(f"Batch of {len(commands)} searches", client_address)
+        return self.run_batch(commands, client_address, session.output)
+
+    def run_batch(self, commands, client_address, output='ansi'):
+        """Run the searches of a /batch on the batch threads and yield their responses in the order they were sent.
+
+        Up to batch_window searches run at a time. A response is sent as soon
+        as it and all before it are done, while the searches after it go on.
+        """
+        pending = iter(enumerate(commands, 1))
+        running = deque()
+
+        def submit():
+            for number, command in itertools.islice(pending, 1):
+                running.append((number, command, self.batch_executor.submit(self.run_batch_command, command, client_address, output)))
+
+        try:
+            for _ in range(self.batch_window):
+                submit()
+            while running:
+                number, command, future = running.popleft()
+                try:
+                    response = future.result()
+                except Exception as e:
+                    self.log(f"Error during batch search {command}: {e}", client_address)
+                    response = self.invalid_command(f"The search failed: {e}")
+                submit()
+                if output == 'ansi':
+                    yield f"{COLOR_BLUE}[{number}/{len(commands)}] {command}{COLOR_RESET}\r\n{response}"
+                    continue
+                if output == 'json':
+                    yield output_format.encode_record({'batch': number, 'of': len(commands), 'command': command})
+                else:
+                    yield output_format.encode_text(output, f"[{number}/{len(commands)}] {command}")
+                yield response if isinstance(response, bytes) else output_format.encode_text(output, response)
+        finally:
+            # The client is gone, don't start the searches that haven't begun
+            for number, command, future in running:
+                future.cancel()
+
+    def run_batch_command(self, command, client_address, output='ansi'):
+        """Run one search of a /batch and return its first page of results, as bytes in a /format other than ansi."""
+        start_counter = time.perf_counter()
+        cmd = command.split(" ", 1)[0].lower()
+        if cmd not in BATCH_COMMANDS:
+            return self.invalid_command(f"Only {', '.join(sorted(BATCH_COMMANDS))} can be part of a batch.")
+        with self.lock:
+            self.total_commands += 1
+        # The search is queued for the client like any other, but its results can't be paged through
+        session = ClientSession(None, client_address)
+        session.output = output
+        try:
+            response = self.handle_command(command, client_address, session)
+            chunks = [response] if isinstance(response, str) else response
             try:
-                matches = future.result()
-                for match in matches:
-                    if len(match) == 3:
-                        matching_files.append(match)
-            except Exception as e:
-                self.log(f"Error during search: {e}")
-
-            if len(matching_files) > self.max_results:
-                return f"{COLOR_RED}Too many search results found. Stopping search.{COLOR_RESET}"
-
-        if matching_files:
-            header = (
-                f"{COLOR_GREEN}Files containing the keywords '{' and '.join(keywords)}':{COLOR_RESET}\r\n"
-                f"{COLOR_GREEN}{'No.':<5} {'File':<43} {'Location':<10} {'Content'}{COLOR_RESET}\r\n"
-                f"{'-'*100}"
-            )
-            results = [f"{i + 1}. {COLOR_BLUE}{file:<43} {COLOR_YELLOW}{location:<10} {COLOR_RESET}{line}" for i, (file, location, line) in enumerate(matching_files)]
-            return self.paginate_response(header, results)
-        else:
-            return f"{COLOR_RED}No files found containing the keywords '{' and '.join(keywords)}'.{COLOR_RESET}"
-
-    def search_text_file(self, file_path, keywords):
-        """Search text files for the given keywords."""
-        matches = []
-        full_path = os.path.join(self.files_dir, file_path)
-        with open(full_path, 'r', errors='ignore') as f:
-            content = f.read().lower()
-            if all(keyword in re.sub(r'\s+', ' ', content) for keyword in keywords):
-                for line_number, line in enumerate(content.splitlines(), 1):
-                    if all(keyword in re.sub(r'\s+', ' ', line) for keyword in keywords):
-                        matches.append((file_path, f"Line {line_number}", line.strip()))
-        return matches
-
-    def search_pdf(self, file_path, keywords):
-        """Search PDF files for the given keywords and return the results."""
-        matches = []
-        full_path = os.path.join(self.files_dir, file_path)
-        with open(full_path, 'rb') as file:
-            reader = PyPDF2.PdfReader(file)
-            for page_number, page in enumerate(reader.pages, 1):
-                text = page.extract_text()
-                if text:
-                    normalized_text = re.sub(r'\s+', ' ', text.lower())
-                    if all(keyword in normalized_text for keyword in keywords):
-                        for line_number, line in enumerate(text.split('\n'), 1):
-                            normalized_line = re.sub(r'\s+', ' ', line.lower()).strip()
-                            if all(keyword in normalized_line for keyword in keywords):
-                                cleaned_line = line.replace("/bulletmed", "").strip()
-                                matches.append((file_path, f"Page {page_number}", cleaned_line))
-        return matches
-
-    def search_videos(self, keyword):
-        """Search videos.txt for the given keyword and return the results."""
-        matching_lines = []
+                if output == 'ansi':
+                    response = "\r\n".join(chunks)
+                else:
+                    response = b"".join(chunk if isinstance(chunk, bytes) else output_format.encode_text(output, chunk)
+                                        for chunk in chunks)
+            finally:
+                if not isinstance(chunks, list):
+                    chunks.close()
+        finally:
+            session.close_cursor()
+        self.metrics.observe_command(cmd, time.perf_counter() - start_counter)
+        return response
+
+    def search_videos(self, keyword, session=None):
+        """Search the videos catalog for the given keyword and return the first page of results."""
         keyword = keyword.lower()
-        if os.path.exists('videos.txt'):
-            with open('videos.txt', 'r', errors='ignore') as f:
-                for line_number, line in enumerate(f, 1):
-                    if keyword in line.lower():
-                        matching_lines.append(f"{line_number:<5} {line.strip()}")
-
-        if matching_lines:
-            header = (
-                f"{COLOR_GREEN}Lines containing the keyword '{keyword}' in videos.txt:{COLOR_RESET}\r\n"
-                f"{COLOR_GREEN}{'Location':<10} {'Content':<50}{COLOR_RESET}\r\n"
-                f"{'-'*55}"
-            )
-            results = [f"{COLOR_YELLOW}{line}" for line in matching_lines]
-            return self.paginate_response(header, results)
-        else:
-            return f"{COLOR_RED}No lines found containing the keyword '{keyword}' in videos.txt.{COLOR_RESET}"
+        matching_lines = self.search_service.search_videos(keyword)
+
+        header = (
+            f"{COLOR_GREEN}Lines containing the keyword '{keyword}' in {self.search_service.videos_file}:{COLOR_RESET}\r\n"
+            f"{COLOR_GREEN}{'Location':<10} {'Content':<50}{COLOR_RESET}\r\n"
+            f"{'-'*55}"
+        )
+        cursor = ResultCursor(header, self.format_video_row, matches=matching_lines,
+                              page_size=self.page_size, max_bytes=self.cursor_bytes, fields=VIDEO_FIELDS)
+        empty = f"{COLOR_RED}No lines found containing the keyword '{keyword}' in {self.search_service.videos_file}.{COLOR_RESET}"
+        return self.open_cursor(session, cursor, empty)
+
+    def format_video_row(self, number, match):
+        line_number, line = match
+        return f"{COLOR_YELLOW}{line_number:<5} {line}"
 
     def get_uptime(self):
         """Return server uptime information."""
@@ -358,6 +1183,12 @@ class TelnetServer:
             uptime_stats = self.get_uptime().split('\r\n')[2:]
             uptime_stats_text = "\r\n".join(uptime_stats)
 
+            search_rows = self.search_service.stats()
+            if self.shard_coordinator:
+                search_rows = self.shard_coordinator.stats() + search_rows
+            search_stats = "".join(f"{COLOR_GREEN}{label:<25} {value:<10}{COLOR_RESET}\r\n"
+                                   for label, value in search_rows)
+
             stats_text = (
                 f"{COLOR_BLUE}Server Statistics (Version {version}):{COLOR_RESET}\r\n"
                 f"{COLOR_GREEN}{'Metric':<25} {'Value':<10}{COLOR_RESET}\r\n"
@@ -366,19 +1197,53 @@ class TelnetServer:
                 f"{COLOR_GREEN}{'Total Clients':<25} {self.total_clients:<10}{COLOR_RESET}\r\n"
                 f"{COLOR_GREEN}{'Total Messages':<25} {self.total_messages:<10}{COLOR_RESET}\r\n"
                 f"{COLOR_GREEN}{'Search Commands':<25} {self.search_count:<10}{COLOR_RESET}\r\n"
+                f"{COLOR_GREEN}{'Ranked Search Commands':<25} {self.rank_count:<10}{COLOR_RESET}\r\n"
+                f"{COLOR_GREEN}{'Regex Search Commands':<25} {self.regex_count:<10}{COLOR_RESET}\r\n"
                 f"{COLOR_GREEN}{'Video Search Commands':<25} {self.videosearch_count:<10}{COLOR_RESET}\r\n"
+                f"{COLOR_GREEN}{'Batch Commands':<25} {self.batch_count:<10}{COLOR_RESET}\r\n"
                 f"{COLOR_GREEN}{'Total Commands':<25} {self.total_commands:<10}{COLOR_RESET}\r\n"
+                f"{COLOR_GREEN}{'Log Lines Dropped':<25} {self.log_writer.total_dropped:<10}{COLOR_RESET}\r\n"
+                f"{COLOR_GREEN}{'Open Result Cursors':<25} {sum(session.cursor is not None for session in self.sessions):<10}{COLOR_RESET}\r\n"
+                f"{search_stats}"
                 f"{uptime_stats_text}"
             )
             return stats_text
 
+    def get_metrics(self):
+        """Return the server counters and latency histograms in Prometheus text format."""
+        with self.lock:
+            counters = [
+                ('clients_total', 'Clients that connected', self.total_clients),
+                ('messages_total', 'Lines received from clients', self.total_messages),
+                ('commands_total', 'Commands received from clients', self.total_commands),
+                ('search_commands_total', 'Search commands', self.search_count),
+                ('rank_commands_total', 'Ranked search commands', self.rank_count),
+                ('regex_commands_total', 'Regex search commands', self.regex_count),
+                ('videosearch_commands_total', 'Video search commands', self.videosearch_count),
+                ('batch_commands_total', 'Batches of searches run', self.batch_count),
+                ('log_lines_dropped_total', 'Log lines dropped because the log queue was full', self.log_writer.total_dropped),
+            ]
+            if self.shard_coordinator:
+                counters += self.shard_coordinator.counters()
+            gauges = [
+                ('clients', 'Clients currently connected', self.client_count),
+                ('uptime_seconds', 'Seconds since the server started', round(time.time() - self.start_time, 3)),
+            ]
+        return self.search_service.metrics_text(counters, gauges)
+
     def start(self):
         """Start the Telnet server and handle incoming connections."""
+        if self.engine == 'asyncio':
+            asyncio.run(self.serve_asyncio())
+            return
+
         try:
             while self.running:
                 try:
                     client_socket, client_address = self.server_socket.accept()
                     client_thread = threading.Thread(target=self.handle_client, args=(client_socket, client_address))
+                    # Forget threads of clients that have logged off
+                    self.threads = [thread for thread in self.threads if thread.is_alive()]
                     self.threads.append(client_thread)
                     client_thread.start()
                 except OSError:
@@ -388,15 +1253,49 @@ class TelnetServer:
         finally:
             self.server_socket.close()
 
+    async def serve_asyncio(self):
+        """Serve all clients from one event loop until SIGINT."""
+        loop = asyncio.get_running_loop()
+        stop = asyncio.Event()
+        loop.add_signal_handler(signal.SIGINT, stop.set)
+
+        server = await asyncio.start_server(self.handle_client_async, sock=self.server_socket, backlog=self.backlog)
+        await stop.wait()
+
+        # Stop accepting, hang up on connected clients, then shut down as usual
+        server.close()
+        for writer in list(self.writers):
+            writer.close()
+        await asyncio.sleep(0)
+        self.handle_sigint(signal.SIGINT, None)
+
 if __name__ == '__main__':
     parser = argparse.ArgumentParser(description='Start a Telnet server.')
     parser.add_argument('--port', type=int, default=8023, help='Port to run the Telnet server on')
     parser.add_argument('--delay', type=float, default=0.05, help='Delay in seconds between lines for short responses')
     parser.add_argument('--delay_lines', type=int, default=25, help='Number of lines to apply the delay to')
-    parser.add_argument('--files_dir', type=str, default='FILES/', help='Directory to search files in')
-    parser.add_argument('--max_results', type=int, default=30, help='Maximum number of search results before stopping the search')
+    add_search_arguments(parser)
+    parser.add_argument('--engine', choices=['threads', 'asyncio'], default='threads', help='Serve clients with a thread each or from one asyncio event loop')
+    parser.add_argument('--backlog', type=int, default=128, help='Listen backlog for incoming connections')
+    parser.add_argument('--max_keywords', type=int, default=8, help='Maximum number of quoted keywords in a /search')
+    parser.add_argument('--page_size', type=int, default=25, help='Results shown per page, /more shows the next page')
+    parser.add_argument('--cursor_timeout', type=float, default=300.0, help='Seconds the results of a search are kept for /more after it was last used')
+    parser.add_argument('--cursor_kb', type=int, default=256, help='Memory in KB a session may keep search results in for /more')
+    parser.add_argument('--max_batch', type=int, default=100, help='Maximum number of searches in a /batch')
+    parser.add_argument('--shards', type=str, default='', help='Comma separated host:port of shard servers to send /search to')
+    parser.add_argument('--shard_timeout', type=float, default=2.0, help='Seconds to wait for a shard before leaving its results out')
+    parser.add_argument('--log_file', type=str, default='server.log', help='File to append the server log to')
+    parser.add_argument('--log_queue', type=int, default=10000, help='Log lines that may wait to be written before the log policy applies')
+    parser.add_argument('--log_policy', choices=['drop', 'block'], default='drop', help='Drop log lines or make clients wait when the log queue is full')
+    parser.add_argument('--log_max_mb', type=float, default=0, help='Rotate the log file once it is this many MB, 0 to never rotate it')
+    parser.add_argument('--log_backups', type=int, default=5, help='Number of rotated log files to keep')
     args = parser.parse_args()
 
-    server = TelnetServer(port=args.port, delay=args.delay, delay_lines=args.delay_lines, files_dir=args.files_dir, max_results=args.max_results)
+    server = TelnetServer(port=args.port, delay=args.delay, delay_lines=args.delay_lines, search_args=args,
+                          engine=args.engine, backlog=args.backlog, max_keywords=args.max_keywords,
+                          log_file=args.log_file, log_queue=args.log_queue, log_policy=args.log_policy,
+                          log_max_mb=args.log_max_mb, log_backups=args.log_backups,
+                          page_size=args.page_size, cursor_timeout=args.cursor_timeout, cursor_kb=args.cursor_kb,
+                          shards=args.shards, shard_timeout=args.shard_timeout, max_batch=args.max_batch)
     server.start()
 
@@ -0,0 +1,64 @@
+# Copyright 2024 by moshix
+# Checks that scanning text files in chunks finds what reading them whole did
+#
+# run with:
+#   python3 -m pytest test_search_engine.py
+
+import os
+import re
+import random
+import search_engine
+
+
+def search_whole_file(files_dir, file_path, keywords):
+    """The search of text files before they were read in chunks, for comparison."""
+    matches = []
+    with open(os.path.join(files_dir, file_path), 'r', errors='ignore') as f:
+        content = f.read().lower()
+        if all(keyword in re.sub(r'\s+', ' ', content) for keyword in keywords):
+            for line_number, line in enumerate(content.splitlines(), 1):
+                if all(keyword in re.sub(r'\s+', ' ', line) for keyword in keywords):
+                    matches.append((file_path, f"Line {line_number}", line.strip()))
+    return matches
+
+
+def assert_same_matches(expected, found, chunk_bytes):
+    assert [match[:2] for match in found] == [match[:2] for match in expected]
+    for whole, chunked in zip(expected, found):
+        # Lines longer than a chunk are shown cut off
+        if chunk_bytes < 1024:
+            assert whole[2].startswith(chunked[2])
+        else:
+            assert chunked[2] == whole[2]
+
+
+def test_carriage_return_before_undecodable_byte(tmp_path):
+    # Decoding drops the \xe9, the \r and \n around it are a single line break
+    (tmp_path / 'a.txt').write_bytes(b'ab\r\xe9\nab\r\xe9\xff\ncd ab\n')
+    expected = search_whole_file(str(tmp_path), 'a.txt', ['ab'])
+    assert [location for _, location, _ in expected] == ['Line 1', 'Line 2', 'Line 3']
+    for chunk_bytes in range(1, 16):
+        found = search_engine.search_text_file(str(tmp_path), 'a.txt', ['ab'], chunk_bytes)
+        assert_same_matches(expected, found, chunk_bytes)
+
+
+def test_chunked_scan_matches_whole_file(tmp_path):
+    rng = random.Random(10)
+    pieces = ["ab", "AB", "c", "Cd", " ", "  ", "\t", "\n", "\r\n", "\r", "\x0b", "\x0c", "\x1c", "\x1d",
+              "\x1e", "\x1f", "\x85", "é", "É", "-", ".", "\xa0", "İ", "K"]
+    raw_bytes = [b"\xe9", b"\xff", b"\xc3", b"\x80"]
+    keyword_pieces = ["ab", "c", "cd", " ", "  ", "\t", "-", "é", "b c", "k", ""]
+    path = tmp_path / 'x.txt'
+    for _ in range(2000):
+        ascii_only = rng.random() < 0.5
+        choices = [piece for piece in pieces if piece.isascii() or not ascii_only]
+        encoding = rng.choice(["utf-8", "utf-8", "latin-1"])
+        data = b"".join(rng.choice(raw_bytes) if rng.random() < 0.1 else rng.choice(choices).encode(encoding, errors='replace')
+                        for _ in range(rng.randint(0, 60)))
+        path.write_bytes(data)
+        keywords = ["".join(rng.choice(keyword_pieces) for _ in range(rng.randint(0, 3))).lower().strip()
+                    for _ in range(rng.randint(1, 2))]
+        expected = search_whole_file(str(tmp_path), 'x.txt', keywords)
+        chunk_bytes = rng.choice([1, 2, 3, 5, 8, 16, 64, 1 << 20])
+        found = search_engine.search_text_file(str(tmp_path), 'x.txt', keywords, chunk_bytes)
+        assert_same_matches(expected, found, chunk_bytes)
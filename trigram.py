@@ -0,0 +1,288 @@
+# Copyright 2024 by moshix
+# Trigram queries for /regex
+#
+# A regular expression is parsed with the re module's own parser and turned
+# into a query of strings every match must contain, like code search engines
+# do: literals and small character classes are expanded into the set of
+# strings they match for as long as that set stays small, everything else
+# only tells that something is there. The query is an AND/OR tree of those
+# strings, ALL when nothing is known. Through the trigrams of the strings it
+# selects the candidate files from the trigram index of FILES/, and it is
+# checked on each line with plain substring tests, the full regex only runs
+# on the lines that pass.
+#
+# The index only knows the trigrams inside words (\w+ tokens of the
+# lowercased text), so only trigrams of three word characters are used and
+# strings without any are left out of the query.
+#
+# The re module backtracks and a search can't be stopped while it tries a
+# line, a pattern like (a+)+$ takes exponential time on a line it doesn't
+# match. regex_problem turns away the kinds of patterns that can do that
+# before the search starts.
+
+import re
+
+try:
+    from re import _parser as sre_parse
+except ImportError:  # Python < 3.11
+    import sre_parse
+
+# Largest set of strings a part of a pattern is expanded into
+MAX_EXACT = 64
+
+# Largest character class expanded into its characters
+MAX_CLASS = 8
+
+# Query that every line satisfies
+ALL = None
+
+# Longest pattern /regex accepts
+MAX_PATTERN = 256
+
+REPEATS = (sre_parse.MAX_REPEAT, sre_parse.MIN_REPEAT, getattr(sre_parse, 'POSSESSIVE_REPEAT', None))
+
+WORD_RE = re.compile(r'\w{3}')
+
+
+def word_trigrams(text):
+    """Return the trigrams of three word characters in text."""
+    return {text[i:i + 3] for i in range(len(text) - 2) if WORD_RE.fullmatch(text, i, i + 3)}
+
+
+def and_query(a, b):
+    if a is ALL:
+        return b
+    if b is ALL:
+        return a
+    parts = (a[1] if isinstance(a, tuple) and a[0] == 'and' else (a,)) + \
+            (b[1] if isinstance(b, tuple) and b[0] == 'and' else (b,))
+    return ('and', tuple(dict.fromkeys(parts)))
+
+
+def or_query(a, b):
+    if a is ALL or b is ALL:
+        return ALL
+    parts = (a[1] if isinstance(a, tuple) and a[0] == 'or' else (a,)) + \
+            (b[1] if isinstance(b, tuple) and b[0] == 'or' else (b,))
+    return ('or', tuple(dict.fromkeys(parts)))
+
+
+def exact_query(strings):
+    """Return the query for a match being one of strings."""
+    query = None
+    for i, string in enumerate(sorted(strings)):
+        if not word_trigrams(string):
+            return ALL
+        query = string if i == 0 else or_query(query, string)
+    return query
+
+
+class Info:
+    """What is known about the strings a part of a pattern matches.
+
+    exact is the set of all of them if it is small, else None; query holds
+    for every match of the part in any case.
+    """
+
+    def __init__(self, exact=None, query=ALL):
+        self.exact = exact
+        self.query = query
+
+    def to_query(self):
+        if self.exact is None:
+            return self.query
+        return and_query(self.query, exact_query(self.exact))
+
+
+def product(a, b):
+    if len(a) * len(b) > MAX_EXACT:
+        return None
+    return {x + y for x in a for y in b}
+
+
+def class_chars(items):
+    """Return the lowercased characters of a character class, or None if there are too many or they are unknown."""
+    chars = set()
+    for op, av in items:
+        if op == sre_parse.LITERAL:
+            chars.add(chr(av).lower())
+        elif op == sre_parse.RANGE:
+            low, high = av
+            if high - low >= MAX_CLASS * 2:
+                return None
+            chars.update(chr(c).lower() for c in range(low, high + 1))
+        else:
+            # Negated classes, \d, \w and the like
+            return None
+        if len(chars) > MAX_CLASS:
+            return None
+    return chars
+
+
+def analyze(pattern):
+    """Return the Info of a parsed sequence of pattern items."""
+    query = ALL
+    run = {''}          # strings the items since the last unknown item can be
+    exact = True        # every item so far was expanded
+    for op, av in pattern:
+        item = analyze_item(op, av)
+        if run is not None and item.exact is not None:
+            joined = product(run, item.exact)
+            if joined is not None:
+                run = joined
+                query = and_query(query, item.query)
+                continue
+        exact = False
+        if run is not None:
+            query = and_query(query, exact_query(run))
+        query = and_query(query, item.query)
+        run = item.exact
+    if exact:
+        return Info(run, query)
+    if run is not None:
+        query = and_query(query, exact_query(run))
+    return Info(None, query)
+
+
+def analyze_item(op, av):
+    if op == sre_parse.LITERAL:
+        return Info({chr(av).lower()})
+    if op == sre_parse.IN:
+        chars = class_chars(av)
+        return Info(chars) if chars is not None else Info()
+    if op == sre_parse.SUBPATTERN:
+        return analyze(av[-1])
+    if op == sre_parse.BRANCH:
+        alternatives = [analyze(alternative) for alternative in av[1]]
+        if all(info.exact is not None for info in alternatives):
+            strings = set().union(*(info.exact for info in alternatives))
+            if len(strings) <= MAX_EXACT:
+                query = alternatives[0].query
+                for info in alternatives[1:]:
+                    query = or_query(query, info.query)
+                return Info(strings, query)
+        query = alternatives[0].to_query()
+        for info in alternatives[1:]:
+            query = or_query(query, info.to_query())
+        return Info(None, query)
+    if op in (sre_parse.MAX_REPEAT, sre_parse.MIN_REPEAT, getattr(sre_parse, 'POSSESSIVE_REPEAT', None)):
+        low, high, item = av
+        if low == 0:
+            return Info()
+        info = analyze(item)
+        if low == high and info.exact is not None:
+            strings = {''}
+            for _ in range(low):
+                strings = product(strings, info.exact)
+                if strings is None:
+                    break
+            if strings is not None:
+                return Info(strings, info.query)
+        # At least one occurrence is always there
+        return Info(None, info.to_query())
+    if op in (sre_parse.AT, sre_parse.ASSERT, sre_parse.ASSERT_NOT):
+        # Anchors and lookarounds match the empty string
+        return Info({''})
+    return Info()
+
+
+def regex_query(pattern):
+    """Return the trigram query for lines matching pattern, ALL if it can't narrow them down."""
+    return analyze(sre_parse.parse(pattern)).to_query()
+
+
+def regex_problem(pattern):
+    """Return why pattern could take too long to try on a line, None if it can't."""
+    if len(pattern) > MAX_PATTERN:
+        return f"Patterns are limited to {MAX_PATTERN} characters."
+    return items_problem(sre_parse.parse(pattern), False)
+
+
+def wide_repeat(op, av):
+    """True for a repeat of any character or of a negated class, like .* or [^,]+."""
+    if op not in REPEATS or av[0] == av[1] or len(av[2]) != 1:
+        return False
+    item_op, item_av = av[2][0]
+    return (item_op in (sre_parse.ANY, sre_parse.NOT_LITERAL) or
+            (item_op == sre_parse.IN and item_av[:1] == [(sre_parse.NEGATE, None)]))
+
+
+def items_problem(items, repeated):
+    """Return the problem of a parsed sequence of pattern items, repeated if it is inside a repeat."""
+    after_wide = False
+    for op, av in items:
+        wide = wide_repeat(op, av)
+        if wide and after_wide:
+            # Every way of sharing the line out between them is tried
+            return "Repeats of any character in a row like .*.* are not allowed."
+        after_wide = wide or (after_wide and op == sre_parse.AT)
+        if op in REPEATS:
+            low, high, item = av
+            if repeated and low != high:
+                return "Nested repeats like (a+)+ are not allowed."
+            problem = items_problem(item, repeated or high > 1)
+        elif op == sre_parse.BRANCH:
+            alternatives = av[1]
+            # Alternatives starting with different letters can't both match at the same place
+            starts = [alternative[0][1] if len(alternative) and alternative[0][0] == sre_parse.LITERAL else None
+                      for alternative in alternatives]
+            if repeated and (None in starts or len({chr(start).lower() for start in starts}) < len(starts)):
+                return "Repeated alternatives that can match the same text like (a|aa)+ are not allowed."
+            problem = None
+            for alternative in alternatives:
+                problem = problem or items_problem(alternative, repeated)
+        elif op == sre_parse.SUBPATTERN:
+            problem = items_problem(av[-1], repeated)
+        elif op in (sre_parse.ASSERT, sre_parse.ASSERT_NOT):
+            problem = items_problem(av[1], repeated)
+        elif op == sre_parse.GROUPREF_EXISTS:
+            problem = items_problem(av[1], repeated)
+            if problem is None and av[2] is not None:
+                problem = items_problem(av[2], repeated)
+        elif op == getattr(sre_parse, 'ATOMIC_GROUP', None):
+            problem = items_problem(av, repeated)
+        else:
+            problem = None
+        if problem:
+            return problem
+    return None
+
+
+def query_predicate(query):
+    """Return a function telling whether a text contains the strings query asks for, None for ALL."""
+    if query is ALL:
+        return None
+    if isinstance(query, str):
+        return lambda text: query in text
+    parts = query[1]
+    if all(isinstance(part, str) for part in parts):
+        if query[0] == 'and':
+            return lambda text: all(part in text for part in parts)
+        return lambda text: any(part in text for part in parts)
+    predicates = [query_predicate(part) for part in parts]
+    if query[0] == 'and':
+        return lambda text: all(predicate(text) for predicate in predicates)
+    return lambda text: any(predicate(text) for predicate in predicates)
+
+
+def query_documents(query, trigram_documents):
+    """Return the ids of the documents containing the trigrams query asks for, None for all of them."""
+    if query is ALL:
+        return None
+    if isinstance(query, str):
+        doc_ids = None
+        for trigram in word_trigrams(query):
+            trigram_doc_ids = trigram_documents.get(trigram, ())
+            doc_ids = set(trigram_doc_ids) if doc_ids is None else doc_ids.intersection(trigram_doc_ids)
+            if not doc_ids:
+                break
+        return doc_ids
+    results = [query_documents(part, trigram_documents) for part in query[1]]
+    if query[0] == 'and':
+        known = [result for result in results if result is not None]
+        if not known:
+            return None
+        return set.intersection(*known)
+    if any(result is None for result in results):
+        return None
+    return set().union(*results)
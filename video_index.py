@@ -0,0 +1,129 @@
+# Copyright 2024 by moshix
+# In-memory index of the videos.txt catalog for /videosearch
+#
+# The catalog is read once into a VideoIndex: the lines, the lowercased
+# lines and a token -> line numbers index for substring and prefix lookup. A
+# keyword is turned into candidate lines through the tokens it can match,
+# the same way the FILES/ search index does it, and only those lines are
+# checked with the substring test /videosearch always used. VideoCatalog
+# builds a new VideoIndex on the side whenever the file changes on disk and
+# then swaps it in, so a search always sees one consistent version. An
+# index saved in a snapshot is used as long as the file hasn't changed.
+
+import os
+import threading
+from array import array
+from search_index import TOKEN_RE, Vocabulary
+
+
+class VideoIndex:
+    def __init__(self, lines=(), signature=None):
+        self.signature = signature
+        self.lines = list(lines)
+        self.lowered = [line.lower() for line in self.lines]
+
+        # token -> numbers of the lines containing it
+        postings = {}
+        for line_no, line in enumerate(self.lowered):
+            for token in set(TOKEN_RE.findall(line)):
+                line_numbers = postings.get(token)
+                if line_numbers is None:
+                    postings[token] = [line_no]
+                else:
+                    line_numbers.append(line_no)
+        self.vocabulary = Vocabulary(postings)
+
+        # The line numbers of all tokens go into one array, so the garbage
+        # collector doesn't have to look at hundreds of thousands of objects
+        self.token_ids = {}
+        self.starts = array('Q')
+        self.line_numbers = array('I')
+        for token_id, token in enumerate(self.vocabulary.tokens):
+            self.token_ids[token] = token_id
+            self.starts.append(len(self.line_numbers))
+            self.line_numbers.extend(postings[token])
+        self.starts.append(len(self.line_numbers))
+
+    @classmethod
+    def load(cls, path):
+        """Read a catalog file, or return an empty index if it doesn't exist."""
+        try:
+            st = os.stat(path)
+            with open(path, 'r', errors='ignore') as f:
+                content = f.read()
+        except OSError:
+            return cls()
+        lines = content.split('\n')
+        if lines[-1] == '':
+            lines.pop()
+        return cls(lines, (st.st_mtime_ns, st.st_size, st.st_ino))
+
+    def postings(self, token):
+        """Return the numbers of the lines containing token."""
+        token_id = self.token_ids[token]
+        return self.line_numbers[self.starts[token_id]:self.starts[token_id + 1]]
+
+    def posting_count(self, token):
+        token_id = self.token_ids[token]
+        return self.starts[token_id + 1] - self.starts[token_id]
+
+    def candidate_lines(self, keyword):
+        """Return the numbers of the lines that may contain keyword in order, or None for all of them."""
+        keyword_tokens = self.vocabulary.keyword_tokens(keyword)
+        if keyword_tokens is None:
+            return None
+        # Lines must contain every token of the keyword, so the rarest one is enough to go through
+        tokens = min(keyword_tokens, key=lambda tokens: sum(self.posting_count(token) for token in tokens))
+        if len(tokens) == 1:
+            return self.postings(tokens[0])
+        line_numbers = set()
+        for token in tokens:
+            line_numbers.update(self.postings(token))
+        return sorted(line_numbers)
+
+    def search(self, keyword):
+        """Return (line number, line) for every line containing the lowercased keyword."""
+        candidates = self.candidate_lines(keyword)
+        if candidates is None:
+            candidates = range(len(self.lines))
+        elif TOKEN_RE.fullmatch(keyword):
+            # A single word is in every line with a token containing it
+            return [(line_no + 1, self.lines[line_no].strip()) for line_no in candidates]
+        lowered = self.lowered
+        return [(line_no + 1, self.lines[line_no].strip()) for line_no in candidates if keyword in lowered[line_no]]
+
+
+class VideoCatalog:
+    """The current VideoIndex of a catalog file, reloaded when the file changes."""
+
+    def __init__(self, path='videos.txt', index=None):
+        self.path = path
+        self.lock = threading.Lock()
+        self.index = index if index is not None and index.signature == self.signature() else VideoIndex.load(path)
+        self.reloads = 0
+
+    def signature(self):
+        try:
+            st = os.stat(self.path)
+        except OSError:
+            return None
+        return (st.st_mtime_ns, st.st_size, st.st_ino)
+
+    def current(self):
+        """Return the index of the file as it is now, reloading it if it changed."""
+        index = self.index
+        if self.signature() == index.signature:
+            return index
+        # Searches keep using the old index while one of them loads the new one
+        if not self.lock.acquire(blocking=False):
+            return index
+        try:
+            if self.signature() != self.index.signature:
+                self.index = VideoIndex.load(self.path)
+                self.reloads += 1
+            return self.index
+        finally:
+            self.lock.release()
+
+    def search(self, keyword):
+        return self.current().search(keyword)